@@ -0,0 +1,229 @@
+import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+import dataset
+import streaming
+
+# Per-state aggregates behind the map. Each parquet file of the dataset is
+# summarized once into a few rows per state and awarding agency (transaction
+# count and summed `Transaction Amount`, by NAICS code and fiscal year), and
+# the summaries are kept in a small cache file next to the data. Only files
+# whose mtime or size changed since the cache was written are read again, so
+# building the map costs the same however much data there is.
+POP, RECIPIENT = 0, 1  # roles; also the columns of the arrays returned below
+STATE_COLUMNS = ["pop_state_code", "recipient_location_state_code"]
+AGENCY_COLUMN = "Awarding Agency"
+AWARD_TYPE_COLUMN = "Award Type"
+AMOUNT_COLUMN = "Transaction Amount"
+MEASURES = ("count", "amount")
+
+CACHE_NAME = "_aggregates.parquet"
+CACHE_SCHEMA = pa.schema([
+    ("path", pa.string()),
+    ("mtime_ns", pa.int64()),
+    ("size", pa.int64()),
+    ("naics", pa.string()),
+    ("fiscal_year", pa.int32()),
+    ("role", pa.int8()),
+    ("state", pa.string()),
+    ("agency", pa.string()),
+    ("award_type", pa.string()),
+    ("count", pa.int64()),
+    ("amount", pa.float64()),
+])
+
+
+def state_positions(values, states):
+    """
+    Position of each value in `states` as a numpy array, with len(states)
+    for nulls and codes that are not in `states`. Dictionary arrays are
+    looked up once per distinct value rather than once per row.
+    """
+    value_set = pa.array(states, pa.string())
+    other = len(states)
+    if pa.types.is_dictionary(values.type):
+        lookup = pc.fill_null(pc.index_in(values.dictionary, value_set=value_set), other)
+        lookup = np.append(lookup.to_numpy(), other)
+        indices = pc.fill_null(values.indices, len(values.dictionary))
+        return lookup[indices.to_numpy()]
+    return pc.fill_null(pc.index_in(values, value_set=value_set), other).to_numpy()
+
+
+# -----------------------------
+# Per-file summaries
+# -----------------------------
+def data_files(root=dataset.DATASET_DIR):
+    return sorted(root.glob("naics=*/fiscal_year=*/*.parquet"))
+
+
+def summarize_file(path, root=dataset.DATASET_DIR):
+    """
+    Count and summed amount per state, role, agency and award type for one
+    parquet file, as CACHE_SCHEMA rows. The file is streamed batch by batch,
+    so memory does not grow with its size.
+    """
+    stat = path.stat()
+    naics, year = (part.split("=", 1)[1] for part in path.relative_to(root).parts[:2])
+    keys = [AGENCY_COLUMN, AWARD_TYPE_COLUMN]
+    totals = [streaming.GroupTotals([column, *keys], sums=[AMOUNT_COLUMN]) for column in STATE_COLUMNS]
+    streaming.fold(streaming.batches(path, STATE_COLUMNS + keys + [AMOUNT_COLUMN]), *totals)
+    pieces = []
+    for role, (column, running) in enumerate(zip(STATE_COLUMNS, totals)):
+        grouped = running.result()
+        grouped = grouped.filter(pc.is_valid(grouped[column]))
+        n = grouped.num_rows
+        pieces.append(pa.table({
+            "path": pa.array([path.relative_to(root).as_posix()] * n, pa.string()),
+            "mtime_ns": pa.array([stat.st_mtime_ns] * n, pa.int64()),
+            "size": pa.array([stat.st_size] * n, pa.int64()),
+            "naics": pa.array([naics] * n, pa.string()),
+            "fiscal_year": pa.array([int(year)] * n, pa.int32()),
+            "role": pa.array([role] * n, pa.int8()),
+            "state": grouped[column],
+            "agency": grouped[AGENCY_COLUMN],
+            "award_type": grouped[AWARD_TYPE_COLUMN],
+            "count": grouped["count"],
+            "amount": grouped[AMOUNT_COLUMN],
+        }, schema=CACHE_SCHEMA))
+    return pa.concat_tables(pieces)
+
+
+def write_atomic(table, path):
+    """Write a parquet file through a temp file of its own, so concurrent writers never share one."""
+    with tempfile.NamedTemporaryFile(dir=path.parent, prefix=path.name + ".", suffix=".tmp", delete=False) as f:
+        pq.write_table(table, f)
+    os.replace(f.name, path)
+
+
+def per_file_cache(root, cache_name, schema, summarize):
+    """
+    `summarize(path, root)` of every file in the dataset, as one `schema`
+    table kept in `root / cache_name`. The rows of each file carry its
+    path, mtime and size (the first three columns of `schema`); they are
+    reused for files whose mtime and size are unchanged, changed and new
+    files are summarized in parallel, and the cache is rewritten only if
+    anything differed. Returns the table and whether it changed.
+    """
+    dataset.open_dataset(root)  # builds the dataset first if it does not exist yet
+    cache_path = root / cache_name
+    cached = pq.read_table(cache_path) if cache_path.exists() else schema.empty_table()
+    if cached.schema != schema:
+        cached = schema.empty_table()
+    signatures = dict(zip(cached["path"].to_pylist(),
+                          zip(cached["mtime_ns"].to_pylist(), cached["size"].to_pylist())))
+
+    current, stale = [], []
+    for path in data_files(root):
+        stat = path.stat()
+        relative = path.relative_to(root).as_posix()
+        current.append(relative)
+        if signatures.get(relative) != (stat.st_mtime_ns, stat.st_size):
+            stale.append(path)
+    stale_names = [path.relative_to(root).as_posix() for path in stale]
+    if not stale and set(signatures) == set(current):
+        return cached, False
+
+    keep = cached.filter(pc.is_in(cached["path"], value_set=pa.array(sorted(set(current) - set(stale_names)),
+                                                                     pa.string())))
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as pool:
+        fresh = list(pool.map(lambda path: summarize(path, root), stale))
+    rows = pa.concat_tables([keep, *fresh])
+    write_atomic(rows, cache_path)
+    return rows, True
+
+
+def load_summaries(root=dataset.DATASET_DIR):
+    """Summaries of every file in the dataset, as one CACHE_SCHEMA table (see per_file_cache)."""
+    return per_file_cache(root, CACHE_NAME, CACHE_SCHEMA, summarize_file)[0]
+
+
+# -----------------------------
+# Aggregate cube
+# -----------------------------
+def dimension(values):
+    """Sorted distinct values (nulls last) and the position of every value among them."""
+    labels = pc.unique(values)
+    labels = labels.take(pc.array_sort_indices(labels, null_placement="at_end"))
+    return labels.to_pylist(), pc.index_in(values, value_set=labels, skip_nulls=False).to_numpy()
+
+
+class Cube:
+    """
+    Dense transaction counts and summed `Transaction Amount` over
+    (role, state, NAICS code, awarding agency, fiscal year), built in one
+    vectorized pass over the cached file summaries. Slicing it never
+    touches parquet: select() is a few numpy reductions over the cube.
+    Award types are summed over; `award_types` only lists the values seen.
+    """
+
+    def __init__(self, states, naics, agencies, years, counts, amounts, award_types=()):
+        self.states = list(states)
+        self.naics = naics
+        self.agencies = agencies
+        self.years = years
+        self.award_types = list(award_types)
+        self.counts = counts  # int64, shape (2, states, naics, agencies, years)
+        self.amounts = amounts  # float64, same shape
+        self.totals = {"count": counts.sum(axis=(2, 3, 4)).T, "amount": amounts.sum(axis=(2, 3, 4)).T}
+        for array in (counts, amounts, *self.totals.values()):
+            array.flags.writeable = False  # shared by every reader
+
+    @classmethod
+    def from_summaries(cls, summaries, states):
+        naics, naics_pos = dimension(summaries["naics"])
+        agencies, agency_pos = dimension(summaries["agency"])
+        years, year_pos = dimension(summaries["fiscal_year"])
+        shape = (2, len(states) + 1, len(naics), len(agencies), len(years))  # +1: states not on the map
+        cells = np.ravel_multi_index(
+            (summaries["role"].to_numpy(), state_positions(summaries["state"], states), naics_pos, agency_pos,
+             year_pos), shape)
+        size = int(np.prod(shape))
+        counts = np.bincount(cells, weights=summaries["count"].to_numpy(), minlength=size)
+        amounts = np.bincount(cells, weights=summaries["amount"].to_numpy(), minlength=size)
+        award_types, _ = dimension(summaries["award_type"])
+        return cls(states, naics, agencies, years,
+                   counts.reshape(shape)[:, :-1].astype(np.int64), amounts.reshape(shape)[:, :-1], award_types)
+
+    def select(self, measure="count", naics=None, agencies=None, years=None):
+        """
+        Counts (measure="count") or dollars (measure="amount") per state and
+        role, as an array of shape (len(states), 2), over the given NAICS
+        codes, awarding agencies and fiscal years (None for all of them).
+        """
+        if measure not in MEASURES:
+            raise ValueError(f"measure must be one of {MEASURES}, not {measure!r}")
+        if naics is None and agencies is None and years is None:
+            return self.totals[measure]
+        cube = self.counts if measure == "count" else self.amounts
+        for axis, labels, wanted in ((2, self.naics, naics), (3, self.agencies, agencies), (4, self.years, years)):
+            if wanted is not None:
+                cube = cube.compress(np.isin(labels, list(wanted)), axis=axis)
+        return cube.sum(axis=(2, 3, 4)).T
+
+
+def load_cube(states, root=dataset.DATASET_DIR):
+    return Cube.from_summaries(load_summaries(root), states)
+
+
+# -----------------------------
+# Per-state totals
+# -----------------------------
+def state_totals(states, measure="count", root=dataset.DATASET_DIR):
+    """
+    Transactions (measure="count") or summed `Transaction Amount`
+    (measure="amount") per state, by place of performance (column POP) and
+    by recipient location (column RECIPIENT), as an array of shape
+    (len(states), 2) whose rows follow `states`.
+    """
+    return load_cube(states, root).select(measure)
+
+
+def state_counts(states, root=dataset.DATASET_DIR):
+    """Transactions per state; see state_totals()."""
+    return state_totals(states, "count", root)
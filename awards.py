@@ -0,0 +1,182 @@
+import argparse
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+import aggregates
+import dataset
+import streaming
+
+# Award-level rollup of the dataset. The dataset keeps one row per
+# transaction (`Award ID` + `Mod`), so an award modified 40 times is 40 rows;
+# this table has one row per award (keyed by `generated_internal_id`, since
+# task and delivery order numbers such as `Award ID` 0001 repeat across
+# parent contracts): its first and last action dates, summed
+# `Transaction Amount`, number of transactions, and the recipient, states,
+# agency and award type of its latest action. Like the map's aggregates, each
+# data file is rolled up once into partial award rows that are cached with
+# the file's mtime and size, so after a crawl only the rewritten files are
+# read again; the partials are then combined into the award table.
+KEY = "generated_internal_id"
+DATE_COLUMN = "Action Date"
+LATEST_COLUMNS = ["Award ID", "Recipient Name", "Recipient UEI", "recipient_location_state_code", "pop_state_code",
+                  aggregates.AGENCY_COLUMN, aggregates.AWARD_TYPE_COLUMN, "naics"]  # as of the latest action
+
+AWARDS_NAME = "_awards.parquet"
+PARTIALS_NAME = "_award_partials.parquet"
+AWARD_SCHEMA = pa.schema([
+    (KEY, pa.string()),
+    ("first_action_date", pa.date32()),
+    ("last_action_date", pa.date32()),
+    ("amount", pa.float64()),
+    ("transactions", pa.int64()),  # the base award and each modification
+    *((column, pa.string()) for column in LATEST_COLUMNS),
+])
+PARTIAL_SCHEMA = pa.schema([("path", pa.string()), ("mtime_ns", pa.int64()), ("size", pa.int64()), *AWARD_SCHEMA])
+
+
+def combine(rows):
+    """
+    One row per award from AWARD_SCHEMA rows that may repeat awards: the
+    earliest first date, latest last date, summed amounts and transactions,
+    and the LATEST_COLUMNS of the row with the latest last date (skipping
+    nulls, so a late action without a recipient keeps the earlier one).
+    """
+    rows = rows.select(AWARD_SCHEMA.names).filter(pc.is_valid(rows[KEY]))
+    rows = rows.take(pc.sort_indices(rows, sort_keys=[("last_action_date", "descending")]))  # nulls last
+    combined = rows.group_by([KEY], use_threads=False).aggregate([  # ordered, so "first" is the latest action
+        ("first_action_date", "min"), ("last_action_date", "max"), ("amount", "sum"), ("transactions", "sum"),
+        *((column, "first") for column in LATEST_COLUMNS),
+    ])
+    return combined.rename_columns([KEY if name == KEY else name.rsplit("_", 1)[0] for name in combined.column_names]
+                                   ).select(AWARD_SCHEMA.names).cast(AWARD_SCHEMA)
+
+
+def award_rows(batch, naics):
+    """A batch of transactions as AWARD_SCHEMA rows, one per transaction."""
+    n = batch.num_rows
+    key = pc.coalesce(streaming.plain(batch[KEY]), streaming.plain(batch["Award ID"]))  # older rows may lack it
+    columns = {KEY: key, "first_action_date": batch[DATE_COLUMN],
+               "last_action_date": batch[DATE_COLUMN], "amount": batch[aggregates.AMOUNT_COLUMN],
+               "transactions": pa.array([1] * n, pa.int64()), "naics": pa.array([naics] * n, pa.string())}
+    for column in LATEST_COLUMNS[:-1]:
+        columns[column] = pc.cast(streaming.plain(batch[column]), pa.string())
+    return pa.table(columns, schema=AWARD_SCHEMA)
+
+
+# -----------------------------
+# Per-file partials
+# -----------------------------
+def rollup_file(path, root=dataset.DATASET_DIR):
+    """
+    The awards of one parquet file as PARTIAL_SCHEMA rows. The file is
+    streamed, with the partial rows combined whenever they pile up, so
+    memory grows with the number of awards rather than of transactions.
+    """
+    stat = path.stat()
+    naics = path.relative_to(root).parts[0].split("=", 1)[1]
+    columns = [KEY, DATE_COLUMN, aggregates.AMOUNT_COLUMN, *LATEST_COLUMNS[:-1]]
+    pending, rows = [], 0
+    for batch in streaming.batches(path, columns):
+        pending.append(combine(award_rows(batch, naics)))
+        rows += pending[-1].num_rows
+        if rows > streaming.COMPACT_ROWS and len(pending) > 1:
+            pending = [combine(pa.concat_tables(pending))]
+            rows = pending[0].num_rows
+    awards = combine(pa.concat_tables(pending)) if pending else AWARD_SCHEMA.empty_table()
+    n = awards.num_rows
+    return pa.table({
+        "path": pa.array([path.relative_to(root).as_posix()] * n, pa.string()),
+        "mtime_ns": pa.array([stat.st_mtime_ns] * n, pa.int64()),
+        "size": pa.array([stat.st_size] * n, pa.int64()),
+        **{name: awards[name] for name in AWARD_SCHEMA.names},
+    }, schema=PARTIAL_SCHEMA)
+
+
+def build(root=dataset.DATASET_DIR):
+    """
+    The award table for the dataset in `root`, brought up to date: files
+    whose mtime and size are unchanged keep their cached partials, changed
+    and new files are rolled up in parallel, and the partials and the award
+    table are rewritten only if anything differed.
+    """
+    partials, changed = aggregates.per_file_cache(root, PARTIALS_NAME, PARTIAL_SCHEMA, rollup_file)
+    awards_path = root / AWARDS_NAME
+    if not changed and awards_path.exists():
+        awards = pq.read_table(awards_path)
+        if awards.schema == AWARD_SCHEMA:
+            return awards
+    awards = combine(partials)
+    aggregates.write_atomic(awards.sort_by([(KEY, "ascending")]), awards_path)
+    return awards
+
+
+# -----------------------------
+# Reading
+# -----------------------------
+def load(columns=None, filter=None, root=dataset.DATASET_DIR):
+    """
+    The award table (built or refreshed first if the dataset changed) as a
+    pyarrow Table, optionally narrowed to `columns` and rows matching
+    `filter`, e.g. load(filter=pc.field("pop_state_code") == "VA").
+    """
+    build(root)
+    return ds.dataset(root / AWARDS_NAME, format="parquet").to_table(columns=columns, filter=filter)
+
+
+def as_date(value):
+    """An ISO date (or datetime) string as a date32 scalar."""
+    return pa.scalar(np.datetime64(value, "D").item(), pa.date32())
+
+
+def state_counts(awards, states, naics=None, agencies=None, award_types=None, start=None, end=None):
+    """
+    Awards per state, by the place of performance and recipient location of
+    their latest action, shaped like aggregates.state_totals(). Filters
+    match the latest action's NAICS code, agency and award type; a date
+    range keeps the awards active during it (first action on or before its
+    end, last action on or after its start).
+    """
+    conditions = [pc.is_in(awards[column], value_set=pa.array(list(wanted), pa.string()))
+                  for column, wanted in (("naics", naics), (aggregates.AGENCY_COLUMN, agencies),
+                                         (aggregates.AWARD_TYPE_COLUMN, award_types)) if wanted]
+    if start:
+        conditions.append(pc.greater_equal(awards["last_action_date"], as_date(start)))
+    if end:
+        conditions.append(pc.less_equal(awards["first_action_date"], as_date(end)))
+    if conditions:
+        keep = conditions[0]
+        for condition in conditions[1:]:
+            keep = pc.and_(keep, condition)
+        awards = awards.filter(keep)  # awards without a date drop out of any date range
+    size = len(states)
+    totals = np.zeros((size, 2), np.int64)
+    for role, column in enumerate(aggregates.STATE_COLUMNS):
+        positions = aggregates.state_positions(awards[column].combine_chunks(), states)
+        totals[:, role] = np.bincount(positions, minlength=size + 1)[:size]
+    return totals
+
+
+def summary(awards, top=10):
+    """Award and transaction counts, and the `top` largest awards by amount, as text."""
+    transactions = pc.sum(awards["transactions"]).as_py() or 0
+    lines = [f"{awards.num_rows} awards from {transactions} transactions "
+             f"({transactions / max(awards.num_rows, 1):.1f} per award)"]
+    largest = awards.take(pc.select_k_unstable(awards, top, sort_keys=[("amount", "descending")]))
+    lines.append(f"{'award':<24} {'first':>10} {'last':>10} {'actions':>7} {'amount':>16}  recipient")
+    for row in largest.to_pylist():
+        lines.append(f"{row['Award ID']:<24} {str(row['first_action_date']):>10} {str(row['last_action_date']):>10} "
+                     f"{row['transactions']:>7} {row['amount'] or 0:>16,.0f}  {row['Recipient Name']}")
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Roll the transaction dataset up to one row per award")
+    parser.add_argument("--top", type=int, default=10, help="largest awards to list")
+    args = parser.parse_args()
+
+    print(summary(build(), args.top))
+    print(f"Award table in {dataset.DATASET_DIR / AWARDS_NAME}")
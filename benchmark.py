@@ -0,0 +1,295 @@
+import argparse
+import contextlib
+import io
+import json
+import multiprocessing
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+# Benchmarks for each stage of the pipeline: the crawl (against the local
+# mock API), the map's per-state aggregation, building a figure, and the
+# update_map callback, and the map's startup. Every stage runs in a fresh process so its peak memory
+# is its own, and the dataset stages run against synthetic copies of the
+# dataset scaled up 10x / 100x. Project modules are imported inside the
+# stages, after DATASET_ENV points them at the dataset being measured.
+BENCH_DIR = Path("bench_data")
+DATASET_ENV = "USASPENDING_DATASET_DIR"  # read by dataset.py
+SCALES = (1, 10)  # 100 works too, but takes minutes and gigabytes to generate
+STAGES = ("crawl", "aggregate", "figure", "callback", "startup")
+REPEAT = 20
+
+
+# -----------------------------
+# Measurements
+# -----------------------------
+def percentiles(samples):
+    """p50 / p95 / p99 / max of durations in seconds, as milliseconds."""
+    ordered = sorted(samples)
+
+    def at(fraction):
+        return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))] * 1000
+
+    return {"n": len(ordered), "p50_ms": at(0.50), "p95_ms": at(0.95), "p99_ms": at(0.99), "max_ms": ordered[-1] * 1000}
+
+
+def timed(fn, repeat):
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - started)
+    return samples
+
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024  # Linux reports KiB
+
+
+def result(stage, name, samples, **extra):
+    return {"stage": stage, "name": name, **percentiles(samples), **extra, "peak_rss_mb": peak_rss_mb()}
+
+
+# -----------------------------
+# Synthetic datasets
+# -----------------------------
+def generate_dataset(scale, root=None):
+    """
+    A copy of the real dataset with every NAICS code's rows repeated `scale`
+    times, written through dataset.write_code. Reused if it already exists.
+    """
+    import pyarrow.parquet as pq
+
+    import dataset
+
+    root = root or BENCH_DIR / f"scale_{scale}"
+    if dataset.dataset_exists(root):
+        return root
+    source = dataset.DATASET_DIR
+    dataset.open_dataset(source)
+    print(f"Generating {scale}x dataset in {root}...")
+    for naics in dataset.naics_codes(source):
+        files = sorted((source / f"naics={naics}").glob("fiscal_year=*/*.parquet"))
+
+        def tables():
+            for _ in range(scale):
+                for file in files:
+                    parquet_file = pq.ParquetFile(file)
+                    for i in range(parquet_file.num_row_groups):
+                        yield parquet_file.read_row_group(i)
+
+        dataset.write_code(naics, tables(), root)
+    return root
+
+
+# -----------------------------
+# Stages (each runs in its own process)
+# -----------------------------
+def bench_crawl(repeat, codes=4, records_per_code=2000, latency=0.01, concurrency=8):
+    import mock_api
+    from fetch_client import FetchClient
+    from usaspending import crawl
+
+    class TimedClient(FetchClient):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            self.latencies = []
+
+        def post(self, payload, url=None, **kwargs):
+            started = time.perf_counter()
+            try:
+                return super().post(payload, url, **kwargs)
+            finally:
+                self.latencies.append(time.perf_counter() - started)
+
+    server, url = mock_api.start_server(latency=latency, records_per_code=records_per_code)
+    naics = [str(336411 + i) for i in range(codes)]
+    runs, latencies, records, pages = [], [], 0, 0
+    try:
+        for _ in range(repeat):
+            client = TimedClient(url, pool_size=concurrency)
+            with tempfile.TemporaryDirectory() as tmp, contextlib.redirect_stdout(io.StringIO()):
+                started = time.perf_counter()
+                stats = crawl(naics, concurrency=concurrency, rate=1000.0, base_url=url, output_dir=Path(tmp),
+                              client=client)
+                runs.append(time.perf_counter() - started)
+            client.close()
+            latencies += client.latencies
+            records += stats.records
+            pages += stats.pages
+    finally:
+        server.shutdown()
+    elapsed = sum(runs)
+    return [
+        result("crawl", "full crawl", runs, records_per_sec=records / elapsed, pages_per_sec=pages / elapsed),
+        result("crawl", "request", latencies),
+    ]
+
+
+def bench_aggregate(repeat):
+    import aggregates
+    import dataset
+    from map import US_STATES
+
+    root = dataset.DATASET_DIR
+    rows = dataset.open_dataset(root).count_rows()
+    (root / aggregates.CACHE_NAME).unlink(missing_ok=True)
+    cold = timed(lambda: aggregates.state_counts(US_STATES, root), 1)
+    warm = timed(lambda: aggregates.state_counts(US_STATES, root), repeat)
+    return [
+        result("aggregate", "state counts, no cache", cold, rows=rows, rows_per_sec=rows / cold[0]),
+        result("aggregate", "state counts, cached", warm, rows=rows),
+    ]
+
+
+def bench_figure(repeat):
+    import map
+
+    states = map.state_store("count")
+    results = []
+    for name, value_type, color_scale in (("red", "red", "Reds"),
+                                          ("combined", "combined_value", [[0, "red"], [0.5, "white"], [1, "green"]]),
+                                          ("white", "red", map.WHITE_SCALE)):
+        samples = timed(lambda: map.create_fig(states, value_type, color_scale).to_plotly_json(), repeat)
+        results.append(result("figure", f"create_fig {name}", samples))
+    return results
+
+
+def bench_callback(repeat):
+    from dash._callback_context import context_value
+    from dash._utils import AttributeDict, to_json
+
+    import filter_index
+    import map
+
+    started = time.perf_counter()
+    map.get_top_k()  # built at startup (or read from the snapshot); don't time clicks against it
+    index_build = time.perf_counter() - started
+    started = time.perf_counter()
+    filter_index.get_index(map.US_STATES)  # likewise built at startup
+    filter_build = time.perf_counter() - started
+
+    def clear_caches():
+        map.state_store.cache_clear()
+        map.figure_cache.figures.clear()
+
+    def call(trigger, shown, selected, click=None, naics=None, award_types=None):
+        context_value.set(AttributeDict(triggered_inputs=[{"prop_id": trigger, "value": 1}]))
+        return map.update_map(1, 1, 1, 1, click, "count", naics, None, award_types, None, None, shown, selected)
+
+    steps = {
+        "gradient button": lambda i, shown, sel: call("btn-red.n_clicks", shown, sel),
+        "state click": lambda i, shown, sel: call("us-map.clickData", shown, sel, click={
+            "points": [{"location": map.US_STATES[i % len(map.US_STATES)]}]}),
+        "NAICS filter": lambda i, shown, sel: call("filter-naics.value", shown, sel,
+                                                   naics=map.get_cube().naics[:1]),
+        "award type filter": lambda i, shown, sel: call("filter-award-type.value", shown, sel,
+                                                        award_types=map.get_cube().award_types[:1]),
+    }
+    # Cold samples start from empty state_store / figure caches, so they time the aggregation and the figure
+    # build; cached samples repeat the same inputs, as a user clicking around the same view does
+    results = []
+    for name, step in steps.items():
+        for cold in (True, False):
+            shown = selected = None
+            samples, payload = [], 0
+            for i in range(repeat):
+                if cold:
+                    clear_caches()
+                started = time.perf_counter()
+                out = step(i, shown, selected)
+                payload = len(to_json(out[0]))
+                samples.append(time.perf_counter() - started)
+                shown, selected = out[-2], out[-1]
+            results.append(result("callback", f"{name}, {'cold' if cold else 'cached'}", samples,
+                                  figure_bytes=payload))
+    results.append(result("callback", "drilldown index wait", [index_build]))
+    results.append(result("callback", "filter index wait", [filter_build]))
+    return results
+
+
+def bench_startup(repeat):
+    import map
+
+    def interpreter(code):
+        subprocess.run([sys.executable, "-c", code], check=True, stdout=subprocess.DEVNULL)
+
+    def worker():
+        pid = os.fork()
+        if pid == 0:
+            map.create_fig(map.state_store("count")).to_plotly_json()
+            os._exit(0)
+        os.waitpid(pid, 0)
+
+    repeat = max(1, repeat // 4)  # every sample is a new interpreter
+    results = [result("startup", "import map", timed(lambda: interpreter("import map"), repeat))]
+    samples = timed(lambda: interpreter("import map; map.create_app(snapshot=False, warm=False)"), repeat)
+    results.append(result("startup", "create_app from dataset", samples))
+    map.write_snapshot()
+    samples = timed(lambda: interpreter("import map; map.create_app(warm=False)"), repeat)
+    results.append(result("startup", "create_app from snapshot", samples))
+    map.create_server()
+    results.append(result("startup", "preforked worker, 1st call", timed(worker, repeat)))
+    return results
+
+
+BENCHMARKS = {"crawl": bench_crawl, "aggregate": bench_aggregate, "figure": bench_figure, "callback": bench_callback,
+              "startup": bench_startup}
+
+
+def set_dataset(root):
+    if root is not None:
+        os.environ[DATASET_ENV] = str(root)
+
+
+def run_isolated(stage, repeat, root=None):
+    """Run one stage in a fresh interpreter pointed at `root`."""
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(1, mp_context=context, initializer=set_dataset, initargs=(root,)) as pool:
+        return pool.submit(BENCHMARKS[stage], repeat).result()
+
+
+def run(stages=STAGES, scales=SCALES, repeat=REPEAT):
+    results = []
+    if "crawl" in stages:
+        results += [dict(r, scale=None) for r in run_isolated("crawl", max(1, repeat // 10))]
+    for scale in scales:
+        root = generate_dataset(scale).resolve()
+        for stage in stages:
+            if stage != "crawl":
+                results += [dict(r, scale=scale) for r in run_isolated(stage, repeat, root)]
+    return results
+
+
+def report(results):
+    print(f"\n{'stage':<10} {'scale':>5}  {'benchmark':<28} {'n':>4} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} "
+          f"{'peak MB':>8}  throughput")
+    for r in results:
+        throughput = ", ".join(f"{k}={r[k]:,.0f}" for k in ("records_per_sec", "pages_per_sec", "rows_per_sec",
+                                                            "figure_bytes") if k in r)
+        print(f"{r['stage']:<10} {r['scale'] or '':>5}  {r['name']:<28} {r['n']:>4} {r['p50_ms']:>9.2f} "
+              f"{r['p95_ms']:>9.2f} {r['p99_ms']:>9.2f} {r['peak_rss_mb']:>8.0f}  {throughput}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the crawl, aggregation and map stages")
+    parser.add_argument("--stages", nargs="+", choices=STAGES, default=list(STAGES))
+    parser.add_argument("--scales", nargs="+", type=int, default=list(SCALES),
+                        help="dataset sizes as multiples of the real dataset")
+    parser.add_argument("--repeat", type=int, default=REPEAT)
+    parser.add_argument("--json", type=Path, help="also write the results here")
+    parser.add_argument("--clean", action="store_true", help=f"delete generated datasets in {BENCH_DIR} first")
+    args = parser.parse_args()
+
+    if args.clean:
+        shutil.rmtree(BENCH_DIR, ignore_errors=True)
+    results = run(args.stages, args.scales, args.repeat)
+    report(results)
+    if args.json:
+        args.json.write_text(json.dumps(results, indent=2))
@@ -0,0 +1,129 @@
+import json
+import os
+import shutil
+import tempfile
+import threading
+from pathlib import Path
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+MANIFEST_NAME = "_crawl_manifest.json"
+STAGING_DIR = "_staging"
+ROW_GROUP_RECORDS = 10_000  # records buffered in memory before they are written out
+
+
+class CrawlManifest:
+    """
+    Progress of an interrupted crawl, stored as JSON next to the parquet output.
+
+    Each (NAICS code, filter window) has an entry recording how many records
+    are safely on disk in staged part files, how many parts there are,
+    whether the window's last page has come back with every record up to
+    it on disk (exhausted), and whether every page has. Each code also has a plan listing
+    its windows in merge order; both are dropped once the code's records
+    are in the dataset. Every update is written through to disk atomically,
+    so a crash loses at most the pages fetched since the last flush.
+
+    The manifest also keeps a per-code high-water mark on `Action Date`,
+    which survives between crawls and drives incremental refreshes.
+    """
+
+    def __init__(self, output_dir):
+        self.path = Path(output_dir) / MANIFEST_NAME
+        self.lock = threading.Lock()
+        self.data = {"windows": {}, "plans": {}, "high_water": {}}
+        if self.path.exists():
+            self.data.update(json.loads(self.path.read_text()))
+
+    @staticmethod
+    def key(naics, window):
+        return "|".join([naics, *window])
+
+    def get(self, naics, window):
+        return dict(self.data["windows"].get(self.key(naics, window), {}))
+
+    def update(self, naics, window, **fields):
+        with self.lock:
+            self.data["windows"].setdefault(self.key(naics, window), {}).update(fields)
+            self.save()
+
+    def plan(self, naics):
+        """How an earlier, unfinished crawl split a NAICS code into windows."""
+        return self.data["plans"].get(naics)
+
+    def set_plan(self, naics, **fields):
+        with self.lock:
+            self.data["plans"].setdefault(naics, {}).update(fields)
+            self.save()
+
+    def high_water(self, naics):
+        """Latest `Action Date` stored for a NAICS code, or None."""
+        return self.data["high_water"].get(naics)
+
+    def set_high_water(self, naics, action_date):
+        with self.lock:
+            self.data["high_water"][naics] = action_date
+            self.save()
+
+    def drop_code(self, naics):
+        """Forget a NAICS code's plan and windows, once its records are in the dataset."""
+        with self.lock:
+            self.data["plans"].pop(naics, None)
+            self.data["windows"] = {key: entry for key, entry in self.data["windows"].items()
+                                    if not key.startswith(naics + "|")}
+            self.save()
+
+    def clear_windows(self):
+        with self.lock:
+            self.data["windows"] = {}
+            self.data["plans"] = {}
+            self.save()
+
+    def save(self):
+        # A temp file of its own, so a second process saving at the same time can't replace it half-written
+        with tempfile.NamedTemporaryFile("w", dir=self.path.parent, prefix=self.path.name + ".", suffix=".tmp",
+                                         delete=False) as f:
+            f.write(json.dumps(self.data, indent=2, sort_keys=True))
+        os.replace(f.name, self.path)
+
+
+def staging_dir(output_dir, naics, window):
+    return Path(output_dir) / STAGING_DIR / CrawlManifest.key(naics, window).replace("|", "_")
+
+
+def part_path(directory, part_number):
+    return directory / f"part-{part_number:05d}.parquet"
+
+
+def write_table(table, path):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    pq.write_table(table, path)
+    return path
+
+
+def remove_parts_from(directory, part_number):
+    """Delete parts numbered `part_number` and up: written after the last checkpoint, so not counted in it."""
+    for part in directory.glob("part-*.parquet"):
+        if int(part.stem.split("-")[1]) >= part_number:
+            part.unlink()
+
+
+def iter_parts(directories):
+    """
+    Staged records of each directory, in the order given, one row group at a
+    time as pyarrow Tables cast to a single schema.
+    """
+    parts = [part for directory in directories for part in sorted(directory.glob("part-*.parquet"))]
+    if not parts:
+        return
+    schema = pa.unify_schemas([pq.read_schema(p) for p in parts], promote_options="permissive")
+    for part in parts:
+        part_file = pq.ParquetFile(part)
+        for i in range(part_file.num_row_groups):
+            yield part_file.read_row_group(i).cast(schema)
+
+
+def remove_parts(directories):
+    for directory in directories:
+        shutil.rmtree(directory, ignore_errors=True)
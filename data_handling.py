@@ -1,41 +1,238 @@
-from pathlib import Path
+import argparse
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+import aggregates
+import dataset
+import streaming
+
+# Profile of every column across the whole dataset. Row counts, null counts
+# and min / max come from the parquet footers without reading any data
+# (every file is written with column statistics). Distinct counts and top
+# values need the data, so each column is streamed once and folded into a
+# HyperLogLog and a count-min sketch, which are merged across files. Files
+# are split between worker processes, one merged profile per worker.
+TOP_K = 10
+CANDIDATES = 4 * TOP_K  # values kept per column while looking for the top ones
+PENDING_VALUES = 64 * 1024  # distinct values counted exactly before they go into the sketches
+PARTITION_COLUMNS = ("naics", "fiscal_year")
+
+
+class ColumnProfile:
+    def __init__(self, name, type):
+        self.name = name
+        self.type = type
+        self.rows = 0
+        self.nulls = 0
+        self.minimum = None
+        self.maximum = None
+        self.distinct = streaming.HyperLogLog()
+        self.frequencies = streaming.CountMin()
+        self.candidates = {}  # value: hash
+        self.pending = []  # (values, counts) not yet in the sketches
+        self.pending_values = 0
+
+    def add_statistics(self, rows, nulls, minimum=None, maximum=None):
+        self.rows += rows
+        self.nulls += nulls
+        if minimum is not None:
+            self.minimum = minimum if self.minimum is None else min(self.minimum, minimum)
+        if maximum is not None:
+            self.maximum = maximum if self.maximum is None else max(self.maximum, maximum)
+
+    def add_counts(self, values, counts):
+        """
+        Count distinct non-null `values` (an arrow array) seen `counts` times.
+        Small batches are combined exactly first, so the sketches are updated
+        a few times per column rather than once per file.
+        """
+        self.pending.append((values, counts))
+        self.pending_values += len(values)
+        if self.pending_values >= PENDING_VALUES:
+            self.flush()
+
+    def flush(self):
+        if not self.pending:
+            return
+        if len(self.pending) == 1:
+            values, counts = self.pending[0]
+        else:
+            grouped = pa.table({"value": pa.concat_arrays([values for values, _ in self.pending]),
+                                "count": np.concatenate([counts for _, counts in self.pending])})
+            grouped = grouped.group_by("value", use_threads=False).aggregate([("count", "sum")])
+            values, counts = grouped["value"].combine_chunks(), grouped["count_sum"].to_numpy()
+        self.pending, self.pending_values = [], 0
+        hashes = streaming.hash64(values)
+        self.distinct.add(hashes)
+        self.frequencies.add(hashes, counts)
+        heaviest = np.argsort(counts)[::-1][:CANDIDATES]
+        self.keep_candidates(zip(values.take(pa.array(heaviest)).to_pylist(), hashes[heaviest]))
+
+    def keep_candidates(self, candidates):
+        self.candidates.update(candidates)
+        if len(self.candidates) > CANDIDATES:
+            values, hashes = list(self.candidates), np.array(list(self.candidates.values()), np.uint64)
+            heaviest = np.argsort(self.frequencies.estimate(hashes), kind="stable")[::-1][:CANDIDATES]
+            self.candidates = {values[i]: hashes[i] for i in heaviest}
+
+    def merge(self, other):
+        self.flush()
+        other.flush()
+        self.add_statistics(other.rows, other.nulls, other.minimum, other.maximum)
+        self.distinct.merge(other.distinct)
+        self.frequencies.merge(other.frequencies)
+        self.keep_candidates(other.candidates.items())
+
+    def top(self, k=TOP_K):
+        """The k most frequent values with their (over-)estimated counts."""
+        self.flush()
+        if not self.candidates:
+            return []
+        estimates = self.frequencies.estimate(np.array(list(self.candidates.values()), np.uint64))
+        ranked = sorted(zip(self.candidates, estimates.tolist()), key=lambda pair: -pair[1])
+        return ranked[:k]
+
+    def summary(self, k=TOP_K):
+        self.flush()
+        distinct = min(round(self.distinct.estimate()), self.rows - self.nulls)
+        return {"column": self.name, "type": self.type, "rows": self.rows, "nulls": self.nulls,
+                "distinct": distinct, "min": self.minimum, "max": self.maximum, "top": self.top(k)}
+
+
+def value_counts(values):
+    """Distinct non-null values of an arrow array and how often each occurs."""
+    if pa.types.is_dictionary(values.type):
+        counts = np.bincount(values.indices.drop_null().to_numpy(), minlength=len(values.dictionary))
+        used = np.flatnonzero(counts)
+        return values.dictionary.take(pa.array(used)), counts[used]
+    counted = pc.value_counts(values)
+    counted = counted.filter(pc.is_valid(counted.field("values")))
+    return counted.field("values"), counted.field("counts").to_numpy()
+
+
+def type_name(kind):
+    return f"dictionary<{kind.value_type}>" if pa.types.is_dictionary(kind) else str(kind)
+
+
+def footer_statistics(metadata, index):
+    """(nulls, min, max) of column `index` from a parquet footer, or None if a row group has no statistics."""
+    nulls, minimum, maximum = 0, None, None
+    for group in range(metadata.num_row_groups):
+        stats = metadata.row_group(group).column(index).statistics
+        if stats is None or not stats.has_null_count:
+            return None
+        nulls += stats.null_count
+        if stats.has_min_max:
+            minimum = stats.min if minimum is None else min(minimum, stats.min)
+            maximum = stats.max if maximum is None else max(maximum, stats.max)
+        elif stats.null_count != metadata.row_group(group).num_rows:
+            return None
+    return nulls, minimum, maximum
+
+
+def profile_files(paths, root=dataset.DATASET_DIR, columns=None, sketches=True):
+    """One merged {column: ColumnProfile} for `paths`."""
+    profiles = {}
+    for path in paths:
+        parquet_file = pq.ParquetFile(path)
+        rows, schema = parquet_file.metadata.num_rows, parquet_file.schema_arrow
+        names = [name for name in schema.names if columns is None or name in columns]
+        for name in names:
+            if name not in profiles:
+                profiles[name] = ColumnProfile(name, type_name(schema.field(name).type))
+        unknown = []
+        for name in names:
+            statistics = footer_statistics(parquet_file.metadata, schema.get_field_index(name))
+            if statistics is None:
+                unknown.append(name)
+            else:
+                profiles[name].add_statistics(rows, *statistics)
+        if sketches or unknown:
+            summary = streaming.ColumnSummary()
+            for batch in streaming.batches(path, names if sketches else unknown):
+                if unknown:
+                    summary.add(batch.select(unknown))
+                if sketches:
+                    for name, values in zip(batch.schema.names, batch.columns):
+                        profiles[name].add_counts(*value_counts(values))
+            for name in unknown:
+                profiles[name].add_statistics(rows, summary.nulls.get(name, 0), summary.minimum.get(name),
+                                              summary.maximum.get(name))
 
-# Directory where your fetched parquet files are stored
-PARQUET_DIR = Path("usa_spending_defense")
+        # Partition columns are not stored in the files; their one value per file comes from the path
+        for name, value in zip(PARTITION_COLUMNS, (part.split("=", 1)[1] for part in path.relative_to(root).parts)):
+            if columns is not None and name not in columns:
+                continue
+            value = pa.array([value], pa.string()) if name == "naics" else pa.array([int(value)], pa.int32())
+            profile = profiles.setdefault(name, ColumnProfile(name, str(value.type)))
+            profile.add_statistics(rows, 0, value[0].as_py(), value[0].as_py())
+            if sketches:
+                profile.add_counts(value, np.array([rows]))
+    for profile in profiles.values():
+        profile.flush()
+    return profiles
 
-# List all parquet files
-files = list(PARQUET_DIR.glob("*.parquet"))
-print(f"Found {len(files)} parquet files.")
 
-if not files:
-    raise FileNotFoundError("No parquet files found in this folder.")
+def merge_profiles(parts):
+    merged = {}
+    for profiles in parts:
+        for name, profile in profiles.items():
+            if name in merged:
+                merged[name].merge(profile)
+            else:
+                merged[name] = profile
+    return merged
 
-# Read the first file
-df = pd.read_parquet(files[0])
 
-# 1️⃣ Show all column names
-print("Columns in this file:")
-print(df.columns.tolist())
+def profile_dataset(root=dataset.DATASET_DIR, columns=None, sketches=True, workers=None):
+    """{column: ColumnProfile} for the whole dataset, with the files split between `workers` processes."""
+    dataset.open_dataset(root)  # builds the dataset first if it does not exist yet
+    files = aggregates.data_files(root)
+    workers = max(1, min(workers or os.cpu_count(), len(files)))
+    if workers == 1:
+        return profile_files(files, root, columns, sketches)
+    chunks = [files[i::workers] for i in range(workers)]
+    with ProcessPoolExecutor(workers) as pool:
+        parts = pool.map(profile_files, chunks, [root] * workers, [columns] * workers, [sketches] * workers)
+        return merge_profiles(parts)
 
-# 2️⃣ Show first 5 rows of all columns (no truncation)
-pd.set_option('display.max_columns', None)
-print("\nFirst 5 rows:")
-print(df.head())
 
-# 3️⃣ Quick summary of each column
-print("\nData types and non-null counts:")
-print(df.info())
+def report(profiles, top=3):
+    pd.set_option("display.max_columns", None)
+    pd.set_option("display.width", 200)
+    pd.set_option("display.max_colwidth", 40)
+    rows = [profile.summary(top) for profile in profiles.values()]
+    table = pd.DataFrame(rows).set_index("column")
+    table["null %"] = (100 * table["nulls"] / table["rows"].clip(lower=1)).round(1)
+    columns = ["type", "rows", "null %", "distinct", "min", "max", "top"]
+    if not any(profile.candidates for profile in profiles.values()):
+        columns = [column for column in columns if column not in ("distinct", "top")]
+    table["top"] = table["top"].map(lambda pairs: ", ".join(f"{value} ({count:,})" for value, count in pairs))
+    print(table[columns].to_string())
 
-# 4️⃣ Inspect the Primary Place of Performance column
-pop_col = "pop_state_code"  # adjust if your column is named differently
-if pop_col in df.columns:
-    print(f"\nTop 10 states by number of contracts in {files[0].name}:")
-    print(df[pop_col].value_counts().head(10))
-else:
-    print(f"\nColumn '{pop_col}' not found in this file. Check your column names.")
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Profile every column of the dataset")
+    parser.add_argument("--columns", nargs="+", help="only profile these columns")
+    parser.add_argument("--footers-only", action="store_true",
+                        help="skip distinct counts and top values; only read the parquet footers")
+    parser.add_argument("--top", type=int, default=3, help="top values to print per column")
+    parser.add_argument("--workers", type=int, help="processes to use (default: one per core)")
+    parser.add_argument("--json", type=str, help="also write the full profile here")
+    args = parser.parse_args()
 
-# 5️⃣ Optionally check NAICS codes present
-if "naics_code" in df.columns:
-    print("\nNAICS codes present in this file:")
-    print(df["naics_code"].value_counts().head(10))
+    started = time.perf_counter()
+    profiles = profile_dataset(columns=args.columns, sketches=not args.footers_only, workers=args.workers)
+    elapsed = time.perf_counter() - started
+    report(profiles, args.top)
+    print(f"\nProfiled {len(profiles)} columns of {dataset.DATASET_DIR} in {elapsed:.2f}s")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump([profile.summary() for profile in profiles.values()], f, indent=2, default=str)
@@ -0,0 +1,282 @@
+import argparse
+import functools
+import itertools
+import json
+import os
+import shutil
+from pathlib import Path
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+import streaming
+from schema import SCHEMA, normalize
+
+# One partitioned dataset for every NAICS code:
+#   usa_spending_dataset/naics=336411/fiscal_year=2024/part-0.parquet
+# Readers filter on naics / fiscal_year to skip whole directories, and on any
+# other column to skip row groups using the parquet column statistics. Caches
+# and metadata kept in it (the map's aggregates and snapshot, the award table,
+# the crawl manifest) are named with a leading underscore, which dataset scans
+# skip.
+DATASET_DIR = Path(os.environ.get("USASPENDING_DATASET_DIR", "usa_spending_dataset"))
+LEGACY_DIR = Path("usa_spending_defense")  # old one-file-per-code layout
+DATASET_VERSION = 2  # bumped whenever the on-disk schema changes
+METADATA_NAME = "_dataset.json"
+
+PARTITIONING = ds.partitioning(
+    pa.schema([("naics", pa.string()), ("fiscal_year", pa.int32())]), flavor="hive"
+)
+WRITE_OPTIONS = ds.ParquetFileFormat().make_write_options(compression="zstd")
+MERGE_ORDER = [("Transaction Amount", "descending")]  # merged partitions keep the crawl's page order
+MAX_ROWS_PER_GROUP = 128 * 1024
+MIN_ROWS_PER_GROUP = 16 * 1024
+
+
+# -----------------------------
+# Writing
+# -----------------------------
+def fiscal_year(action_dates):
+    """Federal fiscal year (October start) of each `Action Date`; 0 when missing."""
+    if not pa.types.is_date(action_dates.type):
+        action_dates = pc.cast(pc.strptime(action_dates, format="%Y-%m-%d", unit="s"), pa.date32())
+    years = pc.add(pc.year(action_dates), pc.cast(pc.greater_equal(pc.month(action_dates), 10), pa.int64()))
+    return pc.fill_null(pc.cast(years, pa.int32()), 0)
+
+
+def with_partition_columns(table, naics):
+    table = table.append_column("naics", pa.array([naics] * table.num_rows, pa.string()))
+    return table.append_column("fiscal_year", fiscal_year(table["Action Date"]))
+
+
+def write_partitions(tables, directory):
+    """Write tables (already carrying naics / fiscal_year) under `directory`. Returns rows written."""
+    tables = iter(tables)
+    first = next(tables, None)
+    if first is None:
+        return 0
+    rows = 0
+
+    def batches():
+        nonlocal rows
+        for table in itertools.chain([first], tables):
+            rows += table.num_rows
+            yield from table.to_batches()
+
+    ds.write_dataset(
+        batches(), directory, schema=first.schema, format="parquet", file_options=WRITE_OPTIONS,
+        partitioning=PARTITIONING,
+        basename_template="part-{i}.parquet", existing_data_behavior="overwrite_or_ignore",
+        preserve_order=True, max_rows_per_group=MAX_ROWS_PER_GROUP, min_rows_per_group=MIN_ROWS_PER_GROUP,
+    )
+    return rows
+
+
+def replace_directory(new, old):
+    """Swap a freshly written directory into place, so readers never see a half-written one."""
+    if old.exists():
+        trash = old.with_name(old.name + ".old")
+        shutil.rmtree(trash, ignore_errors=True)
+        os.replace(old, trash)
+        os.replace(new, old)
+        shutil.rmtree(trash)
+    else:
+        old.parent.mkdir(parents=True, exist_ok=True)
+        os.replace(new, old)
+
+
+def write_code(naics, tables, root=DATASET_DIR):
+    """
+    Replace every partition of one NAICS code with `tables`, an iterable of
+    pyarrow Tables in the order they should be stored. Returns rows written.
+    """
+    staging = root / f"_writing_naics={naics}"
+    shutil.rmtree(staging, ignore_errors=True)
+    rows = write_partitions((with_partition_columns(t, naics) for t in tables), staging)
+    if rows:
+        replace_directory(staging / f"naics={naics}", root / f"naics={naics}")
+        write_metadata(root)
+    shutil.rmtree(staging, ignore_errors=True)
+    return rows
+
+
+def merge_code(naics, delta, key, root=DATASET_DIR):
+    """
+    Merge a table of freshly fetched records into one NAICS code, keeping the
+    newest copy of each transaction. Only the fiscal-year partitions the new
+    records fall in are rewritten, sorted by MERGE_ORDER like a full crawl.
+    Returns the number of rows added.
+    """
+    delta = with_partition_columns(delta, naics)
+    added = 0
+    for year in pc.unique(delta["fiscal_year"]).to_pylist():
+        new_rows = delta.filter(pc.equal(delta["fiscal_year"], year))
+        directory = root / f"naics={naics}" / f"fiscal_year={year}"
+        if directory.exists():
+            existing = with_partition_columns(pq.read_table(directory, schema=SCHEMA), naics)
+            existing_rows = existing.num_rows
+            new_rows = drop_duplicates(pa.concat_tables([existing, new_rows]), key)
+        else:
+            existing_rows = 0
+        new_rows = new_rows.take(pc.sort_indices(new_rows, sort_keys=MERGE_ORDER))  # stable, so ties keep their order
+
+        staging = root / f"_writing_naics={naics}"
+        shutil.rmtree(staging, ignore_errors=True)
+        write_partitions([new_rows], staging)
+        replace_directory(staging / f"naics={naics}" / f"fiscal_year={year}", directory)
+        shutil.rmtree(staging, ignore_errors=True)
+        added += new_rows.num_rows - existing_rows
+    write_metadata(root)
+    return added
+
+
+def drop_duplicates(table, key):
+    """
+    Keep the last row of each `key`, in their original order. Rows with a
+    null in `key` are all kept: rows stored by an older version may lack
+    `generated_internal_id`, and grouping their nulls together would keep
+    one row per `Mod`.
+    """
+    rows = pa.array(np.arange(table.num_rows))
+    keyed = table.select(key).append_column("row", rows)
+    complete = functools.reduce(pc.and_, [pc.is_valid(keyed[column]) for column in key])
+    last = keyed.filter(complete).group_by(key, use_threads=False).aggregate([("row", "max")])["row_max"]
+    unkeyed = keyed.filter(pc.invert(complete))["row"]
+    return table.take(np.sort(np.concatenate([last.to_numpy(), unkeyed.to_numpy()])))
+
+
+def write_metadata(root=DATASET_DIR):
+    (root / METADATA_NAME).write_text(json.dumps({"version": DATASET_VERSION}))
+
+
+# -----------------------------
+# Reading
+# -----------------------------
+def dataset_version(root=DATASET_DIR):
+    path = root / METADATA_NAME
+    return json.loads(path.read_text()).get("version") if path.exists() else None
+
+
+def dataset_exists(root=DATASET_DIR):
+    return dataset_version(root) == DATASET_VERSION
+
+
+def last_modified(root=DATASET_DIR):
+    """When the dataset was last written (every write rewrites its metadata file), in ns; None if there is none."""
+    path = root / METADATA_NAME
+    return path.stat().st_mtime_ns if path.exists() else None
+
+
+def open_dataset(root=DATASET_DIR, legacy_dir=None):
+    """
+    The partitioned dataset as a pyarrow Dataset. The default dataset is
+    built from the legacy one-file-per-code parquet files the first time,
+    if that is all there is; a dataset written by an older version is
+    upgraded in place, keeping whatever was crawled or merged into it.
+    """
+    if legacy_dir is None and root == DATASET_DIR:
+        legacy_dir = LEGACY_DIR
+    if naics_codes(root):
+        if not dataset_exists(root):
+            upgrade(root)
+    elif legacy_dir and list(Path(legacy_dir).glob("naics_*.parquet")):
+        migrate_legacy(legacy_dir, root)
+    if not root.exists():
+        raise FileNotFoundError(f"No dataset found in {root}")
+    return ds.dataset(root, format="parquet", partitioning=PARTITIONING)
+
+
+def partition_filter(naics=None, fiscal_year=None, filter=None):
+    """Combine partition values (a value or a list of values) with any other filter expression."""
+    expressions = [filter] if filter is not None else []
+    for name, value in (("naics", naics), ("fiscal_year", fiscal_year)):
+        if value is None:
+            continue
+        values = value if isinstance(value, (list, tuple, set)) else [value]
+        expressions.append(ds.field(name).isin(list(values)))
+    if not expressions:
+        return None
+    combined = expressions[0]
+    for expression in expressions[1:]:
+        combined = combined & expression
+    return combined
+
+
+def scan(columns=None, naics=None, fiscal_year=None, filter=None, root=DATASET_DIR):
+    """
+    Read only the requested columns and rows as a pyarrow Table, e.g.
+    scan(naics="336411", fiscal_year=2024, filter=ds.field("pop_state_code") == "VA").
+    """
+    dataset = open_dataset(root)
+    return dataset.to_table(columns=columns, filter=partition_filter(naics, fiscal_year, filter))
+
+
+def load(columns=None, naics=None, fiscal_year=None, filter=None, root=DATASET_DIR):
+    """Same as scan(), as a pandas DataFrame."""
+    return scan(columns, naics, fiscal_year, filter, root).to_pandas()
+
+
+def batches(columns=None, naics=None, fiscal_year=None, filter=None, root=DATASET_DIR):
+    """Same as scan(), as an iterator of record batches, for reads that need not fit in memory."""
+    return streaming.batches(open_dataset(root), columns, partition_filter(naics, fiscal_year, filter))
+
+
+def naics_codes(root=DATASET_DIR):
+    return sorted(p.name.split("=", 1)[1] for p in root.glob("naics=*") if p.is_dir())
+
+
+def max_action_date(naics, root=DATASET_DIR):
+    """Latest `Action Date` stored for a NAICS code, or None. Only reads its newest fiscal year."""
+    directory = root / f"naics={naics}"
+    years = sorted(int(p.name.split("=", 1)[1]) for p in directory.glob("fiscal_year=*"))
+    if not years:
+        return None
+    dates = pq.read_table(directory / f"fiscal_year={years[-1]}", columns=["Action Date"])["Action Date"]
+    latest = pc.max(dates).as_py()
+    return str(latest)[:10] if latest is not None else None
+
+
+# -----------------------------
+# Migration
+# -----------------------------
+def upgrade(root=DATASET_DIR):
+    """Rewrite every partition of an older dataset version through normalize(), one NAICS code at a time."""
+    codes = naics_codes(root)
+    print(f"Upgrading dataset in {root} to version {DATASET_VERSION} ({len(codes)} NAICS codes)...")
+    for naics in codes:
+        files = sorted((root / f"naics={naics}").glob("fiscal_year=*/*.parquet"))
+
+        def tables(files=files):
+            for file in files:
+                parquet_file = pq.ParquetFile(file)
+                for i in range(parquet_file.num_row_groups):
+                    yield normalize(parquet_file.read_row_group(i))
+
+        rows = write_code(naics, tables(), root)
+        print(f"  NAICS {naics}: {rows} rows")
+    write_metadata(root)
+
+
+def migrate_legacy(legacy_dir=LEGACY_DIR, root=DATASET_DIR):
+    """Rewrite naics_<code>.parquet files into the partitioned dataset."""
+    files = sorted(Path(legacy_dir).glob("naics_*.parquet"))
+    print(f"Building partitioned dataset in {root} from {len(files)} files in {legacy_dir}...")
+    root.mkdir(parents=True, exist_ok=True)
+    for file in files:
+        naics = file.stem.split("_", 1)[1]
+        parquet_file = pq.ParquetFile(file)
+        tables = (normalize(parquet_file.read_row_group(i)) for i in range(parquet_file.num_row_groups))
+        rows = write_code(naics, tables, root)
+        print(f"  NAICS {naics}: {rows} rows")
+    write_metadata(root)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build the partitioned USAspending dataset")
+    parser.add_argument("--legacy-dir", type=Path, default=LEGACY_DIR)
+    parser.add_argument("--root", type=Path, default=DATASET_DIR)
+    args = parser.parse_args()
+    migrate_legacy(args.legacy_dir, args.root)
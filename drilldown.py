@@ -0,0 +1,80 @@
+import threading
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+
+import aggregates
+import dataset
+import streaming
+
+# Per-state top-K lists behind the map's state panel. One streaming scan of
+# the dataset folds every record batch into running (state, value) totals,
+# and only the K largest values per state are kept, by transaction count and
+# by dollars. A click on a state is then a dictionary lookup.
+TOP_K = 5
+DRILLDOWNS = {  # name: (state column, value column)
+    "pop_cities": ("pop_state_code", "pop_city_name"),
+    "recipient_cities": ("recipient_location_state_code", "recipient_location_city_name"),
+    "recipients": ("recipient_location_state_code", "Recipient Name"),
+}
+
+
+def top_per_state(totals, measure, k):
+    """{state: [(value, total), ...]} holding the k largest totals of each state."""
+    order = pc.sort_indices(totals, sort_keys=[("state", "ascending"), (measure, "descending")])
+    ranked = totals.take(order)
+    states = ranked["state"].to_numpy(zero_copy_only=False)
+    if not len(states):
+        return {}
+    starts = np.flatnonzero(np.r_[True, states[1:] != states[:-1]])
+    group = np.cumsum(np.r_[True, states[1:] != states[:-1]]) - 1
+    keep = np.flatnonzero(np.arange(len(states)) - starts[group] < k)
+    top = {}
+    kept = ranked.take(keep)
+    for state, value, total in zip(kept["state"].to_pylist(), kept["value"].to_pylist(), kept[measure].to_pylist()):
+        top.setdefault(state, []).append((value, total))
+    return top
+
+
+class TopK:
+    """
+    The TOP_K cities and recipients of every state, for each DRILLDOWNS
+    list and each measure: top(name, state, measure) -> [(value, total)].
+    """
+
+    def __init__(self, root=dataset.DATASET_DIR, k=TOP_K):
+        columns = sorted({column for pair in DRILLDOWNS.values() for column in pair} | {aggregates.AMOUNT_COLUMN})
+        totals = {name: streaming.GroupTotals(pair, sums=[aggregates.AMOUNT_COLUMN])
+                  for name, pair in DRILLDOWNS.items()}
+        streaming.fold(streaming.batches(dataset.open_dataset(root), columns), *totals.values())
+
+        self.lists = {}
+        for name, (state_column, value_column) in DRILLDOWNS.items():
+            grouped = totals[name].result()
+            grouped = grouped.filter(pc.and_(pc.is_valid(grouped[state_column]), pc.is_valid(grouped[value_column])))
+            table = pa.table({"state": grouped[state_column], "value": grouped[value_column],
+                              "count": grouped["count"], "amount": grouped[aggregates.AMOUNT_COLUMN]})
+            self.lists[name] = {measure: top_per_state(table, measure, k) for measure in aggregates.MEASURES}
+
+    @classmethod
+    def from_lists(cls, lists):
+        """A TopK serving `lists` saved from another one, without scanning the dataset."""
+        top_k = cls.__new__(cls)
+        top_k.lists = lists
+        return top_k
+
+    def top(self, name, state, measure="count"):
+        return self.lists[name][measure].get(state, [])
+
+
+_indexes = {}
+_lock = threading.Lock()
+
+
+def get_top_k(root=dataset.DATASET_DIR):
+    """The TopK index for `root`, built on first use and shared afterwards."""
+    with _lock:
+        if str(root) not in _indexes:
+            _indexes[str(root)] = TopK(root)
+        return _indexes[str(root)]
@@ -0,0 +1,130 @@
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from retry import RetryPolicy
+
+# Page sizes the crawler may use. Each size divides the next, so a crawl that
+# has fetched N records at one size can always continue at a smaller size, and
+# at a larger size once N lines up with it.
+PAGE_SIZES = (100, 500, 1000, 5000)  # the API allows at most 5000
+TARGET_LATENCY = 10.0  # seconds; slower pages stop the page size from growing
+GROW_AFTER = 4  # consecutive fast pages before stepping up a size
+TIMEOUT = 30
+
+
+class AdaptivePageSize:
+    """
+    Picks the page size for the next request.
+
+    Steps up one size after GROW_AFTER consecutive successful pages at the
+    current size that came back under target_latency, and steps down one size
+    after every timeout. Any other error or slow page resets the streak.
+    """
+
+    def __init__(self, sizes=PAGE_SIZES, target_latency=TARGET_LATENCY, grow_after=GROW_AFTER):
+        self.sizes = sizes
+        self.target_latency = target_latency
+        self.grow_after = grow_after
+        self.index = 0
+        self.streak = 0
+        self.lock = threading.Lock()
+
+    @property
+    def current(self):
+        return self.sizes[self.index]
+
+    def limit_for(self, offset):
+        """Largest allowed size that keeps `offset` on a page boundary."""
+        for size in reversed(self.sizes[:self.index + 1]):
+            if offset % size == 0:
+                return size
+        raise ValueError(f"offset {offset} is not a multiple of {self.sizes[0]}")
+
+    def record_success(self, limit, latency):
+        with self.lock:
+            if latency > self.target_latency:
+                self.streak = 0
+            elif limit == self.current:
+                self.streak += 1
+                if self.streak >= self.grow_after and self.index < len(self.sizes) - 1:
+                    self.index += 1
+                    self.streak = 0
+                    print(f"Page size raised to {self.current}")
+
+    def record_error(self, timeout=False):
+        with self.lock:
+            self.streak = 0
+            if timeout and self.index > 0:
+                self.index -= 1
+                print(f"Page size lowered to {self.current} after timeout")
+
+
+class FetchClient:
+    """
+    Keep-alive HTTP client shared by every fetch worker. With a
+    ResponseCache, requests it already holds are answered from disk, pages
+    from any stored pages covering the same records, so a replayed crawl
+    is served whatever page sizes it asks for; the page size then adapts to
+    the latency the records were first fetched with.
+    Network requests go through the RetryPolicy's per-host concurrency
+    limit and circuit breaker. With CrawlMetrics, every request records its
+    wait, latency, size and decode time under the `labels` it was sent with.
+    """
+
+    def __init__(self, base_url, pool_size=10, timeout=TIMEOUT, page_size=None, cache=None, retry=None,
+                 metrics=None):
+        self.base_url = base_url
+        self.timeout = timeout
+        self.page_size = page_size or AdaptivePageSize()
+        self.cache = cache
+        self.retry = retry or RetryPolicy(max_concurrency=pool_size)
+        self.metrics = metrics
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def post(self, payload, url=None, throttle=None, labels=None):
+        """POST `payload` and return the decoded JSON. `throttle` is called only before going to the network."""
+        url = url or self.base_url
+        limit = payload.get("limit", 0)
+        labels = labels or {}
+        if self.cache is not None:
+            cached = self.cache.get(url, payload)
+            if cached is not None:
+                self.page_size.record_success(limit, cached.latency)
+                if self.metrics:
+                    self.metrics.count("cache_hits", **labels)
+                return cached.data
+        queued = time.monotonic()
+        with self.retry.slot(url):
+            if throttle is not None:
+                throttle()
+            started = time.monotonic()
+            try:
+                response = self.session.post(url, json=payload, timeout=self.timeout)
+                received = time.monotonic()
+                response.raise_for_status()
+                data = response.json()
+                if self.metrics:
+                    self.metrics.observe("queue_seconds", started - queued, **labels)
+                    self.metrics.observe("request_seconds", received - started, **labels)
+                    self.metrics.observe("decode_seconds", time.monotonic() - received, **labels)
+                    self.metrics.count("response_bytes", len(response.content), **labels)
+            except requests.exceptions.Timeout:
+                self.page_size.record_error(timeout=True)
+                raise
+            except Exception:
+                self.page_size.record_error()
+                raise
+        latency = time.monotonic() - started
+        self.page_size.record_success(limit, latency)
+        if self.cache is not None:
+            self.cache.put(url, payload, data, latency)
+        return data
+
+    def close(self):
+        self.session.close()
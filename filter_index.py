@@ -0,0 +1,141 @@
+import threading
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+
+import aggregates
+import dataset
+
+# In-memory columnar index behind the map's live filters. Every transaction
+# is held as a few small typed numpy columns (state positions, the amount and
+# the `Action Date` as days) with all rows sorted by date, plus one packed
+# bitmap per value of each filter dimension. A date range is a contiguous
+# slice found by binary search, each other filter is an OR of the bitmaps of
+# its selected values, and the per-state totals are a np.bincount over the
+# rows left after ANDing the filters together.
+DIMENSIONS = {"naics": "naics", "agencies": aggregates.AGENCY_COLUMN, "award_types": aggregates.AWARD_TYPE_COLUMN}
+DATE_COLUMN = "Action Date"
+NO_DATE = np.iinfo(np.int32).min  # rows without a date sort first and never match a date range
+
+
+class Encoder:
+    """Assigns stable integer codes to the values of one dimension, batch by batch."""
+
+    def __init__(self):
+        self.labels = []
+        self.codes = {}
+
+    def code(self, value):
+        if value not in self.codes:
+            self.codes[value] = len(self.labels)
+            self.labels.append(value)
+        return self.codes[value]
+
+    def encode(self, values):
+        if not pa.types.is_dictionary(values.type):
+            values = pc.dictionary_encode(values)
+        mapping = np.array([self.code(v) for v in values.dictionary.to_pylist()] + [self.code(None)], np.int32)
+        return mapping[pc.fill_null(values.indices, len(values.dictionary)).to_numpy()]
+
+
+def to_day(value):
+    """Days since the epoch of an ISO date string or date."""
+    return int(np.datetime64(value, "D").astype(np.int64))
+
+
+class FilterIndex:
+    """
+    Every transaction of the dataset, indexed for filtering. select() takes
+    any combination of NAICS codes, awarding agencies, award types and an
+    inclusive `Action Date` range, and returns per-state totals shaped like
+    Cube.select().
+    """
+
+    def __init__(self, states, root=dataset.DATASET_DIR):
+        self.states = list(states)
+        encoders = {name: Encoder() for name in DIMENSIONS}
+        pieces = {name: [] for name in ["dates", "amounts", *aggregates.STATE_COLUMNS, *DIMENSIONS]}
+        columns = [*aggregates.STATE_COLUMNS, *DIMENSIONS.values(), DATE_COLUMN, aggregates.AMOUNT_COLUMN]
+        for batch in dataset.open_dataset(root).to_batches(columns=columns):
+            days = pc.cast(batch.column(DATE_COLUMN), pa.int32())
+            pieces["dates"].append(pc.fill_null(days, NO_DATE).to_numpy())
+            pieces["amounts"].append(pc.fill_null(batch.column(aggregates.AMOUNT_COLUMN), 0.0).to_numpy())
+            for column in aggregates.STATE_COLUMNS:
+                pieces[column].append(aggregates.state_positions(batch.column(column), self.states).astype(np.int16))
+            for name, column in DIMENSIONS.items():
+                pieces[name].append(encoders[name].encode(batch.column(column)).astype(np.int16))
+
+        def combined(name, dtype):
+            return np.concatenate(pieces[name]) if pieces[name] else np.empty(0, dtype)
+
+        dates = combined("dates", np.int32)
+        order = np.argsort(dates, kind="stable")
+        self.dates = dates[order]
+        self.amounts = combined("amounts", np.float64)[order]
+        self.positions = [combined(column, np.int16)[order] for column in aggregates.STATE_COLUMNS]
+        self.labels = {name: encoders[name].labels for name in DIMENSIONS}
+        self.bitmaps = {}
+        for name in DIMENSIONS:
+            codes = combined(name, np.int16)[order]
+            self.bitmaps[name] = [np.packbits(codes == code) for code in range(len(self.labels[name]))]
+        self.totals = {measure: self.select(measure) for measure in aggregates.MEASURES}
+
+    def __len__(self):
+        return len(self.dates)
+
+    def date_range(self, start=None, end=None):
+        """Slice of rows whose `Action Date` is within [start, end]."""
+        if not start and not end:
+            return slice(0, len(self.dates))
+        lo = np.searchsorted(self.dates, to_day(start) if start else NO_DATE + 1, "left")
+        hi = np.searchsorted(self.dates, to_day(end), "right") if end else len(self.dates)
+        return slice(lo, max(lo, hi))
+
+    def mask(self, rows, **filters):
+        """Boolean mask over `rows` for the dimension filters given (None means no filter)."""
+        first, last = rows.start // 8, -(-rows.stop // 8)
+        packed = None
+        for name, wanted in filters.items():
+            if wanted is None:
+                continue
+            wanted = set(wanted)
+            selected = np.zeros(last - first, np.uint8)
+            for label, bitmap in zip(self.labels[name], self.bitmaps[name]):
+                if label in wanted:
+                    selected |= bitmap[first:last]
+            packed = selected if packed is None else packed & selected
+        if packed is None:
+            return None
+        offset = rows.start - first * 8
+        return np.unpackbits(packed)[offset:offset + rows.stop - rows.start].view(bool)
+
+    def select(self, measure="count", naics=None, agencies=None, award_types=None, start=None, end=None):
+        if measure not in aggregates.MEASURES:
+            raise ValueError(f"measure must be one of {aggregates.MEASURES}, not {measure!r}")
+        if (naics, agencies, award_types, start, end) == (None,) * 5 and hasattr(self, "totals"):
+            return self.totals[measure]
+        rows = self.date_range(start, end)
+        mask = self.mask(rows, naics=naics, agencies=agencies, award_types=award_types)
+        weights = self.amounts[rows] if measure == "amount" else None
+        if mask is not None and weights is not None:
+            weights = weights[mask]
+        size = len(self.states)
+        totals = np.zeros((size, 2), dtype=np.int64 if measure == "count" else np.float64)
+        for role, positions in enumerate(self.positions):
+            positions = positions[rows] if mask is None else positions[rows][mask]
+            totals[:, role] = np.bincount(positions, weights=weights, minlength=size + 1)[:size]
+        return totals
+
+
+_indexes = {}
+_lock = threading.Lock()
+
+
+def get_index(states, root=dataset.DATASET_DIR):
+    """The FilterIndex for `root`, built on first use and shared afterwards."""
+    key = (tuple(states), str(root))
+    with _lock:
+        if key not in _indexes:
+            _indexes[key] = FilterIndex(states, root)
+        return _indexes[key]
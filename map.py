@@ -1,22 +1,33 @@
-import dash
-from dash import dcc, html
-from dash.dependencies import Input, Output
-import plotly.express as px
-import numpy as np
-import pandas as pd
-from pathlib import Path
+import argparse
+import gc
+import importlib
+import json
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from functools import lru_cache
+from typing import NamedTuple, Optional
+
+# Importing this module loads nothing but the standard library: dash, plotly,
+# numpy and the data modules (which pull in pyarrow) are imported where they
+# are used, and the per-state data is loaded by create_app(). A snapshot of
+# that data (the aggregate cube and the drilldown top-K lists) is kept next
+# to the dataset, so startup reads one small file instead of scanning the
+# dataset; it is rebuilt whenever the dataset has been written since.
+SNAPSHOT_NAME = "_map_snapshot.npz"
 
 
 # -----------------------------
 # Define State class
 # -----------------------------
-class State:
-    def __init__(self, code, red=0, green=0, center=None):
-        self.code = code
-        self.red = red
-        self.green = green
-        self.center = center  # dict: {"lat": ..., "lon": ...}
-        self.is_selected = False
+class State(NamedTuple):
+    """One state's totals. Immutable: selection lives in the user's session, not here."""
+    code: str
+    red: float = 0
+    green: float = 0
+    center: Optional[dict] = None  # dict: {"lat": ..., "lon": ...}
 
     @property
     def combined(self):
@@ -53,205 +64,437 @@ state_centers = {
     "WA":{"lat":47.5,"lon":-120.5}, "WV":{"lat":38.5,"lon":-80.5},
     "WI":{"lat":44.5,"lon":-89.5}, "WY":{"lat":43.0,"lon":-107.5}
 }
-PARQUET_DIR = Path("usa_spending_defense")
 US_STATES = [x for x in state_centers.keys()]
 
 
-def aggregate_state_counts_dict():
-    # Initialize dictionary with each state
-    state_counts = {state: [0,0] for state in US_STATES}
+METRICS = {"count": "Contracts", "amount": "Dollars", "awards": "Awards"}  # "awards" counts each award once
 
-    for file in PARQUET_DIR.glob("*.parquet"):
-        df = pd.read_parquet(file)
 
-        # Primary Place of Performance
-        if "pop_state_code" in df.columns:
-            pop_vals = df["pop_state_code"].dropna()
-            pop_counts_file = pop_vals.value_counts()
-            for state, count in pop_counts_file.items():
-                if state in state_counts:
-                    state_counts[state][0] += int(count)
+def read_only(values):
+    import numpy as np
 
-        # Recipient Location
-        if "recipient_location_state_code" in df.columns:
-            rec_vals = df["recipient_location_state_code"].dropna()
-            rec_counts_file = rec_vals.value_counts()
-            for state, count in rec_counts_file.items():
-                if state in state_counts:
-                    state_counts[state][1] += int(count)
-    return state_counts
+    values = np.array(values)
+    values.flags.writeable = False
+    return values
+
+
+class StateStore:
+    """
+    Per-state totals for one metric and filter combination, held as
+    read-only numpy arrays aligned with US_STATES. Stores are cached and
+    shared by every request and thread, so nothing in one is ever modified.
+    """
+    __slots__ = ("codes", "red", "green", "combined")
+
+    def __init__(self, totals):
+        import aggregates
+
+        self.codes = tuple(US_STATES)
+        self.red = read_only(totals[:, aggregates.RECIPIENT])
+        self.green = read_only(totals[:, aggregates.POP])
+        self.combined = read_only(self.green - self.red)
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __getitem__(self, code):
+        i = self.codes.index(code)
+        return State(code, self.red[i].item(), self.green[i].item(), state_centers[code])
+
+    def __iter__(self):
+        return (self[code] for code in self.codes)
+
+    def values(self, value_type):
+        """Values for "red", "green" or "combined_value"; None for the plain white map."""
+        return {"red": self.red, "green": self.green, "combined_value": self.combined}.get(value_type)
+
+    def top(self, value_type, n=5, largest=True):
+        """The n States with the largest (or smallest) values, ties in US_STATES order."""
+        import numpy as np
+
+        values = self.values(value_type)
+        order = np.argsort(-values if largest else values, kind="stable")[:n]
+        return [self[self.codes[i]] for i in order]
+
+
+def state_totals(metric, naics=None, agencies=None, award_types=None, start=None, end=None):
+    """
+    Per-state totals for the current filters. The cube answers NAICS and
+    agency filters on its own; award types and date ranges need the
+    in-memory filter index, which is built the first time it is used.
+    Award counts come from the award table instead.
+    """
+    import awards
+    import filter_index
+
+    naics, agencies, award_types = (values or None for values in (naics, agencies, award_types))
+    if metric == "awards":
+        return awards.state_counts(get_awards(), US_STATES, naics, agencies, award_types, start, end)
+    if award_types is None and start is None and end is None:
+        return get_cube().select(metric, naics=naics, agencies=agencies)
+    index = filter_index.get_index(US_STATES)
+    return index.select(metric, naics=naics, agencies=agencies, award_types=award_types, start=start, end=end)
+
+
+@lru_cache(maxsize=64)
+def state_store(metric, naics=(), agencies=(), award_types=(), start=None, end=None):
+    """The shared StateStore for a metric and filter combination (filters as tuples)."""
+    return StateStore(state_totals(metric, list(naics), list(agencies), list(award_types), start, end))
+
+
+def format_value(value, metric):
+    if metric == "amount":
+        return f"{'-' if value < 0 else ''}${abs(value):,.0f}"
+    return f"{value}"
+
+
+DRILLDOWN_TITLES = {
+    "pop_cities": "Top Cities (Performance)",
+    "recipient_cities": "Top Cities (Recipients)",
+    "recipients": "Top Recipients",
+}
+
+
+def drilldown_panel(code, metric):
+    """Top cities and recipients of one state, from the precomputed per-state top-K lists."""
+    from dash import html
+
+    import aggregates
+
+    children = []
+    if metric not in aggregates.MEASURES:
+        return children  # the top-K lists rank transactions and dollars only
+    for name, title in DRILLDOWN_TITLES.items():
+        rows = get_top_k().top(name, code, metric)
+        children.append(html.H5(title, style={"margin": "8px 0 2px"}))
+        children.append(html.Ol([html.Li(f"{value}: {format_value(total, metric)}") for value, total in rows])
+                        if rows else html.P("None"))
+    return children
 
 
 # -----------------------------
 # Initialize States
 # -----------------------------
-states_dict = {}
-colors = aggregate_state_counts_dict()
-for code, center in state_centers.items():
-    red = colors[code][1]
-    green = colors[code][0]
-    states_dict[code] = State(
-        code=code,
-        red=red,
-        green=green,
-        center=center
-    )
+cube = None  # aggregates.Cube: counts and dollars per (state, NAICS, agency, year), sliced per request
+top_k = None  # drilldown.TopK read from the snapshot; None until then
+award_table = None  # the award table's state and filter columns, read on first use
+_data_lock = threading.Lock()
 
-# -----------------------------
-# Dash App Setup
-# -----------------------------
-app = dash.Dash(__name__)
 
-app.layout = html.Div([
-    html.H1("Interactive US Contracts Map", style={"margin": "0", "padding": "6px 0"}),
+def snapshot_path():
+    import dataset
 
-    html.Div([
-        html.Button("Show Completed (Red)", id="btn-red", n_clicks=0),
-        html.Button("Show Offered (Green)", id="btn-green", n_clicks=0),
-        html.Button("Show Combined", id="btn-redgreen", n_clicks=0),
-        html.Button("Reset White", id="btn-white", n_clicks=0),
-    ], style={"marginBottom": "6px"}),
+    return dataset.DATASET_DIR / SNAPSHOT_NAME
 
-    dcc.Graph(id="us-map", style={"width": "100vw", "height": "calc(100vh - 80px)"}),
 
-    html.Div(
-        id="top-states",
-        style={
-            "position": "absolute",
-            "top": "90px",
-            "right": "20px",
-            "backgroundColor": "white",
-            "padding": "12px",
-            "border": "1px solid #ccc",
-            "borderRadius": "6px",
-            "width": "260px",
-            "fontFamily": "Arial",
-            "fontSize": "14px"
-        }
-    ),
+def read_snapshot(path=None):
+    """(cube, top_k) saved by write_snapshot(), or None if there is none or the dataset has changed since."""
+    import numpy as np
 
-    html.Div(
-        id="state-info",
-        style={
-            "position": "absolute",
-            "top": "250px",
-            "right": "20px",
-            "backgroundColor": "white",
-            "padding": "12px",
-            "border": "1px solid #ccc",
-            "borderRadius": "6px",
-            "width": "260px",
-            "fontFamily": "Arial",
-            "fontSize": "14px",
-            "display": "none"  # start hidden
-        }
-    )
+    import aggregates
+    import dataset
+    import drilldown
+
+    path = path or snapshot_path()
+    if not path.exists():
+        return None
+    with np.load(path) as data:
+        meta = json.loads(str(data["meta"]))
+        if meta["modified"] != dataset.last_modified() or meta["states"] != US_STATES:
+            return None
+        snapshot_cube = aggregates.Cube(meta["states"], meta["naics"], meta["agencies"], meta["years"],
+                                        data["counts"], data["amounts"], meta["award_types"])
+    return snapshot_cube, drilldown.TopK.from_lists(meta["top_k"])
+
+
+def write_snapshot(path=None):
+    """Save the cube and the drilldown top-K lists for the next startup."""
+    import numpy as np
+
+    import aggregates
+    import dataset
+    import drilldown
+
+    path = path or snapshot_path()
+    modified = dataset.last_modified()  # taken first: a write during the build leaves the snapshot stale, not wrong
+    snapshot_cube = aggregates.load_cube(US_STATES)
+    meta = {"modified": modified, "states": snapshot_cube.states, "naics": snapshot_cube.naics,
+            "agencies": snapshot_cube.agencies, "years": snapshot_cube.years,
+            "award_types": snapshot_cube.award_types, "top_k": drilldown.get_top_k().lists}
+    with tempfile.NamedTemporaryFile(dir=path.parent, prefix=path.name + ".", suffix=".tmp", delete=False) as f:
+        np.savez(f, counts=snapshot_cube.counts, amounts=snapshot_cube.amounts, meta=np.array(json.dumps(meta)))
+    os.replace(f.name, path)
+    return path
+
+
+def load_data(snapshot=True):
+    """Load the cube (and the top-K lists) from the snapshot, or else from the dataset. Returns the source."""
+    global cube, top_k
+    import aggregates
+
+    with _data_lock:
+        loaded = read_snapshot() if snapshot else None
+        if loaded:
+            cube, top_k = loaded
+            return "snapshot"
+        cube = aggregates.load_cube(US_STATES)
+        return "dataset"
 
-])
+
+def get_cube():
+    if cube is None:
+        load_data()
+    return cube
+
+
+def get_awards():
+    """The award table (see awards.py), refreshed if the dataset changed and then kept in memory."""
+    global award_table
+    import aggregates
+    import awards
+
+    with _data_lock:
+        if award_table is None:
+            award_table = awards.load(columns=[*aggregates.STATE_COLUMNS, "naics", aggregates.AGENCY_COLUMN,
+                                               aggregates.AWARD_TYPE_COLUMN, "first_action_date",
+                                               "last_action_date"])
+        return award_table
+
+
+def get_top_k():
+    """The per-state top-K lists: the snapshot's, or else built from the dataset on first use."""
+    import drilldown
+
+    return top_k or drilldown.get_top_k()
+
+
+FILTER_STYLE = {"display": "inline-block", "width": "220px", "marginRight": "6px", "verticalAlign": "middle"}
+
+
+# -----------------------------
+# Dash App Setup
+# -----------------------------
+def layout(cube):
+    from dash import dcc, html
+
+    years = [year for year in cube.years if year]  # fiscal year 0 holds the rows without an action date
+    return html.Div([
+        html.H1("Interactive US Contracts Map", style={"margin": "0", "padding": "6px 0"}),
+
+        html.Div([
+            html.Button("Show Completed (Red)", id="btn-red", n_clicks=0),
+            html.Button("Show Offered (Green)", id="btn-green", n_clicks=0),
+            html.Button("Show Combined", id="btn-redgreen", n_clicks=0),
+            html.Button("Reset White", id="btn-white", n_clicks=0),
+            dcc.RadioItems(
+                id="metric",
+                options=[{"label": label, "value": metric} for metric, label in METRICS.items()],
+                value="count",
+                inline=True,
+                style={"display": "inline-block", "marginLeft": "12px"}
+            ),
+        ], style={"marginBottom": "6px"}),
+
+        html.Div([
+            dcc.Dropdown(id="filter-naics", options=cube.naics, multi=True, placeholder="NAICS",
+                         style=FILTER_STYLE),
+            dcc.Dropdown(id="filter-agency", options=[a for a in cube.agencies if a], multi=True,
+                         placeholder="Awarding agency", style=FILTER_STYLE),
+            dcc.Dropdown(id="filter-award-type", options=[t for t in cube.award_types if t], multi=True,
+                         placeholder="Award type", style=FILTER_STYLE),
+            dcc.DatePickerRange(
+                id="filter-dates",
+                min_date_allowed=f"{years[0] - 1}-10-01" if years else None,
+                max_date_allowed=f"{years[-1]}-09-30" if years else None,
+                clearable=True,
+                start_date_placeholder_text="From",
+                end_date_placeholder_text="To"
+            ),
+        ], style={"marginBottom": "6px"}),
+
+        # Per-session client state: which gradient / figure is showing and which state is selected
+        dcc.Store(id="view", storage_type="session"),
+        dcc.Store(id="selected-state", storage_type="session"),
+
+        dcc.Graph(id="us-map", style={"width": "100vw", "height": "calc(100vh - 130px)"}),
+
+        html.Div(
+            id="top-states",
+            style={
+                "position": "absolute",
+                "top": "140px",
+                "right": "20px",
+                "backgroundColor": "white",
+                "padding": "12px",
+                "border": "1px solid #ccc",
+                "borderRadius": "6px",
+                "width": "260px",
+                "fontFamily": "Arial",
+                "fontSize": "14px"
+            }
+        ),
+
+        html.Div(
+            id="state-info",
+            style={
+                "position": "absolute",
+                "top": "300px",
+                "right": "20px",
+                "backgroundColor": "white",
+                "padding": "12px",
+                "border": "1px solid #ccc",
+                "borderRadius": "6px",
+                "width": "260px",
+                "fontFamily": "Arial",
+                "fontSize": "14px",
+                "display": "none"  # start hidden
+            }
+        )
+
+    ])
 
 
 # -----------------------------
 # Choropleth creator
 # -----------------------------
-def create_fig(states_list, value_type="red", color_scale="Reds"):
+WHITE_SCALE = [[0, "white"], [1, "white"]]
+FIGURE_CACHE_SIZE = 64
+BUTTONS = ("btn-red", "btn-green", "btn-redgreen", "btn-white")
+FILTER_INPUTS = ("metric", "filter-naics", "filter-agency", "filter-award-type", "filter-dates")
+
+
+def selection_style(states, selected=None):
+    """Outline colors, outline widths and geo view for the selected state, if any."""
+    line_colors = ["black"] * len(states)
+    line_widths = [1.5] * len(states)
+    if selected in states.codes:
+        idx = states.codes.index(selected)
+        line_colors[idx] = "yellow"  # highlight color
+        line_widths[idx] = 4
+
+    # If a state is selected, center on it
+    if selected in state_centers:
+        geo = {"center": state_centers[selected], "projection_scale": 2.5}
+    else:
+        geo = {"center": {"lat": 36, "lon": -96}, "projection_scale": 0.8}
+    return line_colors, line_widths, geo
+
+
+def create_fig(states, value_type="red", color_scale="Reds", selected=None):
     """
-    states_list: list of State objects
+    states: StateStore
     value_type: "red", "green", or "combined_value"
     color_scale: Plotly color scale or custom [[0,color1],[1,color2]]
+    selected: code of the state to highlight and zoom to, if any
     """
+    import plotly.graph_objects as go
 
-    # Extract codes and values based on value_type
-    codes = [s.code for s in states_list]
+    values = states.values(value_type)
+    values = values.tolist() if values is not None else [1] * len(states)  # default white map
 
-    if value_type == "red":
-        values = [s.red for s in states_list]
-    elif value_type == "green":
-        values = [s.green for s in states_list]
-    elif value_type == "combined_value":
-        values = [s.combined for s in states_list]
-    else:
-        values = [1] * len(states_list)  # default white map
+    line_colors, line_widths, geo = selection_style(states, selected)
+    fig = go.Figure(go.Choropleth(
+        locations=list(states.codes),
+        z=values,
+        locationmode="USA-states",
+        colorscale=color_scale,
+        showscale=False,
+        marker_line_color=line_colors,
+        marker_line_width=line_widths,
+        hovertemplate="%{location}<br>Intensity=%{z}<extra></extra>"
+    ))
+    fig.update_geos(scope="usa", **geo)
+    fig.update_layout(margin={"l": 0, "r": 0, "t": 0, "b": 0})
 
-    # Create DataFrame for Plotly
-    df = pd.DataFrame({"state": codes, "value": values})
+    return fig
 
-    fig = px.choropleth(
-        df,
-        locations="state",
-        locationmode="USA-states",
-        color="value",
-        scope="usa",
-        color_continuous_scale=color_scale,
-        labels={"value": "Intensity"}
-    )
 
-    # Highlight selected state(s)
-    line_colors = ["black"] * len(codes)
-    line_widths = [1.5] * len(codes)
-    for idx, s in enumerate(states_list):
-        if getattr(s, "is_selected", False):
-            line_colors[idx] = "yellow"  # highlight color
-            line_widths[idx] = 4
+def selection_patch(states, selected=None):
+    """Partial update that moves the highlight and zoom of a figure already on screen."""
+    import dash
 
-    fig.update_traces(marker_line_color=line_colors, marker_line_width=line_widths, showscale=False)
+    line_colors, line_widths, geo = selection_style(states, selected)
+    patch = dash.Patch()
+    patch["data"][0]["marker"]["line"]["color"] = line_colors
+    patch["data"][0]["marker"]["line"]["width"] = line_widths
+    patch["layout"]["geo"]["center"] = geo["center"]
+    patch["layout"]["geo"]["projection"]["scale"] = geo["projection_scale"]
+    return patch
 
-    # Optional: adjust zoom / center
-    # If a state is selected, center on it
-    selected_states = [s for s in states_list if getattr(s, "is_selected", False)]
-    if selected_states and selected_states[0].center:
-        center = selected_states[0].center
-        fig.update_geos(center=center, projection_scale=2.5)
-    else:
-        fig.update_geos(center={"lat": 36, "lon": -96}, projection_scale=0.8)
 
-    fig.update_layout(margin={"l": 0, "r": 0, "t": 0, "b": 0})
+class FigureCache:
+    """Least-recently-used cache of serialized base figures (no state selected)."""
+
+    def __init__(self, size=FIGURE_CACHE_SIZE):
+        self.size = size
+        self.figures = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, build):
+        with self.lock:
+            if key in self.figures:
+                self.figures.move_to_end(key)
+                return self.figures[key]
+        figure = build()
+        with self.lock:
+            self.figures[key] = figure
+            while len(self.figures) > self.size:
+                self.figures.popitem(last=False)
+        return figure
+
+
+figure_cache = FigureCache()
+
+
+def base_figure(states, value_type, color_scale, filters):
+    """(key, figure) for a metric / color scale / filter combination, built once and then cached."""
+    key = json.dumps([value_type, color_scale, *filters])
+    return key, figure_cache.get(key, lambda: create_fig(states, value_type, color_scale).to_plotly_json())
 
-    return fig
 
 # -----------------------------
 # Callback
 # -----------------------------
-@app.callback(
-    Output("us-map", "figure"),
-    Output("top-states", "children"),
-    Output("state-info", "children"),
-    Output("state-info", "style"),
-    Input("btn-red", "n_clicks"),
-    Input("btn-green", "n_clicks"),
-    Input("btn-redgreen", "n_clicks"),
-    Input("btn-white", "n_clicks"),
-    Input("us-map", "clickData")
-)
-def update_map(n_red, n_green, n_redgreen, n_white, clickData):
+def update_map(n_red, n_green, n_redgreen, n_white, clickData, metric, naics, agencies, award_types,
+               start_date, end_date, shown, selected):
+    import dash
+    from dash import html
+
     ctx = dash.callback_context
     last_trigger = ctx.triggered[-1]["prop_id"].split(".")[0] if ctx.triggered else None
+    metric = metric or "count"
+    filters = [metric, sorted(naics or []), sorted(agencies or []), sorted(award_types or []), start_date, end_date]
+    states = state_store(metric, *(tuple(values) for values in filters[1:4]), start_date, end_date)
+    view, shown_figure = (shown or {}).get("view"), (shown or {}).get("figure")
 
-    # -----------------------
-    # Reset selection & info panel by default
-    # -----------------------
-    for s in states_dict.values():
-        s.is_selected = False
+    # A click selects a state and a button clears the selection. Switching
+    # metric or filters keeps the selection, or else redraws the gradient.
+    if last_trigger == "us-map" and clickData:
+        selected = clickData["points"][0]["location"]
+    elif last_trigger in BUTTONS:
+        view, selected = last_trigger, None
+    elif last_trigger in FILTER_INPUTS and not selected:
+        last_trigger = view
 
     info_panel = html.Div()
     info_style = {"display": "none"}
 
     # -----------------------
-    # State click takes precedence
+    # Selected state takes precedence
     # -----------------------
-    if last_trigger == "us-map" and clickData:
-        selected_code = clickData["points"][0]["location"]
-        states_dict[selected_code].is_selected = True
-        state_obj = states_dict[selected_code]
+    if selected in state_centers:
+        state_obj = states[selected]
 
         info_panel = html.Div([
             html.H4(f"State: {state_obj.code}"),
-            html.P(f"Awarded Contracts: {state_obj.red}"),
-            html.P(f"Offered Contracts: {state_obj.green}"),
-            html.P(f"Combined: {state_obj.combined}")
+            html.P(f"Awarded {METRICS[metric]}: {format_value(state_obj.red, metric)}"),
+            html.P(f"Offered {METRICS[metric]}: {format_value(state_obj.green, metric)}"),
+            html.P(f"Combined: {format_value(state_obj.combined, metric)}"),
+            *drilldown_panel(state_obj.code, metric)
         ])
         info_style = {
             "position": "absolute",
-            "top": "250px",
+            "top": "300px",
             "right": "20px",
             "backgroundColor": "white",
             "padding": "12px",
@@ -260,88 +503,199 @@ def update_map(n_red, n_green, n_redgreen, n_white, clickData):
             "width": "260px",
             "fontFamily": "Arial",
             "fontSize": "14px",
+            "maxHeight": "calc(100vh - 320px)",
+            "overflowY": "auto",
             "display": "block"
         }
 
+        # Only the outline and zoom change when a click lands on the white map already showing. After a
+        # reload the session stores survive but the graph starts empty, so anything else gets a full figure.
+        key, _ = base_figure(states, "red", WHITE_SCALE, filters)
+        if last_trigger == "us-map" and key == shown_figure:
+            figure = selection_patch(states, selected)
+        else:
+            figure = create_fig(states, "red", WHITE_SCALE, selected)
         return (
-            create_fig(list(states_dict.values()), "red", [[0, "white"], [1, "white"]]),
+            figure,
             html.Div(f"Selected state: {state_obj.code}"),  # rankings panel placeholder
             info_panel,
-            info_style
+            info_style,
+            {"view": view, "figure": key},
+            selected
         )
 
     # -----------------------
     # Reset / White button
     # -----------------------
     if last_trigger == "btn-white":
+        key, figure = base_figure(states, "red", WHITE_SCALE, filters)
         return (
-            create_fig(list(states_dict.values()), "red", [[0, "white"], [1, "white"]]),
+            figure,
             html.Div("No rankings (white map)"),
             info_panel,
-            info_style
+            info_style,
+            {"view": view, "figure": key},
+            None
         )
 
     # -----------------------
     # Gradient buttons
     # -----------------------
     if last_trigger == "btn-green":
-        top5 = sorted(states_dict.values(), key=lambda s: s.green, reverse=True)[:5]
+        top5 = states.top("green")
         panel = html.Div([
             html.H4("Top 5 Green States"),
-            html.Ol([html.Li(f"{s.code}: {s.green}") for s in top5])
+            html.Ol([html.Li(f"{s.code}: {format_value(s.green, metric)}") for s in top5])
         ])
-        return create_fig(list(states_dict.values()), "green", "Greens"), panel, info_panel, info_style
+        key, figure = base_figure(states, "green", "Greens", filters)
+        return figure, panel, info_panel, info_style, {"view": view, "figure": key}, None
 
     if last_trigger == "btn-red":
-        top5 = sorted(states_dict.values(), key=lambda s: s.red, reverse=True)[:5]
+        top5 = states.top("red")
         panel = html.Div([
             html.H4("Top 5 Red States"),
-            html.Ol([html.Li(f"{s.code}: {s.red}") for s in top5])
+            html.Ol([html.Li(f"{s.code}: {format_value(s.red, metric)}") for s in top5])
         ])
-        return create_fig(list(states_dict.values()), "red", "Reds"), panel, info_panel, info_style
+        key, figure = base_figure(states, "red", "Reds", filters)
+        return figure, panel, info_panel, info_style, {"view": view, "figure": key}, None
 
     if last_trigger == "btn-redgreen":
-        for s in states_dict.values():
-            s.combined_value = s.combined
-
-        top5_green = sorted(states_dict.values(), key=lambda s: s.combined_value, reverse=True)[:5]
-        top5_red = sorted(states_dict.values(), key=lambda s: s.combined_value)[:5]
+        top5_green = states.top("combined_value")
+        top5_red = states.top("combined_value", largest=False)
 
         panel = html.Div([
             html.H4("Most Extreme"),
             html.Div([
                 html.H5("🟢 More Offered"),
-                html.Ol([html.Li(f"{s.code}: +{s.combined_value}") for s in top5_green])
+                html.Ol([html.Li(f"{s.code}: +{format_value(s.combined, metric)}") for s in top5_green])
             ], style={"marginBottom": "10px"}),
             html.Div([
                 html.H5("🔴 More Completed"),
-                html.Ol([html.Li(f"{s.code}: {s.combined_value}") for s in top5_red])
+                html.Ol([html.Li(f"{s.code}: {format_value(s.combined, metric)}") for s in top5_red])
             ])
         ])
 
-        # combined_norm = [(s.combined - min([s.combined for s in states_dict.values()])) /
-        #                  (max([s.combined for s in states_dict.values()]) -
-        #                   min([s.combined for s in states_dict.values()])) for s in states_dict.values()]
-
-        return create_fig(list(states_dict.values()), "combined_value", [[0,"red"], [0.5,"white"], [1,"green"]]), panel, info_panel, info_style
+        key, figure = base_figure(states, "combined_value", [[0,"red"], [0.5,"white"], [1,"green"]], filters)
+        return figure, panel, info_panel, info_style, {"view": view, "figure": key}, None
 
     # -----------------------
     # Fallback
     # -----------------------
+    key, figure = base_figure(states, "red", WHITE_SCALE, filters)
     return (
-        create_fig(list(states_dict.values()), "red", [[0, "white"], [1, "white"]]),
+        figure,
         html.Div("Click a gradient button or state to see rankings"),
         info_panel,
-        info_style
+        info_style,
+        {"view": view, "figure": key},
+        None
     )
 
+def register_callbacks(app):
+    import dash
+    from dash.dependencies import Input, Output
+
+    app.callback(
+        Output("us-map", "figure"),
+        Output("top-states", "children"),
+        Output("state-info", "children"),
+        Output("state-info", "style"),
+        Output("view", "data"),
+        Output("selected-state", "data"),
+        Input("btn-red", "n_clicks"),
+        Input("btn-green", "n_clicks"),
+        Input("btn-redgreen", "n_clicks"),
+        Input("btn-white", "n_clicks"),
+        Input("us-map", "clickData"),
+        Input("metric", "value"),
+        Input("filter-naics", "value"),
+        Input("filter-agency", "value"),
+        Input("filter-award-type", "value"),
+        Input("filter-dates", "start_date"),
+        Input("filter-dates", "end_date"),
+        dash.State("view", "data"),
+        dash.State("selected-state", "data")
+    )(update_map)
+
+
 # -----------------------------
-# Run app
+# App factory
 # -----------------------------
+def create_app(snapshot=True, warm=True):
+    """
+    The Dash app, with its data loaded from the snapshot if it is current
+    (or from the dataset otherwise). With `warm`, the filter index and the
+    drilldown lists are then built in a background thread (see warm_up())
+    and, if the snapshot was not current, it is rewritten for the next start.
+    The time spent on each step is printed and kept in `app.startup`.
+    """
+    started = time.perf_counter()
+    dash = importlib.import_module("dash")
+    for name in ("aggregates", "drilldown"):  # loading the data would import them (and pyarrow) anyway; time it here
+        importlib.import_module(name)
+    imported = time.perf_counter()
+    source = load_data(snapshot)
+    loaded = time.perf_counter()
+
+    app = dash.Dash(__name__)
+    app.layout = layout(cube)
+    register_callbacks(app)
+    ready = time.perf_counter()
+
+    if warm:
+        threading.Thread(target=warm_up, kwargs={"snapshot": source != "snapshot"}, daemon=True).start()
+    app.startup = {"imports_seconds": imported - started, "data_seconds": loaded - imported,
+                   "app_seconds": ready - loaded, "data_source": source}
+    print(f"Map ready in {ready - started:.2f}s: imports {imported - started:.2f}s, "
+          f"data {loaded - imported:.2f}s from the {source}, app {ready - loaded:.2f}s")
+    return app
+
+
+def warm_up(snapshot=False):
+    """
+    Build the in-memory filter index (award type and date filters), the
+    per-state top cities / recipients and the award table, so the first
+    filtered request, state click and award count find them ready; with
+    `snapshot`, also rewrite it.
+    """
+    import filter_index
+
+    filter_index.get_index(US_STATES)
+    get_top_k()
+    get_awards()
+    if snapshot:
+        write_snapshot()
+
+
+def create_server(snapshot=True):
+    """
+    WSGI entry point for pre-forking servers, loaded once in the master:
+    gunicorn --preload --workers 4 --threads 8 'map:create_server()'
+    The filter index and drilldown lists are built here too, in the
+    foreground since a thread would not survive the fork, so the workers
+    start in milliseconds and share all of it copy-on-write. Write the
+    snapshot first (python map.py --snapshot) to load the drilldown lists
+    instead of scanning the dataset for them.
+    """
+    app = create_app(snapshot, warm=False)
+    started = time.perf_counter()
+    warm_up()
+    app.startup["warm_up_seconds"] = time.perf_counter() - started
+    print(f"Filter index and drilldown lists ready in {app.startup['warm_up_seconds']:.2f}s")
+    gc.freeze()  # keep the workers' garbage collections from touching, and so copying, the preloaded objects
+    return app.server
+
+
 if __name__ == "__main__":
-    app.run(debug=True)
+    parser = argparse.ArgumentParser(description="Interactive map of contracts per state")
+    parser.add_argument("--snapshot", action="store_true",
+                        help="rebuild the startup snapshot from the dataset and exit")
+    parser.add_argument("--no-snapshot", action="store_true", help="load the data from the dataset")
+    args = parser.parse_args()
+
+    if args.snapshot:
+        print(f"Snapshot written to {write_snapshot()}")
+    else:
+        create_app(snapshot=not args.no_snapshot).run(debug=True, threaded=True)
 
-#TODO: add top 3 most completed and awarded for each state
-#TODO: add gradient on only selected state
-#TODO: add live data filters
-#TODO: add top cities when a state is selected
\ No newline at end of file
+#TODO: add gradient on only selected state
\ No newline at end of file
@@ -0,0 +1,154 @@
+import bisect
+import json
+import threading
+from pathlib import Path
+
+# Instrumentation for the crawl. Every measurement is a named counter or
+# histogram with labels (the NAICS code, the endpoint, ...), kept in memory
+# for the whole run and written out at the end as a JSON run report and/or a
+# Prometheus text file (for node_exporter's textfile collector or a push).
+# Histograms use fixed log-spaced buckets, four per doubling from 1 ms to
+# about two minutes, so percentiles are accurate to a few percent whatever
+# the run length, and runs can be merged bucket by bucket.
+PREFIX = "usaspending_crawl_"
+BUCKETS = tuple(0.001 * 2 ** (i / 4) for i in range(69))  # seconds, 1 ms .. ~155 s
+EXPORT_EVERY = 4  # Prometheus gets one `le` per doubling
+QUANTILES = (0.5, 0.95, 0.99)
+
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)  # the last bucket is everything above BUCKETS[-1]
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def quantile(self, q):
+        """Estimated q-quantile, interpolated within its bucket."""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            if n and seen + n >= rank:
+                lower = BUCKETS[i - 1] if i else 0.0
+                upper = BUCKETS[i] if i < len(BUCKETS) else self.max
+                return min(self.max, lower + (upper - lower) * (rank - seen) / n)
+            seen += n
+        return self.max
+
+    def summary(self):
+        return {"count": self.count, "sum": self.sum, "max": self.max,
+                **{f"p{round(q * 100)}": self.quantile(q) for q in QUANTILES}}
+
+
+def label_key(labels):
+    return tuple(sorted((name, str(value)) for name, value in labels.items() if value is not None))
+
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_labels(key, **extra):
+    pairs = list(key) + list(extra.items())
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{escape(value)}"' for name, value in pairs) + "}"
+
+
+class CrawlMetrics:
+    """
+    Thread-safe counters and histograms for one crawl:
+    metrics.count("retries", naics="336411", reason="HTTP 429") and
+    metrics.observe("request_seconds", 0.42, naics="336411").
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}  # name -> {label key: value}
+        self.histograms = {}  # name -> {label key: Histogram}
+
+    def count(self, name, value=1, **labels):
+        key = label_key(labels)
+        with self.lock:
+            series = self.counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = label_key(labels)
+        with self.lock:
+            self.histograms.setdefault(name, {}).setdefault(key, Histogram()).observe(value)
+
+    def total(self, name, **labels):
+        """Sum of a counter over every series whose labels include `labels`."""
+        wanted = set(label_key(labels))
+        with self.lock:
+            return sum(value for key, value in self.counters.get(name, {}).items() if wanted <= set(key))
+
+    def combined(self, name, **labels):
+        """One Histogram merging every series of `name` whose labels include `labels`."""
+        wanted = set(label_key(labels))
+        merged = Histogram()
+        with self.lock:
+            for key, histogram in self.histograms.get(name, {}).items():
+                if wanted <= set(key):
+                    merged.counts = [a + b for a, b in zip(merged.counts, histogram.counts)]
+                    merged.count += histogram.count
+                    merged.sum += histogram.sum
+                    merged.max = max(merged.max, histogram.max)
+        return merged
+
+    def label_values(self, label):
+        with self.lock:
+            keys = [key for series in (*self.counters.values(), *self.histograms.values()) for key in series]
+        return sorted({value for key in keys for name, value in key if name == label})
+
+    # -----------------------------
+    # Export
+    # -----------------------------
+    def report(self, **extra):
+        """Every series as plain JSON-ready data, plus `extra` top-level fields."""
+        with self.lock:
+            counters = {name: [{"labels": dict(key), "value": value} for key, value in sorted(series.items())]
+                        for name, series in sorted(self.counters.items())}
+            histograms = {name: [{"labels": dict(key), **histogram.summary()}
+                                 for key, histogram in sorted(series.items())]
+                          for name, series in sorted(self.histograms.items())}
+        return {**extra, "counters": counters, "histograms": histograms}
+
+    def prometheus(self):
+        """The metrics in the Prometheus text exposition format."""
+        lines = []
+        with self.lock:
+            for name, series in sorted(self.counters.items()):
+                lines.append(f"# TYPE {PREFIX}{name}_total counter")
+                lines += [f"{PREFIX}{name}_total{format_labels(key)} {value}" for key, value in sorted(series.items())]
+            for name, series in sorted(self.histograms.items()):
+                lines.append(f"# TYPE {PREFIX}{name} histogram")
+                for key, histogram in sorted(series.items()):
+                    cumulative = 0
+                    for i, n in enumerate(histogram.counts[:-1]):
+                        cumulative += n
+                        if i % EXPORT_EVERY == 0:
+                            lines.append(f"{PREFIX}{name}_bucket{format_labels(key, le=f'{BUCKETS[i]:g}')} {cumulative}")
+                    lines.append(f"{PREFIX}{name}_bucket{format_labels(key, le='+Inf')} {histogram.count}")
+                    lines.append(f"{PREFIX}{name}_sum{format_labels(key)} {histogram.sum}")
+                    lines.append(f"{PREFIX}{name}_count{format_labels(key)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+    def write(self, path, **extra):
+        """Write the report to `path`: Prometheus text for *.prom, JSON otherwise."""
+        path = Path(path)
+        tmp = path.with_name(path.name + ".tmp")
+        if path.suffix == ".prom":
+            tmp.write_text(self.prometheus())
+        else:
+            tmp.write_text(json.dumps(self.report(**extra), indent=2))
+        tmp.replace(path)
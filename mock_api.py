@@ -0,0 +1,235 @@
+import argparse
+import json
+import random
+import tempfile
+import threading
+import time
+from datetime import date, timedelta
+from functools import lru_cache
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from pathlib import Path
+
+# Local stand-in for the USAspending spending_by_transaction endpoint, so the
+# crawler can be exercised and tuned without touching the real API.
+ENDPOINT = "/api/v2/search/spending_by_transaction/"
+COUNT_ENDPOINT = "/api/v2/search/spending_by_transaction_count/"
+
+RECORDS_PER_CODE = 2000
+LATENCY = 0.05  # seconds added to every response
+LATENCY_PER_RECORD = 0.00002  # extra seconds per requested record, so big pages cost more
+STALL = 35.0  # seconds added to stalled pages: past the crawler's 30s request timeout
+
+STATES = ["CA", "TX", "VA", "FL", "WA", "AZ", "CT", "MA", "AL", "GA", "OH", "PA", "MD", "CO", "NY"]
+AGENCIES = ["Department of Defense", "National Aeronautics and Space Administration",
+            "Department of Homeland Security", "Department of Energy"]
+AWARD_TYPES = ["DELIVERY ORDER", "DEFINITIVE CONTRACT", "PURCHASE ORDER", "BPA CALL"]
+
+
+@lru_cache(maxsize=None)
+def generate_records(naics, n_records):
+    """Deterministic synthetic transactions for one NAICS code, sorted by amount desc."""
+    rng = random.Random(int(naics))
+    start = date(2007, 10, 1)
+    span = (date(2025, 12, 31) - start).days
+    records = []
+    for i in range(n_records):
+        award = f"MOCK{naics}{i // 8:06d}"
+        pop_state = rng.choice(STATES)
+        rec_state = rng.choice(STATES)
+        records.append({
+            "internal_id": int(naics) * 1_000_000 + i,
+            "Award ID": award,
+            "Mod": f"P{i % 8:05d}",
+            "Recipient Name": f"MOCK RECIPIENT {rng.randint(1, 200)}",
+            "Recipient UEI": f"UEI{rng.randint(1, 200):09d}",
+            "Recipient Location": {"city_name": f"{rec_state} CITY", "state_code": rec_state,
+                                   "country_name": "UNITED STATES", "location_country_code": "USA"},
+            "Primary Place of Performance": {"city_name": f"{pop_state} CITY", "state_code": pop_state,
+                                             "country_name": "UNITED STATES", "location_country_code": "USA"},
+            "Action Date": (start + timedelta(days=rng.randrange(span))).isoformat(),
+            "Transaction Amount": round(rng.lognormvariate(12, 2), 2),
+            "Transaction Description": "MOCK TRANSACTION",
+            "Awarding Agency": rng.choice(AGENCIES),
+            "Awarding Sub Agency": "MOCK SUB AGENCY",
+            "Award Type": rng.choice(AWARD_TYPES),
+            "NAICS": {"code": naics, "description": "MOCK NAICS"},
+            "PSC": {"code": "1510", "description": "MOCK PSC"},
+            "pop_state_code": pop_state,
+            "recipient_location_state_code": rec_state,
+            "pop_city_name": f"{pop_state} CITY",
+            "recipient_location_city_name": f"{rec_state} CITY",
+            "Funding Agency": "Department of Defense",
+            "generated_internal_id": f"CONT_AWD_{award}_9700_-NONE-_-NONE-",
+        })
+    records.sort(key=lambda r: r["Transaction Amount"], reverse=True)
+    return tuple(records)
+
+
+def matching_records(filters, records_per_code=RECORDS_PER_CODE):
+    records = []
+    for naics in filters.get("naics_codes", []):
+        records.extend(generate_records(naics, records_per_code))
+    if len(filters.get("naics_codes", [])) > 1:
+        records.sort(key=lambda r: r["Transaction Amount"], reverse=True)
+    for period in filters.get("time_period", []):
+        records = [r for r in records if period["start_date"] <= r["Action Date"] <= period["end_date"]]
+    return records
+
+
+def count(payload, records_per_code=RECORDS_PER_CODE):
+    return {"results": {"contracts": len(matching_records(payload.get("filters", {}), records_per_code))}}
+
+
+def search(payload, records_per_code=RECORDS_PER_CODE):
+    records = matching_records(payload.get("filters", {}), records_per_code)
+    page, limit = int(payload.get("page", 1)), int(payload.get("limit", 10))
+    start = (page - 1) * limit
+    results = records[start:start + limit]
+    fields = payload.get("fields")
+    if fields:
+        keep = set(fields) | {"internal_id", "generated_internal_id"}
+        results = [{k: v for k, v in r.items() if k in keep} for r in results]
+    return {
+        "limit": limit,
+        "results": results,
+        "page_metadata": {"page": page, "hasNext": start + limit < len(records)},
+    }
+
+
+def past_end(payload, records_per_code=RECORDS_PER_CODE):
+    """Whether a search page starts beyond the last matching record."""
+    start = (int(payload.get("page", 1)) - 1) * int(payload.get("limit", 10))
+    return start >= len(matching_records(payload.get("filters", {}), records_per_code))
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        path = self.path.rstrip("/")
+        if path not in (ENDPOINT.rstrip("/"), COUNT_ENDPOINT.rstrip("/")):
+            self.send_error(404)
+            return
+        payload = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+        server = self.server
+        if server.past_end_status and path == ENDPOINT.rstrip("/") and past_end(payload, server.records_per_code):
+            self.send_fault(server.past_end_status)  # at once, so it lands before slower in-range pages
+            return
+        with server.lock:
+            server.in_flight += 1
+            overloaded = server.max_in_flight and server.in_flight > server.max_in_flight
+        try:
+            if overloaded:
+                self.send_fault(429, Retry_After=f"{server.retry_after:g}")
+                return
+            if server.error_rate and random.random() < server.error_rate:
+                self.send_fault(503)
+                return
+            limit = int(payload.get("limit", 0))
+            stall = server.stall if server.stall_above and limit > server.stall_above else 0.0
+            time.sleep(server.latency + server.latency_per_record * limit + stall)
+        finally:
+            with server.lock:
+                server.in_flight -= 1
+        handler = count if path == COUNT_ENDPOINT.rstrip("/") else search
+        body = json.dumps(handler(payload, server.records_per_code)).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_fault(self, status, **headers):
+        with self.server.lock:
+            self.server.faults += 1
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name.replace("_", "-"), value)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass  # keep the crawl output readable
+
+
+def start_server(port=0, latency=LATENCY, records_per_code=RECORDS_PER_CODE,
+                 latency_per_record=LATENCY_PER_RECORD, max_in_flight=None, error_rate=0.0, retry_after=1.0,
+                 past_end_status=None, stall_above=None, stall=STALL):
+    """
+    Serve the mock endpoint on a background thread. Returns (server, url).
+    Like the real API under load, it answers 429 with a Retry-After when
+    more than `max_in_flight` requests are being served at once, and 503 to
+    a random `error_rate` fraction of requests. With `past_end_status` (e.g.
+    400), pages starting past the last record are answered with that status
+    instead of an empty page. `server.faults` counts all of them. Pages
+    with a limit above `stall_above` are held `stall` seconds longer, long
+    enough for the client to time out.
+    """
+    server = ThreadingHTTPServer(("127.0.0.1", port), MockHandler)
+    server.daemon_threads = True
+    server.latency = latency
+    server.latency_per_record = latency_per_record
+    server.records_per_code = records_per_code
+    server.max_in_flight = max_in_flight
+    server.error_rate = error_rate
+    server.retry_after = retry_after
+    server.past_end_status = past_end_status
+    server.stall_above = stall_above
+    server.stall = stall
+    server.in_flight = 0
+    server.faults = 0
+    server.lock = threading.Lock()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}{ENDPOINT}"
+
+
+def sweep(concurrency_levels, naics_codes, latency=LATENCY, records_per_code=RECORDS_PER_CODE, rate=1000.0,
+          max_in_flight=None, error_rate=0.0, past_end_status=None, stall_above=None):
+    """Crawl the mock once per concurrency level and print throughput for each."""
+    from usaspending import crawl
+
+    server, url = start_server(latency=latency, records_per_code=records_per_code, max_in_flight=max_in_flight,
+                               error_rate=error_rate, past_end_status=past_end_status, stall_above=stall_above)
+    results = {}
+    try:
+        for concurrency in concurrency_levels:
+            with tempfile.TemporaryDirectory() as tmp:
+                stats = crawl(naics_codes, concurrency=concurrency, rate=rate, base_url=url,
+                              output_dir=Path(tmp))
+            results[concurrency] = stats
+    finally:
+        server.shutdown()
+
+    print("\nconcurrency  pages/sec  records/sec")
+    for concurrency, stats in results.items():
+        elapsed = max(stats.elapsed, 1e-9)
+        print(f"{concurrency:>11}  {stats.pages / elapsed:>9.2f}  {stats.records / elapsed:>11.1f}")
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Mock spending_by_transaction endpoint")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=LATENCY, help="seconds added per response")
+    parser.add_argument("--records-per-code", type=int, default=RECORDS_PER_CODE)
+    parser.add_argument("--sweep", type=int, nargs="+", metavar="CONCURRENCY",
+                        help="crawl the mock at each concurrency level and report throughput")
+    parser.add_argument("--naics", nargs="+", default=["336411", "336413", "336414", "332992"])
+    parser.add_argument("--max-in-flight", type=int, help="answer 429 beyond this many concurrent requests")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of requests answered with 503")
+    parser.add_argument("--past-end-status", type=int, help="answer pages past the last record with this status")
+    parser.add_argument("--stall-above", type=int, metavar="LIMIT",
+                        help="hold pages larger than this long enough for the crawler to time out")
+    args = parser.parse_args()
+
+    if args.sweep:
+        sweep(args.sweep, args.naics, latency=args.latency, records_per_code=args.records_per_code,
+              max_in_flight=args.max_in_flight, error_rate=args.error_rate, past_end_status=args.past_end_status,
+              stall_above=args.stall_above)
+    else:
+        server, url = start_server(args.port, args.latency, args.records_per_code,
+                                   max_in_flight=args.max_in_flight, error_rate=args.error_rate,
+                                   past_end_status=args.past_end_status, stall_above=args.stall_above)
+        print(f"Mock API listening on {url}")
+        try:
+            threading.Event().wait()
+        except KeyboardInterrupt:
+            server.shutdown()
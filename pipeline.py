@@ -0,0 +1,101 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+# Stages of the crawl pipeline. Fetch workers hand finished pages to the
+# crawl loop, which hands full buffers of records to a normalize stage
+# (flatten and type them into an Arrow table), which hands tables to a write
+# stage (append the parquet part). Stages are joined by bounded queues, so a
+# slow stage blocks the one feeding it instead of letting memory grow, and
+# each stage times how long its workers were busy and how long they sat
+# blocked on the next stage. The stage with the highest utilization is the
+# bottleneck; a stage that is often blocked is waiting on the one after it.
+QUEUE_SIZE = 4  # items waiting for a stage, beyond the ones being worked on
+
+
+class StageStats:
+    """Busy and blocked time of one stage's workers."""
+
+    def __init__(self, name, workers):
+        self.name = name
+        self.workers = workers
+        self.items = 0
+        self.busy = 0.0
+        self.blocked = 0.0
+        self.started = time.monotonic()
+        self.lock = threading.Lock()
+
+    def record(self, busy=0.0, blocked=0.0, items=1):
+        with self.lock:
+            self.items += items
+            self.busy += busy
+            self.blocked += blocked
+
+    def utilization(self, elapsed=None):
+        elapsed = elapsed if elapsed is not None else time.monotonic() - self.started
+        return self.busy / max(elapsed * self.workers, 1e-9)
+
+    def summary(self, elapsed=None):
+        return {"workers": self.workers, "items": self.items, "busy_seconds": self.busy,
+                "blocked_seconds": self.blocked, "utilization": self.utilization(elapsed)}
+
+
+class Stage(StageStats):
+    """
+    `workers` threads applying `handle` to the items put() on a bounded
+    queue. Each put() returns a Future; the handler's result completes it,
+    or, with a `downstream` stage, is put on that stage with the same
+    Future. put() blocks while the queue is full.
+    """
+
+    def __init__(self, name, handle, workers=1, capacity=QUEUE_SIZE, downstream=None):
+        super().__init__(name, workers)
+        self.handle = handle
+        self.downstream = downstream
+        self.queue = queue.Queue(capacity)
+        self.threads = [threading.Thread(target=self.run, name=f"{name}-{i}", daemon=True) for i in range(workers)]
+        for thread in self.threads:
+            thread.start()
+
+    def put(self, item, future=None):
+        future = future or Future()
+        self.queue.put((item, future))
+        return future
+
+    def run(self):
+        while True:
+            entry = self.queue.get()
+            if entry is None:
+                return
+            item, future = entry
+            started = time.monotonic()
+            try:
+                result = self.handle(item)
+            except BaseException as e:
+                self.record(busy=time.monotonic() - started)
+                future.set_exception(e)
+                continue
+            handled = time.monotonic()
+            if self.downstream is not None:
+                self.downstream.put(result, future)
+            else:
+                future.set_result(result)
+            self.record(busy=handled - started, blocked=time.monotonic() - handled)
+
+    def close(self):
+        """Finish every queued item, then stop the workers (and the downstream stage's)."""
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        if self.downstream is not None:
+            self.downstream.close()
+
+
+def table(stages, elapsed):
+    lines = [f"{'stage':<10} {'workers':>7} {'items':>6} {'busy s':>8} {'blocked s':>9} {'utilization':>11}"]
+    for stage in stages:
+        lines.append(f"{stage.name:<10} {stage.workers:>7} {stage.items:>6} {stage.busy:>8.2f} {stage.blocked:>9.2f} "
+                     f"{stage.utilization(elapsed):>10.0%}")
+    return "\n".join(lines)
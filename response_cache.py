@@ -0,0 +1,227 @@
+import gzip
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+# Local cache of API responses, keyed by a hash of the URL and canonicalized
+# JSON payload, so re-posting an identical request (same filters and fields)
+# is a gzip read instead of a round trip. Each response is one file,
+# <dir>/<first 2 hex chars>/<sha256>.json.gz, holding the response with the
+# time it was stored and the latency it was fetched with. Paged requests are
+# keyed without their page and limit, by the record range they cover instead
+# (<sha256>.<offset>.<limit>.json.gz), and a request is answered from any
+# stored pages that cover its range, sliced or joined as needed: the page
+# size adapts while a crawl runs, so a replay seldom asks for the same pages
+# the recording did. A hit touches the files' mtimes, so mtime order is
+# least-recently-used order and eviction deletes the oldest files once the
+# cache outgrows max_bytes.
+CACHE_DIR = Path(os.environ.get("USASPENDING_CACHE_DIR", ".response_cache"))
+DEFAULT_TTL = 24 * 3600  # seconds
+MAX_BYTES = 1024 ** 3
+EVICT_TO = 0.9  # eviction stops at this fraction of max_bytes
+
+# off:       no cache
+# readwrite: serve entries younger than the TTL, fetch and store the rest
+# replay:    serve any stored entry however old, fetch and store misses
+# offline:   serve any stored entry, raise CacheMiss for the rest; never fetch
+# refresh:   always fetch, and store the new responses
+MODES = ("off", "readwrite", "replay", "offline", "refresh")
+DEFAULT_MODE = os.environ.get("USASPENDING_CACHE", "readwrite")
+
+
+class CacheMiss(LookupError):
+    """An offline cache has no response for a request."""
+
+
+def cache_key(url, payload):
+    canonical = json.dumps({"url": url, "payload": payload}, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+
+def page_range(payload):
+    """(offset, limit) of the records a paged request asks for, or None if it is not paged."""
+    if "page" not in payload or "limit" not in payload:
+        return None
+    limit = int(payload["limit"])
+    return (int(payload["page"]) - 1) * limit, limit
+
+
+def query_key(url, payload):
+    """cache_key of a paged request without its page and limit, shared by every page of the query."""
+    return cache_key(url, {name: value for name, value in payload.items() if name not in ("page", "limit")})
+
+
+def is_last(data, limit):
+    """Whether a stored page was the query's last: no next page, or fewer records than asked for."""
+    metadata = data.get("page_metadata") or {}
+    if "hasNext" in metadata:
+        return not metadata["hasNext"]
+    return len(data.get("results", [])) < limit
+
+
+class CachedResponse:
+    __slots__ = ("data", "stored", "latency")
+
+    def __init__(self, data, stored, latency):
+        self.data = data
+        self.stored = stored
+        self.latency = latency
+
+
+class ResponseCache:
+    def __init__(self, directory=CACHE_DIR, mode=DEFAULT_MODE, ttl=DEFAULT_TTL, max_bytes=MAX_BYTES):
+        if mode not in MODES:
+            raise ValueError(f"mode must be one of {MODES}, not {mode!r}")
+        self.directory = Path(directory)
+        self.mode = mode
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.size = sum(path.stat().st_size for path in self.files())
+
+    def files(self):
+        return self.directory.glob("*/*.json.gz")
+
+    def path(self, key, records=None):
+        """File of a request's response; `records` is the (offset, limit) of a page, keyed by its query."""
+        if records is None:
+            return self.directory / key[:2] / f"{key}.json.gz"
+        return self.directory / key[:2] / f"{key}.{records[0]}.{records[1]}.json.gz"
+
+    def read(self, path):
+        """The entry stored in `path`, or None if there is none or it has expired."""
+        try:
+            with gzip.open(path, "rt", encoding="utf-8") as f:
+                stored = json.load(f)
+            entry = CachedResponse(stored["response"], stored["stored"], stored.get("latency", 0.0))
+        except FileNotFoundError:
+            return None
+        except (OSError, EOFError, ValueError, KeyError):
+            path.unlink(missing_ok=True)  # truncated or corrupt; fetch it again
+            return None
+        if self.mode == "readwrite" and time.time() - entry.stored > self.ttl:
+            return None
+        return entry
+
+    def read_range(self, key, offset, limit):
+        """
+        The records [offset, offset + limit) of a query, joined from the
+        stored pages that overlap them (and the one just before, which may
+        show the records end first), as (entry, paths); None if a record in
+        the range is neither stored nor known to be past the end.
+        """
+        pages, before = [], None
+        for path in (self.directory / key[:2]).glob(f"{key}.*.json.gz"):
+            start, size = (int(part) for part in path.name.split(".")[1:3])
+            if start < offset + limit and start + size > offset:
+                pages.append((start, size, path))
+            elif start + size <= offset and (before is None or start > before[0]):
+                before = (start, size, path)
+        loaded = []
+        for start, size, path in sorted(pages + ([before] if before else [])):
+            entry = self.read(path)
+            if entry is not None:
+                loaded.append((start, size, path, entry))
+        if not loaded:
+            return None
+        ends = [start + len(entry.data.get("results", [])) for start, size, _, entry in loaded
+                if is_last(entry.data, size)]
+        end = min(ends) if ends else None
+        results, used, position = [], [], offset
+        while position < offset + limit and (end is None or position < end):
+            covering = [(start, path, entry) for start, _, path, entry in loaded
+                        if start <= position < start + len(entry.data.get("results", []))]
+            if not covering:
+                return None
+            start, path, entry = covering[0]
+            taken = entry.data["results"][position - start:offset + limit - start]
+            results.extend(taken)
+            used.append((path, entry))
+            position += len(taken)
+        used = used or [loaded[-1][2:]]  # the range is past the end: the page that showed where it is
+        data = dict(used[0][1].data, limit=limit, results=results)
+        data["page_metadata"] = dict(data.get("page_metadata") or {}, page=offset // limit + 1,
+                                     hasNext=end is None or end > offset + limit)
+        entry = CachedResponse(data, min(e.stored for _, e in used), max(e.latency for _, e in used))
+        return entry, [path for path, _ in used]
+
+    def get(self, url, payload):
+        """
+        The stored response to POSTing `payload` to `url`, or None if it has
+        to be fetched. In offline mode a miss raises CacheMiss instead.
+        """
+        if self.mode in ("off", "refresh"):
+            return None
+        records = page_range(payload)
+        if records is None:
+            paths = [self.path(cache_key(url, payload))]
+            entry = self.read(paths[0])
+        else:
+            found = self.read_range(query_key(url, payload), *records)
+            entry, paths = found or (None, [])
+        with self.lock:
+            if entry is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        if entry is None:
+            if self.mode == "offline":
+                raise CacheMiss(f"No cached response for {url} with payload {json.dumps(payload, sort_keys=True)}")
+            return None
+        for path in paths:
+            try:
+                os.utime(path)  # most recently used
+            except FileNotFoundError:
+                pass  # evicted meanwhile
+        return entry
+
+    def put(self, url, payload, data, latency=0.0):
+        if self.mode in ("off", "offline"):
+            return
+        records = page_range(payload)
+        if records is None:
+            path = self.path(cache_key(url, payload))
+        else:
+            path = self.path(query_key(url, payload), records)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with tempfile.NamedTemporaryFile(dir=path.parent, prefix=path.name + ".", suffix=".tmp", delete=False) as raw:
+            with gzip.open(raw, "wt", encoding="utf-8") as f:
+                json.dump({"url": url, "payload": payload, "stored": time.time(), "latency": latency,
+                           "response": data}, f, separators=(",", ":"))
+        tmp = Path(raw.name)
+        size = tmp.stat().st_size
+        try:
+            replaced = path.stat().st_size
+        except FileNotFoundError:
+            replaced = 0
+        os.replace(tmp, path)
+        with self.lock:
+            self.size += size - replaced
+            if self.size > self.max_bytes:
+                self.evict()
+
+    def evict(self):
+        """Delete least recently used entries until the cache is under EVICT_TO of max_bytes. Caller holds the lock."""
+        entries = []
+        for path in self.files():
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime_ns, stat.st_size, path))
+        entries.sort()
+        self.size = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if self.size <= self.max_bytes * EVICT_TO:
+                break
+            path.unlink(missing_ok=True)
+            self.size -= size
+
+    def summary(self):
+        return f"{self.hits} hits, {self.misses} misses, {self.size / 1024 ** 2:.1f} MB in {self.directory}"
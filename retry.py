@@ -0,0 +1,180 @@
+import email.utils
+import random
+import threading
+import time
+from contextlib import contextmanager
+from urllib.parse import urlsplit
+
+import requests
+
+# Retry policy shared by every fetch worker. Each failed request is sorted
+# into "retry" or "give up"; retryable ones wait a jittered exponential
+# backoff, or as long as the server's Retry-After asks. Per host, the policy
+# also keeps:
+#   - a concurrency limit that halves on every throttling response (429/503)
+#     and creeps back up one slot per `limit` successes, so the crawl settles
+#     at the highest rate the server sustains instead of oscillating;
+#   - a circuit breaker that opens after THRESHOLD consecutive failures, or
+#     on a Retry-After, and holds every worker until the cooldown passes. A
+#     single probe request then decides whether it closes or opens again for
+#     twice as long.
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+THROTTLE_STATUSES = {429, 503}
+MAX_RETRIES = 7
+BACKOFF_BASE = 1.0  # seconds
+BACKOFF_CAP = 60.0
+MAX_RETRY_AFTER = 300.0  # longer Retry-After values are clipped to this
+THRESHOLD = 5  # consecutive failures that open the circuit
+COOLDOWN = 5.0  # first open period; doubles on every reopen up to BACKOFF_CAP
+
+
+def status_of(error):
+    response = getattr(error, "response", None)
+    return response.status_code if response is not None else None
+
+
+def is_retryable(error):
+    """Connection problems, timeouts, unreadable bodies, throttling and 5xx errors are worth retrying."""
+    if isinstance(error, requests.exceptions.HTTPError):
+        return status_of(error) in RETRY_STATUSES
+    return isinstance(error, (requests.exceptions.ConnectionError, requests.exceptions.Timeout,
+                              requests.exceptions.ChunkedEncodingError, requests.exceptions.JSONDecodeError))
+
+
+def retry_after(error):
+    """Seconds the server asked us to wait in a Retry-After header (delta seconds or HTTP date), or None."""
+    response = getattr(error, "response", None)
+    value = response.headers.get("Retry-After") if response is not None else None
+    if not value:
+        return None
+    try:
+        seconds = float(value)
+    except ValueError:
+        try:
+            seconds = email.utils.parsedate_to_datetime(value).timestamp() - time.time()
+        except (TypeError, ValueError):
+            return None
+    return min(max(seconds, 0.0), MAX_RETRY_AFTER)
+
+
+class HostState:
+    """Concurrency limit and circuit breaker for one host, timed by `clock` (seconds, monotonic)."""
+
+    def __init__(self, max_concurrency, clock=time.monotonic):
+        self.max_concurrency = max_concurrency
+        self.clock = clock
+        self.limit = max_concurrency
+        self.in_flight = 0
+        self.successes = 0
+        self.failures = 0  # consecutive
+        self.open_until = 0.0
+        self.cooldown = COOLDOWN
+        self.probing = False
+        self.throttled = 0  # responses that reduced the limit, for reporting
+        self.reduced_at = 0.0
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        """Block until a request may start; returns its start time for release()."""
+        with self.condition:
+            while True:
+                wait = self.open_until - self.clock()
+                if wait > 0:
+                    self.condition.wait(wait)
+                elif self.failures >= THRESHOLD and self.probing:
+                    self.condition.wait()  # half open: one probe at a time
+                elif self.in_flight >= self.limit:
+                    self.condition.wait()
+                else:
+                    break
+            if self.failures >= THRESHOLD:
+                self.probing = True
+            self.in_flight += 1
+            return self.clock()
+
+    def release(self, started, error=None):
+        with self.condition:
+            self.in_flight -= 1
+            if error is not None and is_retryable(error):
+                self.record_failure(error, started)
+            else:
+                self.record_success()  # the server answered, even if it was a 4xx
+            self.condition.notify_all()
+
+    def record_success(self):
+        if self.failures >= THRESHOLD:
+            print("Circuit closed, requests resumed")
+        self.failures = 0
+        self.cooldown = COOLDOWN
+        self.probing = False
+        self.successes += 1
+        if self.successes >= self.limit and self.limit < self.max_concurrency:
+            self.limit += 1
+            self.successes = 0
+
+    def record_failure(self, error, started):
+        now = self.clock()
+        self.failures += 1
+        self.successes = 0
+        # Requests sent before the last cut were throttled at the old limit; halve once per round
+        if status_of(error) in THROTTLE_STATUSES and self.limit > 1 and started >= self.reduced_at:
+            self.limit = max(1, self.limit // 2)
+            self.reduced_at = now
+            self.throttled += 1
+            print(f"Throttled (HTTP {status_of(error)}), concurrency lowered to {self.limit}")
+        delay = retry_after(error)
+        if delay:
+            self.open_until = max(self.open_until, now + delay)
+        if self.failures >= THRESHOLD:
+            if self.probing or self.failures == THRESHOLD:
+                print(f"Circuit open for {self.cooldown:.0f}s after {self.failures} consecutive failures")
+                self.open_until = max(self.open_until, now + self.cooldown)
+                self.cooldown = min(BACKOFF_CAP, self.cooldown * 2)
+            self.probing = False
+
+
+class RetryPolicy:
+    """
+    Which errors to retry, how long to wait before each retry, and the
+    per-host state every request passes through (see slot()). The clock,
+    the sleep between retries and the jitter's random source can be
+    swapped, e.g. for tests.
+    """
+
+    def __init__(self, max_concurrency=4, base=BACKOFF_BASE, cap=BACKOFF_CAP, clock=time.monotonic,
+                 sleep=time.sleep, rng=None):
+        self.max_concurrency = max_concurrency
+        self.base = base
+        self.cap = cap
+        self.clock = clock
+        self.sleep = sleep
+        self.rng = rng or random.Random()
+        self.hosts = {}
+        self.lock = threading.Lock()
+
+    def host(self, url):
+        name = urlsplit(url).netloc
+        with self.lock:
+            if name not in self.hosts:
+                self.hosts[name] = HostState(self.max_concurrency, self.clock)
+            return self.hosts[name]
+
+    @contextmanager
+    def slot(self, url):
+        """Wait for the host's circuit and concurrency limit, then record how the request went."""
+        host = self.host(url)
+        started = host.acquire()
+        try:
+            yield
+        except BaseException as e:
+            host.release(started, e)
+            raise
+        host.release(started)
+
+    def delay(self, error, attempt):
+        """Seconds to wait before retry number `attempt` (from 1) after `error`, or None if it is not retryable."""
+        if not is_retryable(error):
+            return None
+        requested = retry_after(error)
+        jittered = self.rng.uniform(0, min(self.cap, self.base * 2 ** attempt))  # "full jitter"
+        return requested + self.rng.uniform(0, self.base) if requested is not None else jittered
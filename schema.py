@@ -0,0 +1,107 @@
+import pyarrow as pa
+import pyarrow.compute as pc
+
+# Explicit on-disk schema for transactions. Nested location / NAICS / PSC
+# objects from the API are flattened into the flat field names the API itself
+# uses, dates are real dates, and low-cardinality strings are dictionary
+# encoded so they load as pandas categoricals.
+DICT = pa.dictionary(pa.int32(), pa.string())
+
+RECIPIENT_LOCATION = "Recipient Location"
+PLACE_OF_PERFORMANCE = "Primary Place of Performance"
+
+# (column, type, sources tried in order: a top-level column or a (struct, field) pair)
+COLUMNS = [
+    ("Award ID", pa.string(), ["Award ID"]),
+    ("Mod", pa.string(), ["Mod"]),
+    ("generated_internal_id", pa.string(), ["generated_internal_id"]),
+    ("internal_id", pa.int64(), ["internal_id"]),
+    ("Action Date", pa.date32(), ["Action Date"]),
+    ("Transaction Amount", pa.float64(), ["Transaction Amount"]),
+    ("Transaction Description", pa.string(), ["Transaction Description"]),
+    ("Award Type", DICT, ["Award Type"]),
+    ("Awarding Agency", DICT, ["Awarding Agency"]),
+    ("Awarding Sub Agency", DICT, ["Awarding Sub Agency"]),
+    ("Funding Agency", DICT, ["Funding Agency"]),
+    ("naics_code", DICT, ["naics_code", ("NAICS", "code")]),
+    ("naics_description", DICT, ["naics_description", ("NAICS", "description")]),
+    ("product_or_service_code", DICT, ["product_or_service_code", ("PSC", "code")]),
+    ("product_or_service_description", DICT, ["product_or_service_description", ("PSC", "description")]),
+    ("Recipient Name", pa.string(), ["Recipient Name"]),
+    ("Recipient UEI", pa.string(), ["Recipient UEI"]),
+    ("recipient_location_address_line1", pa.string(), [(RECIPIENT_LOCATION, "address_line1")]),
+    ("recipient_location_address_line2", pa.string(), [(RECIPIENT_LOCATION, "address_line2")]),
+    ("recipient_location_address_line3", pa.string(), [(RECIPIENT_LOCATION, "address_line3")]),
+    ("recipient_location_city_name", DICT, ["recipient_location_city_name", (RECIPIENT_LOCATION, "city_name")]),
+    ("recipient_location_county_code", pa.string(), [(RECIPIENT_LOCATION, "county_code")]),
+    ("recipient_location_county_name", DICT, [(RECIPIENT_LOCATION, "county_name")]),
+    ("recipient_location_state_code", DICT,
+     ["recipient_location_state_code", (RECIPIENT_LOCATION, "state_code")]),
+    ("recipient_location_state_name", DICT, [(RECIPIENT_LOCATION, "state_name")]),
+    ("recipient_location_congressional_code", DICT, [(RECIPIENT_LOCATION, "congressional_code")]),
+    ("recipient_location_zip5", pa.string(), [(RECIPIENT_LOCATION, "zip5")]),
+    ("recipient_location_zip4", pa.string(), [(RECIPIENT_LOCATION, "zip4")]),
+    ("recipient_location_country_code", DICT, [(RECIPIENT_LOCATION, "location_country_code")]),
+    ("recipient_location_country_name", DICT, [(RECIPIENT_LOCATION, "country_name")]),
+    ("recipient_location_foreign_province", pa.string(), [(RECIPIENT_LOCATION, "foreign_province")]),
+    ("recipient_location_foreign_postal_code", pa.string(), [(RECIPIENT_LOCATION, "foreign_postal_code")]),
+    ("pop_city_name", DICT, ["pop_city_name", (PLACE_OF_PERFORMANCE, "city_name")]),
+    ("pop_county_code", pa.string(), [(PLACE_OF_PERFORMANCE, "county_code")]),
+    ("pop_county_name", DICT, [(PLACE_OF_PERFORMANCE, "county_name")]),
+    ("pop_state_code", DICT, ["pop_state_code", (PLACE_OF_PERFORMANCE, "state_code")]),
+    ("pop_state_name", DICT, [(PLACE_OF_PERFORMANCE, "state_name")]),
+    ("pop_congressional_code", DICT, [(PLACE_OF_PERFORMANCE, "congressional_code")]),
+    ("pop_zip5", pa.string(), [(PLACE_OF_PERFORMANCE, "zip5")]),
+    ("pop_zip4", pa.string(), [(PLACE_OF_PERFORMANCE, "zip4")]),
+    ("pop_country_code", DICT, [(PLACE_OF_PERFORMANCE, "location_country_code")]),
+    ("pop_country_name", DICT, [(PLACE_OF_PERFORMANCE, "country_name")]),
+]
+
+SCHEMA = pa.schema([(name, type_) for name, type_, _ in COLUMNS])
+
+
+def _source(table, source):
+    if isinstance(source, str):
+        return table[source].combine_chunks() if source in table.column_names else None
+    struct, field = source
+    if struct not in table.column_names:
+        return None
+    column = table[struct].combine_chunks()
+    if not pa.types.is_struct(column.type) or column.type.get_field_index(field) < 0:
+        return None
+    return pc.struct_field(column, field)
+
+
+def _cast(values, type_):
+    if pa.types.is_null(values.type):
+        return pa.nulls(len(values), type_)
+    if pa.types.is_dictionary(type_):
+        if not pa.types.is_dictionary(values.type):
+            values = pc.cast(values, pa.string()).dictionary_encode()
+        return pc.cast(values, type_)
+    if pa.types.is_dictionary(values.type):
+        values = values.dictionary_decode()
+    if pa.types.is_date(type_) and (pa.types.is_string(values.type) or pa.types.is_large_string(values.type)):
+        values = pc.utf8_slice_codeunits(values, 0, 10)  # tolerate full timestamps
+    return pc.cast(values, type_)
+
+
+def normalize(data):
+    """
+    Apply SCHEMA to API records (a list of dicts) or to a pyarrow Table
+    holding them as returned by the API, or as stored by an older version of
+    the dataset (a column already named as in SCHEMA is used first).
+    Returns a pyarrow Table.
+    """
+    table = pa.Table.from_pylist(data) if isinstance(data, list) else data
+    arrays = []
+    for name, type_, sources in COLUMNS:
+        values = None
+        for source in sources if name in sources else [name, *sources]:
+            candidate = _source(table, source)
+            if candidate is None:
+                continue
+            candidate = _cast(candidate, type_)
+            values = candidate if values is None else pc.coalesce(values, candidate)
+        arrays.append(values if values is not None else pa.nulls(table.num_rows, type_))
+    return pa.Table.from_arrays(arrays, schema=SCHEMA)
@@ -0,0 +1,228 @@
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+# Out-of-core aggregation. Parquet is read one record batch at a time and
+# every batch is folded into running aggregates, so memory is bounded by the
+# batch size plus the size of the results, never by the size of the data.
+BATCH_ROWS = 64 * 1024
+COMPACT_ROWS = 256 * 1024  # partial group rows held before they are merged
+
+
+def batches(source, columns=None, filter=None, batch_size=BATCH_ROWS):
+    """Record batches of `columns` from a parquet file or a pyarrow Dataset."""
+    if isinstance(source, ds.Dataset):
+        yield from source.to_batches(columns=columns, filter=filter, batch_size=batch_size)
+    else:
+        yield from pq.ParquetFile(source).iter_batches(batch_size=batch_size, columns=columns)
+
+
+def fold(source_batches, *aggregates):
+    """Feed every batch to every aggregate. Returns the aggregates."""
+    for batch in source_batches:
+        for aggregate in aggregates:
+            aggregate.add(batch)
+    return aggregates
+
+
+def plain(values):
+    """Dictionary-encoded values as plain strings, so partial results from different batches concatenate."""
+    return pc.cast(values, values.type.value_type) if pa.types.is_dictionary(values.type) else values
+
+
+class GroupTotals:
+    """
+    Running row count (and sums of `sums` columns) per distinct `keys`.
+    Each batch is grouped on its own; the small partial results are merged
+    whenever they add up to more than COMPACT_ROWS rows.
+    """
+
+    def __init__(self, keys, sums=()):
+        self.keys = list(keys)
+        self.sums = list(sums)
+        self.partials = []
+        self.rows = 0
+
+    def _group(self, table, count):
+        grouped = table.group_by(self.keys, use_threads=False).aggregate(
+            [count] + [(column, "sum") for column in self.sums])
+        columns = {key: plain(grouped[key]) for key in self.keys}
+        columns["count"] = grouped[f"{count[0]}_sum" if count[0] else "count_all"]
+        for column in self.sums:
+            columns[column] = pc.fill_null(grouped[f"{column}_sum"], 0)
+        return pa.table(columns)
+
+    def add(self, batch):
+        table = pa.Table.from_batches([batch]).select(self.keys + self.sums)
+        grouped = self._group(table, ([], "count_all"))
+        self.partials.append(grouped)
+        self.rows += grouped.num_rows
+        if self.rows > COMPACT_ROWS:
+            self.compact()
+
+    def compact(self):
+        if len(self.partials) > 1:
+            self.partials = [self._group(pa.concat_tables(self.partials), ("count", "sum"))]
+            self.rows = self.partials[0].num_rows
+
+    def result(self):
+        """Table of keys, `count` and one column per summed column."""
+        self.compact()
+        if self.partials:
+            return self.partials[0]
+        return pa.table({**{key: pa.array([], pa.string()) for key in self.keys}, "count": pa.array([], pa.int64()),
+                         **{column: pa.array([], pa.float64()) for column in self.sums}})
+
+
+class ColumnSummary:
+    """Running row, null and min / max counts for every column of the batches seen."""
+
+    def __init__(self):
+        self.rows = 0
+        self.types = {}
+        self.nulls = {}
+        self.minimum = {}
+        self.maximum = {}
+
+    def add(self, batch):
+        self.rows += batch.num_rows
+        for name, values in zip(batch.schema.names, batch.columns):
+            self.types.setdefault(name, values.type)
+            self.nulls[name] = self.nulls.get(name, 0) + values.null_count
+            if pa.types.is_dictionary(values.type) or pa.types.is_nested(values.type):
+                continue
+            bounds = pc.min_max(values)
+            for store, value, better in ((self.minimum, bounds["min"].as_py(), min),
+                                         (self.maximum, bounds["max"].as_py(), max)):
+                if value is not None:
+                    store[name] = value if name not in store else better(store[name], value)
+
+    def non_null(self, name):
+        return self.rows - self.nulls.get(name, 0)
+
+
+# -----------------------------
+# Sketches
+# -----------------------------
+# Fixed-size summaries that are updated batch by batch and merged across
+# files or processes, for the aggregates that would otherwise need every
+# distinct value in memory. Both work on the 64-bit hashes from hash64().
+def mix64(values):
+    """splitmix64 finalizer over a uint64 array: spreads every input bit over every output bit."""
+    with np.errstate(over="ignore"):
+        values = (values ^ (values >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        values = (values ^ (values >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return values ^ (values >> np.uint64(31))
+
+
+_BYTE_WEIGHTS = np.ones(1, np.uint64)
+
+
+def byte_weights(length):
+    """Powers of an odd multiplier, one per byte position, modulo 2**64."""
+    global _BYTE_WEIGHTS
+    if len(_BYTE_WEIGHTS) < length:
+        powers = np.full(max(length, 2 * len(_BYTE_WEIGHTS)), 0x100000001B3, np.uint64)
+        powers[0] = 1
+        with np.errstate(over="ignore"):
+            _BYTE_WEIGHTS = np.multiply.accumulate(powers)
+    return _BYTE_WEIGHTS[:length]
+
+
+def hash64(values):
+    """
+    Stable 64-bit hashes of the non-null values of an arrow array, as a
+    uint64 numpy array. Strings are hashed from their bytes without
+    leaving numpy, dictionary arrays once per dictionary value, and
+    everything else from its integer or float bit pattern.
+    """
+    if isinstance(values, pa.ChunkedArray):
+        values = values.combine_chunks()
+    if pa.types.is_dictionary(values.type) and values.dictionary.null_count:
+        values = values.dictionary_decode()
+    if pa.types.is_dictionary(values.type):
+        hashes = hash64(values.dictionary)
+        return hashes[values.indices.drop_null().to_numpy()]
+    values = values.drop_null()
+    kind = values.type
+    if pa.types.is_string(kind) or pa.types.is_binary(kind) or pa.types.is_large_string(kind) \
+            or pa.types.is_large_binary(kind):
+        large = pa.types.is_large_string(kind) or pa.types.is_large_binary(kind)
+        values = values.cast(pa.large_binary() if large else pa.binary())
+        offsets = np.frombuffer(values.buffers()[1], np.int64 if large else np.int32)
+        offsets = offsets[values.offset:values.offset + len(values) + 1].astype(np.int64)
+        data = np.frombuffer(values.buffers()[2], np.uint8)[offsets[0]:offsets[-1]].astype(np.uint64) \
+            if len(values) and offsets[-1] > offsets[0] else np.empty(0, np.uint64)
+        starts, lengths = offsets[:-1] - offsets[0], np.diff(offsets)
+        positions = np.arange(len(data)) - np.repeat(starts, lengths)
+        with np.errstate(over="ignore"):
+            weighted = (data + np.uint64(1)) * byte_weights(int(lengths.max(initial=0)))[positions]
+            hashes = np.zeros(len(values), np.uint64)
+            filled = lengths > 0
+            if filled.any():
+                hashes[filled] = np.add.reduceat(weighted, starts[filled])
+            return mix64((hashes ^ lengths.astype(np.uint64)) + np.uint64(0x9E3779B97F4A7C15))
+    if pa.types.is_floating(kind):
+        bits = pc.cast(values, pa.float64()).to_numpy(zero_copy_only=False).view(np.uint64)
+    elif pa.types.is_boolean(kind):
+        bits = values.to_numpy(zero_copy_only=False).astype(np.uint64)
+    else:
+        physical = {8: pa.int8(), 16: pa.int16(), 32: pa.int32(), 64: pa.int64()}[kind.bit_width]
+        bits = values.view(physical).to_numpy().astype(np.int64).view(np.uint64)
+    return mix64(bits + np.uint64(0x9E3779B97F4A7C15))
+
+
+class HyperLogLog:
+    """Distinct count estimate from 2**precision one-byte registers (~1.04 / sqrt(2**precision) relative error)."""
+
+    def __init__(self, precision=14):
+        self.precision = precision
+        self.registers = np.zeros(1 << precision, np.uint8)
+
+    def add(self, hashes):
+        p = np.uint64(self.precision)
+        buckets = (hashes >> np.uint64(64 - self.precision)).astype(np.intp)
+        rest = (hashes << p).astype(np.float64)  # only the position of the highest set bit matters
+        _, bit_length = np.frexp(rest)
+        ranks = np.where(rest > 0, 65 - bit_length, 65 - self.precision).astype(np.uint8)
+        np.maximum.at(self.registers, buckets, ranks)
+
+    def merge(self, other):
+        np.maximum(self.registers, other.registers, out=self.registers)
+
+    def estimate(self):
+        m = len(self.registers)
+        raw = 0.7213 / (1 + 1.079 / m) * m * m / np.sum(np.ldexp(1.0, -self.registers.astype(np.int32)))
+        zeros = int(np.count_nonzero(self.registers == 0))
+        if raw <= 2.5 * m and zeros:
+            return m * np.log(m / zeros)  # linear counting is more accurate for small sets
+        return float(raw)
+
+
+class CountMin:
+    """
+    Approximate counts per value in a depth x width table; estimates never
+    undercount. Each row takes its own 16 bits of one mixed hash, so width
+    is a power of two up to 2**16 and depth at most 4.
+    """
+
+    def __init__(self, width=16384, depth=4):
+        self.width = width
+        self.table = np.zeros((depth, width), np.int64)
+
+    def _columns(self, hashes):
+        mixed = mix64(hashes)
+        mask = np.uint64(self.width - 1)
+        return [((mixed >> np.uint64(16 * row)) & mask).astype(np.intp) for row in range(len(self.table))]
+
+    def add(self, hashes, counts):
+        for row, columns in enumerate(self._columns(hashes)):
+            self.table[row] += np.bincount(columns, weights=counts, minlength=self.width).astype(np.int64)
+
+    def estimate(self, hashes):
+        return np.min([self.table[row][columns] for row, columns in enumerate(self._columns(hashes))], axis=0)
+
+    def merge(self, other):
+        self.table += other.table
@@ -1,7 +1,10 @@
-import requests
+import json
 import pandas as pd
 from pathlib import Path
 
+from fetch_client import FetchClient
+from response_cache import ResponseCache
+
 BASE_URL = "https://api.usaspending.gov/api/v2/search/spending_by_transaction/"
 
 OUTPUT_DIR = Path("test_storage")
@@ -34,6 +37,10 @@ FIELDS = [
     "recipient_location_city_name",
     "Funding Agency"
 ]
+
+# Identical payloads are answered from the local response cache; set
+# USASPENDING_CACHE=offline to run without a network, or refresh to re-fetch
+client = FetchClient(BASE_URL, pool_size=1, cache=ResponseCache())
 for naics in NAICS:
     payload = {
         "filters":
@@ -50,11 +57,9 @@ for naics in NAICS:
         "sort": SORT_FIELD,
         "order": ORDER }
 
-    response = requests.post(BASE_URL, json=payload)
-    print(response.status_code)
-    print(response.text)
-    response.raise_for_status()
-    data = response.json().get("results", [])
+    response = client.post(payload)
+    print(json.dumps(response))
+    data = response.get("results", [])
 
     # Convert to DataFrame
     df = pd.DataFrame(data)
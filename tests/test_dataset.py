@@ -0,0 +1,70 @@
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+import pytest
+
+import dataset
+import mock_api
+import usaspending
+from schema import normalize
+
+NAICS = "336411"
+LEGACY_KEY = ["Award ID", "Mod"]
+
+
+@pytest.fixture
+def records():
+    return [dict(record) for record in mock_api.generate_records(NAICS, 400)]
+
+
+def stored(root):
+    return dataset.scan(root=root, naics=NAICS)
+
+
+def keys(table, key):
+    return list(zip(*(table[column].to_pylist() for column in key)))
+
+
+def updated(records):
+    return [dict(record, **{"Recipient Name": "UPDATED"}) for record in records]
+
+
+@pytest.mark.parametrize("key", [usaspending.DEDUPE_KEY, LEGACY_KEY])
+def test_overlapping_delta_replaces_older_rows(tmp_path, records, key):
+    if key == LEGACY_KEY:  # as fetched before generated_internal_id was requested
+        records = [{name: value for name, value in record.items() if name != "generated_internal_id"}
+                   for record in records]
+    dataset.write_code(NAICS, [normalize(records[:300])], tmp_path)
+
+    added = dataset.merge_code(NAICS, normalize(updated(records[200:])), key, tmp_path)
+
+    table = stored(tmp_path)
+    assert added == 100
+    assert table.num_rows == 400
+    assert len(set(keys(table, key))) == 400
+    names = dict(zip(keys(table, key), table["Recipient Name"].to_pylist()))
+    assert all(names[k] == "UPDATED" for k in keys(normalize(records[200:]), key))
+    assert all(names[k] != "UPDATED" for k in keys(normalize(records[:200]), key))
+
+
+def test_rows_without_generated_id_are_kept(tmp_path, records):
+    legacy = [dict(record, generated_internal_id=None) for record in records[:300]]
+    dataset.write_code(NAICS, [normalize(legacy)], tmp_path)
+
+    dataset.merge_code(NAICS, normalize(records[200:]), usaspending.DEDUPE_KEY, tmp_path)
+
+    table = stored(tmp_path)
+    assert sorted(keys(table, LEGACY_KEY)) == sorted(keys(normalize(legacy + records[200:]), LEGACY_KEY))
+
+
+def test_merged_partitions_stay_sorted_by_amount(tmp_path, records):
+    dataset.write_code(NAICS, [normalize(records[::2])], tmp_path)
+
+    dataset.merge_code(NAICS, normalize(updated(records[1::2])), usaspending.DEDUPE_KEY, tmp_path)
+
+    files = sorted((tmp_path / f"naics={NAICS}").glob("fiscal_year=*/*.parquet"))
+    assert files
+    for path in files:
+        amounts = pq.read_table(path, columns=["Transaction Amount"])["Transaction Amount"].to_pylist()
+        assert amounts == sorted(amounts, reverse=True), path
+    assert pc.sum(stored(tmp_path)["Transaction Amount"]).as_py() == pytest.approx(
+        sum(record["Transaction Amount"] for record in records))
@@ -0,0 +1,86 @@
+import itertools
+
+import numpy as np
+import pytest
+
+import aggregates
+import dataset
+import mock_api
+from filter_index import FilterIndex
+from schema import normalize
+
+STATES = sorted(mock_api.STATES)[:-3]  # the other states count nowhere
+
+
+@pytest.fixture(scope="module")
+def root(tmp_path_factory):
+    root = tmp_path_factory.mktemp("dataset")
+    for naics in ("336411", "336413"):
+        dataset.write_code(naics, [normalize(list(mock_api.generate_records(naics, 1500)))], root)
+    return root
+
+
+@pytest.fixture(scope="module")
+def index(root):
+    return FilterIndex(STATES, root)
+
+
+@pytest.fixture(scope="module")
+def frame(root):
+    columns = [*aggregates.STATE_COLUMNS, "naics", aggregates.AGENCY_COLUMN, aggregates.AWARD_TYPE_COLUMN,
+               "Action Date", aggregates.AMOUNT_COLUMN]
+    return dataset.load(columns, root=root)
+
+
+def expected(frame, measure, naics=None, agencies=None, award_types=None, start=None, end=None):
+    """The same totals from a pandas groupby."""
+    rows = frame
+    for column, wanted in (("naics", naics), (aggregates.AGENCY_COLUMN, agencies),
+                           (aggregates.AWARD_TYPE_COLUMN, award_types)):
+        if wanted is not None:
+            rows = rows[rows[column].isin(wanted)]
+    dates = rows["Action Date"].astype("datetime64[ns]")
+    if start:
+        rows = rows[dates >= np.datetime64(start)]
+        dates = dates[dates >= np.datetime64(start)]
+    if end:
+        rows = rows[dates <= np.datetime64(end)]
+    totals = np.zeros((len(STATES), 2))
+    for role, column in enumerate(aggregates.STATE_COLUMNS):
+        grouped = rows.groupby(column)[aggregates.AMOUNT_COLUMN]
+        grouped = grouped.size() if measure == "count" else grouped.sum()
+        totals[:, role] = grouped.reindex(STATES, fill_value=0).to_numpy()
+    return totals
+
+
+def date_bounds(frame):
+    dates = frame["Action Date"].astype("datetime64[ns]")
+    first, last = dates.min().date().isoformat(), dates.max().date().isoformat()
+    return [(None, None), (first, None), (None, last), (first, last), (last, last), (first, first),
+            ("2015-06-01", "2019-09-30"), ("2019-09-30", "2015-06-01"), ("1990-01-01", "1999-12-31")]
+
+
+FILTERS = [
+    {},
+    {"naics": ["336411"]},
+    {"naics": ["336411", "336413"], "agencies": ["Department of Defense"]},
+    {"agencies": ["Department of Energy", "Department of Homeland Security"], "award_types": ["BPA CALL"]},
+    {"award_types": ["DELIVERY ORDER", "PURCHASE ORDER"]},
+    {"naics": []},
+    {"agencies": ["No Such Agency"]},
+]
+
+
+@pytest.mark.parametrize("measure", aggregates.MEASURES)
+def test_select_matches_a_pandas_groupby(index, frame, measure):
+    for filters, (start, end) in itertools.product(FILTERS, date_bounds(frame)):
+        totals = index.select(measure, start=start, end=end, **filters)
+        assert totals.shape == (len(STATES), 2)
+        np.testing.assert_allclose(totals, expected(frame, measure, start=start, end=end, **filters),
+                                   err_msg=f"{filters} {start}..{end}")
+
+
+def test_unfiltered_select_counts_every_row_with_a_state(index, frame):
+    assert len(index) == len(frame)
+    for role, column in enumerate(aggregates.STATE_COLUMNS):
+        assert index.select("count")[:, role].sum() == frame[column].isin(STATES).sum()
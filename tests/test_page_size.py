@@ -0,0 +1,23 @@
+import pyarrow.dataset as ds
+
+import mock_api
+import usaspending
+from fetch_client import AdaptivePageSize, FetchClient
+
+NAICS = "336411"
+RECORDS = 4321
+
+
+def test_timed_out_page_is_fetched_in_smaller_pages(tmp_path):
+    # Pages above 500 records stall past the client's timeout; the page size keeps growing back into them
+    server, url = mock_api.start_server(latency=0.0, records_per_code=RECORDS, stall_above=500, stall=2.0)
+    client = FetchClient(url, pool_size=4, timeout=0.5, page_size=AdaptivePageSize(grow_after=1))
+    try:
+        stats = usaspending.crawl([NAICS], concurrency=4, pages_per_window=4, rate=1000.0, base_url=url,
+                                  output_dir=tmp_path, client=client, max_window_records=100_000)
+    finally:
+        server.shutdown()
+    assert stats.failed == []
+    assert stats.metrics.total("page_splits") > 0
+    assert stats.metrics.total("retries") == 0  # no page was sent again at the size that timed out
+    assert ds.dataset(tmp_path, format="parquet", partitioning="hive").count_rows() == RECORDS
@@ -0,0 +1,52 @@
+from datetime import date
+
+import pyarrow.dataset as ds
+
+import mock_api
+import usaspending
+from fetch_client import AdaptivePageSize, FetchClient
+from response_cache import ResponseCache
+
+NAICS_CODES = ["336411", "336413", "336414"]
+AS_OF = date(2026, 1, 1)
+
+
+def crawl(url, output_dir, cache, client=None):
+    return usaspending.crawl(NAICS_CODES, concurrency=4, pages_per_window=4, rate=1000.0, base_url=url,
+                             output_dir=output_dir, max_window_records=1000, cache=cache, client=client,
+                             as_of=AS_OF)
+
+
+def stored_rows(output_dir):
+    return ds.dataset(output_dir, format="parquet", partitioning="hive").count_rows()
+
+
+def test_offline_replay_of_a_concurrent_crawl(tmp_path):
+    server, url = mock_api.start_server(latency=0.01, records_per_code=3000)
+    try:
+        recorded = crawl(url, tmp_path / "recorded", ResponseCache(tmp_path / "cache", "readwrite"))
+    finally:
+        server.shutdown()
+    assert recorded.failed == []
+
+    # With the server gone and the page size moving on its own schedule, every page must still come from the cache
+    cache = ResponseCache(tmp_path / "cache", "offline")
+    client = FetchClient(url, pool_size=4, cache=cache, page_size=AdaptivePageSize(grow_after=1))
+    replayed = crawl(url, tmp_path / "replayed", cache, client)
+    assert cache.misses == 0
+    assert replayed.failed == []
+    assert stored_rows(tmp_path / "replayed") == stored_rows(tmp_path / "recorded") == 3 * 3000
+
+
+def test_pages_are_served_from_other_page_sizes(tmp_path):
+    url, filters = "http://mock/search", {"naics_codes": ["336411"]}
+    recorder = ResponseCache(tmp_path, "readwrite")
+    for page in (1, 2, 3):  # 500, 500, then the last 200
+        payload = {"filters": filters, "page": page, "limit": 500}
+        recorder.put(url, payload, mock_api.search(payload, 1200))
+    cache = ResponseCache(tmp_path, "offline")
+
+    for page, limit in [(7, 100), (1, 1000), (2, 1000), (12, 100), (13, 100), (3, 5000)]:
+        payload = {"filters": filters, "page": page, "limit": limit}
+        assert cache.get(url, payload).data == mock_api.search(payload, 1200), (page, limit)
+    assert cache.misses == 0
@@ -0,0 +1,129 @@
+import time
+
+import pyarrow.dataset as ds
+import pytest
+
+import awards
+import mock_api
+import usaspending
+from checkpoint import ROW_GROUP_RECORDS, CrawlManifest, part_path, staging_dir, write_table
+from fetch_client import FetchClient
+from schema import normalize
+
+NAICS = "336411"
+RECORDS = 2999  # the last page is short, so the last offset is not a multiple of any page size
+
+
+def crawl(url, output_dir):
+    return usaspending.crawl([NAICS], concurrency=4, pages_per_window=4, rate=1000.0, base_url=url,
+                             output_dir=output_dir, max_window_records=100_000)
+
+
+def stored_rows(output_dir):
+    return ds.dataset(output_dir, format="parquet", partitioning="hive").count_rows()
+
+
+def test_failed_page_past_the_end_is_not_a_failure(tmp_path):
+    # Speculative pages past the last record fail at once with a 400, before the real, slower last page arrives
+    server, url = mock_api.start_server(latency=0.2, records_per_code=RECORDS, past_end_status=400)
+    try:
+        stats = crawl(url, tmp_path)
+    finally:
+        server.shutdown()
+    assert server.faults > 0
+    assert stats.failed == []
+    assert stored_rows(tmp_path) == RECORDS
+    assert CrawlManifest(tmp_path).data["windows"] == {}
+    assert (tmp_path / awards.AWARDS_NAME).exists()  # refreshed as the code finished
+
+
+def test_resume_from_unaligned_offset(tmp_path):
+    # A checkpoint left by an earlier version: every record on disk, but neither done nor exhausted, so the
+    # window can't be paged from where it stopped and is fetched again
+    server, url = mock_api.start_server(latency=0.0, records_per_code=RECORDS)
+    try:
+        plan = usaspending.action_range(NAICS, CrawlManifest(tmp_path), tmp_path)
+        windows = usaspending.plan_windows(plan[0], plan[1], lambda w: RECORDS)
+        window = (usaspending.AWARD_START_DATE, usaspending.AWARD_END_DATE, *windows[0])
+        records = mock_api.search(usaspending.build_payload(NAICS, 1, RECORDS, windows[0]), RECORDS)["results"]
+        write_table(normalize(records), part_path(staging_dir(tmp_path, NAICS, window), 0))
+        manifest = CrawlManifest(tmp_path)
+        manifest.set_plan(NAICS, windows=windows, merge=False, done=False)
+        manifest.update(NAICS, window, offset=RECORDS, parts=1, done=False)
+
+        for _ in range(2):  # and the run after it
+            stats = crawl(url, tmp_path)
+            assert stats.failed == []
+            assert stored_rows(tmp_path) == RECORDS
+    finally:
+        server.shutdown()
+
+
+class Interrupted(BaseException):
+    """Stands in for a crash or Ctrl-C: not an Exception, so nothing in the crawl catches it."""
+
+
+class InterruptingClient(FetchClient):
+    """Interrupts the crawl at the first search page at or past `offset`, once a checkpoint is on disk."""
+
+    def __init__(self, url, offset, output_dir):
+        super().__init__(url, pool_size=4)
+        self.offset = offset
+        self.output_dir = output_dir
+
+    def post(self, payload, url=None, throttle=None, labels=None):
+        if "page" in payload and (payload["page"] - 1) * payload["limit"] >= self.offset:
+            deadline = time.monotonic() + 10
+            while time.monotonic() < deadline and not any(
+                    entry.get("offset") for entry in CrawlManifest(self.output_dir).data["windows"].values()):
+                time.sleep(0.01)
+            raise Interrupted()
+        return super().post(payload, url=url, throttle=throttle, labels=labels)
+
+
+def test_resume_after_interruption_mid_window(tmp_path):
+    records = 25_000  # checkpoints land every ROW_GROUP_RECORDS
+    server, url = mock_api.start_server(latency=0.0, records_per_code=records)
+    try:
+        with pytest.raises(Interrupted):
+            usaspending.crawl([NAICS], concurrency=4, pages_per_window=4, rate=1000.0, base_url=url,
+                              output_dir=tmp_path, max_window_records=100_000,
+                              client=InterruptingClient(url, 2 * ROW_GROUP_RECORDS, tmp_path))
+        (entry,) = CrawlManifest(tmp_path).data["windows"].values()
+        assert 0 < entry["offset"] < records and not entry["done"] and not entry["exhausted"]
+
+        stats = usaspending.crawl([NAICS], concurrency=4, pages_per_window=4, rate=1000.0, base_url=url,
+                                  output_dir=tmp_path, max_window_records=100_000)
+    finally:
+        server.shutdown()
+    assert stats.failed == []
+    assert stats.records == records - entry["offset"]  # nothing before the checkpoint is fetched again
+    assert stored_rows(tmp_path) == records
+
+
+class FailingClient(FetchClient):
+    """Fails every search page of one NAICS code, as if the API kept rejecting it."""
+
+    def __init__(self, url, naics):
+        super().__init__(url, pool_size=4)
+        self.naics = naics
+
+    def post(self, payload, url=None, throttle=None, labels=None):
+        if "page" in payload and payload["filters"]["naics_codes"] == [self.naics]:
+            raise ValueError(f"NAICS {self.naics} rejected")
+        return super().post(payload, url=url, throttle=throttle, labels=labels)
+
+
+def test_finished_codes_refresh_while_another_keeps_failing(tmp_path, capsys):
+    server, url = mock_api.start_server(latency=0.0, records_per_code=RECORDS)
+    try:
+        for incremental in (False, True):
+            stats = usaspending.crawl([NAICS, "336413"], concurrency=4, rate=1000.0, base_url=url,
+                                      output_dir=tmp_path, client=FailingClient(url, "336413"),
+                                      incremental=incremental)
+            assert stats.failed == ["336413"]
+            assert CrawlManifest(tmp_path).plan(NAICS) is None
+            assert stats.records > 0  # NAICS was fetched again, not skipped as already done
+    finally:
+        server.shutdown()
+    assert "already fetched" not in capsys.readouterr().out
@@ -0,0 +1,136 @@
+import random
+
+import requests
+
+import retry
+import usaspending
+from fetch_client import FetchClient
+
+URL = "http://api.test/search"
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def http_error(status, **headers):
+    response = requests.Response()
+    response.status_code = status
+    response.url = URL
+    response.headers.update({name.replace("_", "-"): value for name, value in headers.items()})
+    return requests.exceptions.HTTPError(f"HTTP {status}", response=response)
+
+
+def fail(policy, error):
+    """One request through the policy's slot that ends in `error`."""
+    try:
+        with policy.slot(URL):
+            raise error
+    except type(error):
+        pass
+
+
+def succeed(policy, n=1):
+    for _ in range(n):
+        with policy.slot(URL):
+            pass
+
+
+def test_429_with_retry_after_waits_as_asked_and_halves_concurrency():
+    clock = Clock()
+    policy = retry.RetryPolicy(max_concurrency=8, clock=clock, rng=random.Random(1))
+    error = http_error(429, Retry_After="7")
+
+    fail(policy, error)
+
+    host = policy.host(URL)
+    assert host.limit == 4
+    assert host.open_until == clock.now + 7  # every worker holds off, not just this one
+    for attempt in range(1, 5):
+        assert 7 <= policy.delay(error, attempt) <= 7 + policy.base
+
+
+def test_backoff_is_full_jitter_capped():
+    policy = retry.RetryPolicy(rng=random.Random(2))
+    error = http_error(502)
+    for attempt in range(1, 12):
+        delays = [policy.delay(error, attempt) for _ in range(50)]
+        assert all(0 <= delay <= min(policy.cap, policy.base * 2 ** attempt) for delay in delays)
+    assert policy.delay(http_error(404), 1) is None
+
+
+def test_repeated_5xx_opens_the_breaker_until_a_probe_succeeds():
+    clock = Clock()
+    policy = retry.RetryPolicy(clock=clock)
+    host = policy.host(URL)
+    for _ in range(retry.THRESHOLD - 1):
+        fail(policy, http_error(500))
+    assert host.open_until < clock.now  # still closed
+
+    fail(policy, http_error(500))
+    assert host.open_until == clock.now + retry.COOLDOWN
+
+    clock.now = host.open_until  # the cooldown has passed; the next request is a probe
+    fail(policy, http_error(500))
+    assert host.open_until == clock.now + 2 * retry.COOLDOWN  # reopened for twice as long
+
+    clock.now = host.open_until
+    succeed(policy)
+    assert host.failures == 0 and not host.probing
+    assert host.cooldown == retry.COOLDOWN
+
+
+def test_concurrency_limit_recovers_one_slot_per_limit_successes():
+    clock = Clock()
+    policy = retry.RetryPolicy(max_concurrency=4, clock=clock)
+    host = policy.host(URL)
+    first, second = host.acquire(), host.acquire()
+    clock.now += 1
+    host.release(first, http_error(503))
+    assert host.limit == 2
+    host.release(second, http_error(503))  # sent before the cut, so throttled at the old limit: no second cut
+    assert host.limit == 2
+
+    succeed(policy, 2)
+    assert host.limit == 3
+    succeed(policy, 2)
+    assert host.limit == 3
+    succeed(policy, 1)
+    assert host.limit == 4
+    succeed(policy, 10)
+    assert host.limit == 4
+
+
+class Session:
+    """Answers with the given responses in turn."""
+
+    def __init__(self, *responses):
+        self.responses = list(responses)
+
+    def post(self, url, json=None, timeout=None):
+        response = requests.Response()
+        response.status_code, headers, response._content = self.responses.pop(0)
+        response.headers.update(headers)
+        response.url = url
+        return response
+
+
+def test_fetch_with_retry_sleeps_for_retry_after():
+    clock, sleeps = Clock(), []
+
+    def sleep(seconds):
+        sleeps.append(seconds)
+        clock.now += seconds  # so the circuit the Retry-After opened has closed again
+
+    policy = retry.RetryPolicy(clock=clock, sleep=sleep, rng=random.Random(3))
+    client = FetchClient(URL, retry=policy)
+    client.session = Session((429, {"Retry-After": "3"}, b""), (503, {}, b""), (200, {}, b'{"results": [1]}'))
+
+    assert usaspending.fetch_with_retry({"page": 1, "limit": 100}, client=client) == {"results": [1]}
+    assert len(sleeps) == 2
+    assert 3 <= sleeps[0] <= 3 + policy.base
+    assert 0 <= sleeps[1] <= policy.base * 2 ** 2
@@ -1,7 +1,25 @@
-import requests
-import pandas as pd
+import pyarrow as pa
 from pathlib import Path
+import argparse
+import shutil
+import sys
+import threading
 import time
+from datetime import date, timedelta
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import requests
+
+import awards
+import pipeline
+from checkpoint import (CrawlManifest, ROW_GROUP_RECORDS, STAGING_DIR, iter_parts, part_path, remove_parts,
+                        remove_parts_from, staging_dir, write_table)
+from dataset import DATASET_DIR, max_action_date, merge_code, write_code
+import retry
+from fetch_client import FetchClient
+from metrics import CrawlMetrics
+from response_cache import CACHE_DIR, DEFAULT_MODE, DEFAULT_TTL, MODES, ResponseCache
+from schema import normalize
 
 # Base URL for USAspending transaction search
 BASE_URL = "https://api.usaspending.gov/api/v2/search/spending_by_transaction/"
@@ -36,9 +54,22 @@ DEFENSE_NAICS = [
     "332721",  # Precision Turned Products
 ]
 
-# Directory to save Parquet files
-OUTPUT_DIR = Path("usa_spending_defense")
-OUTPUT_DIR.mkdir(exist_ok=True)
+# Partitioned dataset to save into (see dataset.py)
+OUTPUT_DIR = DATASET_DIR
+
+# Award date window requested from the API
+AWARD_START_DATE = "2023-01-01"
+AWARD_END_DATE = "2025-12-31"
+
+# Earliest action date USAspending accepts in a time_period filter
+ACTION_START_DATE = "2007-10-01"
+
+# Incremental refreshes re-fetch this many days before the stored high-water
+# mark, to pick up transactions that were reported late
+INCREMENTAL_OVERLAP_DAYS = 7
+
+# A transaction is one modification of one award
+DEDUPE_KEY = ["generated_internal_id", "Mod"]
 
 # [\'Action Date\', \'Action Type\', \'Award ID\', \'Award Type\', \'Awarding Agency\', \'awarding_agency_id\', \'awarding_agency_slug\', \'Awarding Sub Agency\', \'cfda_number\', \'cfda_title\', \'def_codes\', \'Funding Agency\', \'funding_agency_slug\', \'Funding Sub Agency\', \'generated_internal_id\', \'internal_id\', \'Issued Date\', \'Last Date to Order\', \'Loan Value\', \'Mod\', \'naics_code\', \'naics_description\', \'pop_city_name\', \'pop_country_name\', \'pop_state_code\', \'product_or_service_code\', \'product_or_service_description\', \'recipient_id\', \'recipient_location_address_line1\', \'recipient_location_address_line2\', \'recipient_location_address_line3\', \'recipient_location_city_name\', \'recipient_location_country_name\', \'recipient_location_state_code\', \'Recipient Name\', \'Recipient UEI\', \'Subsidy Cost\', \'Transaction Amount\', \'Transaction Description\', \'Assistance Listing\', \'NAICS\', \'Primary Place of Performance\', \'PSC\', \'Recipient Location\']"}'
 
@@ -69,70 +100,671 @@ FIELDS = [
 SORT_FIELD = "Transaction Amount"
 ORDER = "desc"
 
+# Concurrency defaults
+CONCURRENCY = 4  # total requests in flight across all NAICS codes
+PAGES_PER_WINDOW = 2  # requests in flight for a single action-date window
+MAX_WINDOW_RECORDS = 10_000  # windows holding more records than this are split in two
+REQUESTS_PER_SECOND = 3.0  # shared budget, replaces the old fixed 0.3s pause
+
+
+# -----------------------------
+# Rate limiting
+# -----------------------------
+class TokenBucket:
+    """Thread-safe token bucket shared by every fetch worker."""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait_time = (1 - self.tokens) / self.rate
+            time.sleep(wait_time)
+
+
+# -----------------------------
+# Crawl statistics
+# -----------------------------
+class CrawlStats:
+    """Run totals, with the detailed per-NAICS measurements in `metrics` (a CrawlMetrics)."""
+
+    def __init__(self, metrics=None):
+        self.pages = 0
+        self.records = 0
+        self.started = time.monotonic()
+        self.finished = None
+        self.failed = []  # NAICS codes left incomplete
+        self.metrics = metrics or CrawlMetrics()
+        self.hosts = {}  # host: final concurrency limit and throttling responses
+        self.stages = {}  # pipeline stage: busy / blocked time and utilization
+        self.lock = threading.Lock()
+
+    def add_page(self, n_records, naics=None):
+        with self.lock:
+            self.pages += 1
+            self.records += n_records
+        self.metrics.count("pages", naics=naics)
+        self.metrics.count("records", n_records, naics=naics)
+
+    def stop(self):
+        self.finished = time.monotonic()
+
+    @property
+    def elapsed(self):
+        return (self.finished or time.monotonic()) - self.started
+
+    def summary(self):
+        elapsed = max(self.elapsed, 1e-9)
+        return (f"{self.pages} pages, {self.records} records in {elapsed:.1f}s "
+                f"({self.pages / elapsed:.2f} pages/sec, {self.records / elapsed:.1f} records/sec)")
+
+    def report(self):
+        """Run totals for the JSON run report."""
+        return {"pages": self.pages, "records": self.records, "elapsed_seconds": self.elapsed,
+                "failed": self.failed, "hosts": self.hosts, "stages": self.stages}
+
+    def table(self):
+        """Per-NAICS breakdown of where the crawl spent its time, one line per code."""
+        m = self.metrics
+        lines = [f"{'naics':<8} {'pages':>6} {'records':>8} {'MB':>7} {'p50 ms':>7} {'p95 ms':>7} {'p99 ms':>7} "
+                 f"{'queue s':>8} {'decode s':>8} {'write s':>8} {'retries':>7} {'throttles':>9}"]
+        for naics in m.label_values("naics"):
+            latency = m.combined("request_seconds", naics=naics, endpoint="search")
+            p = [f"{latency.quantile(q) * 1000:>7.0f}" if latency.count else f"{'-':>7}" for q in (0.5, 0.95, 0.99)]
+            lines.append(
+                f"{naics:<8} {m.total('pages', naics=naics):>6} {m.total('records', naics=naics):>8} "
+                f"{m.total('response_bytes', naics=naics) / 1e6:>7.1f} {' '.join(p)} "
+                f"{m.combined('queue_seconds', naics=naics).sum:>8.1f} "
+                f"{m.combined('decode_seconds', naics=naics).sum:>8.2f} "
+                f"{m.combined('write_seconds', naics=naics).sum + m.combined('finish_seconds', naics=naics).sum:>8.2f} "
+                f"{m.total('retries', naics=naics):>7} {m.total('throttles', naics=naics):>9}")
+        return "\n".join(lines)
+
+
+def build_payload(naics, page, limit=100, action_window=None):
+    payload = {
+        "filters": {
+            "award_type_codes": ["A", "B", "C", "D"],
+            "naics_codes": [naics],
+            "award_date_range": {
+                "start_date": AWARD_START_DATE,
+                "end_date": AWARD_END_DATE
+            }
+        },
+        "fields": FIELDS,
+        "page": page,
+        "limit": limit,
+        "sort": SORT_FIELD,
+        "order": ORDER
+    }
+    if action_window:
+        payload["filters"]["time_period"] = [{
+            "start_date": action_window[0],
+            "end_date": action_window[1],
+            "date_type": "action_date"
+        }]
+    return payload
+
+
+def describe(error):
+    status = retry.status_of(error)
+    return f"HTTP {status}" if status else f"{type(error).__name__}: {error}"
+
 
 # Retry function
-def fetch_with_retry(payload, max_retries=7):
-    retries = 0
-    while retries < max_retries:
+def fetch_with_retry(payload, max_retries=retry.MAX_RETRIES, client=None, url=None, throttle=None, labels=None,
+                     split_timeouts=False):
+    """
+    POST with the client's RetryPolicy: throttling, 5xx and connection
+    errors are retried after a jittered backoff (or the server's
+    Retry-After) up to `max_retries` times, then the last error is raised.
+    Other errors are raised at once, and so are timeouts with
+    `split_timeouts` once the page size has dropped below the payload's
+    limit, for the caller to fetch the page in smaller pieces. Retries,
+    throttling responses and failures are counted in the client's metrics
+    under `labels`.
+    """
+    client = client or FetchClient(BASE_URL, pool_size=1)
+    labels = labels or {}
+    attempt = 0
+    while True:
         try:
-            response = requests.post(BASE_URL, json=payload, timeout=30)
-            response.raise_for_status()
-            return response.json()
-        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
-            retries += 1
-            wait = 2 ** retries
-            print(f"Connection error: {e}. Retrying in {wait}s... ({retries}/{max_retries})")
-            time.sleep(wait)
-    raise Exception("Max retries exceeded for payload")
+            return client.post(payload, url=url, throttle=throttle, labels=labels)
+        except Exception as e:
+            if (split_timeouts and isinstance(e, requests.exceptions.Timeout)
+                    and client.page_size.current < payload.get("limit", 0)):
+                raise
+            attempt += 1
+            wait = client.retry.delay(e, attempt)
+            if client.metrics:
+                if retry.status_of(e) in retry.THROTTLE_STATUSES:
+                    client.metrics.count("throttles", **labels)
+                given_up = wait is None or attempt > max_retries
+                reason = f"HTTP {retry.status_of(e)}" if retry.status_of(e) else type(e).__name__
+                client.metrics.count("failures" if given_up else "retries", reason=reason, **labels)
+            if wait is None or attempt > max_retries:
+                raise
+            print(f"{describe(e)}. Retrying in {wait:.1f}s... ({attempt}/{max_retries})")
+            client.retry.sleep(wait)
 
 
-# Loop over each NAICS code
-for naics in DEFENSE_NAICS:
-    print(f"Fetching NAICS {naics}...")
+def is_last_page(data, results, limit):
+    metadata = data.get("page_metadata") or {}
+    if "hasNext" in metadata:
+        return not metadata["hasNext"]
+    return len(results) < limit
 
-    page = 1
-    limit = 100  # adjust up to 5000 if needed
-    all_records = []
 
-    while True:
-        payload = {
-            "filters": {
-                "award_type_codes": ["A", "B", "C", "D"],
-                "naics_codes": [naics],
-                "award_date_range": {
-                    "start_date": "2023-01-01",
-                    "end_date": "2025-12-31"
-                }
-            },
-            "fields": FIELDS,
-            "page": page,
-            "limit": limit,
-            "sort": SORT_FIELD,
-            "order": ORDER
-        }
+def fetch_records(naics, action_window, offset, limit, client, throttle=None, labels=None):
+    """
+    The search page holding records [offset, offset + limit). If it times
+    out and the page size has dropped meanwhile, the same records are
+    fetched as aligned pages of the smaller size (each split again if it
+    times out too) instead of retrying the page whole, and their results
+    are joined into one page.
+    """
+    payload = build_payload(naics, offset // limit + 1, limit, action_window)
+    try:
+        return fetch_with_retry(payload, client=client, throttle=throttle, labels=labels, split_timeouts=True)
+    except requests.exceptions.Timeout:
+        size = client.page_size.limit_for(offset)  # divides both offset and limit, since every size divides the next
+        if size >= limit:
+            raise
+    print(f"Page of {limit} records at offset {offset} timed out, fetching it as pages of {size}")
+    if client.metrics:
+        client.metrics.count("page_splits", **(labels or {}))
+    results = []
+    for start in range(offset, offset + limit, size):
+        data = fetch_records(naics, action_window, start, size, client, throttle, labels)
+        page = data.get("results", [])
+        results.extend(page)
+        if not page or is_last_page(data, page, size):
+            break
+    metadata = dict(data.get("page_metadata") or {}, page=offset // limit + 1,
+                    hasNext=bool(page) and not is_last_page(data, page, size))
+    return dict(data, limit=limit, results=results, page_metadata=metadata)
+
+
+def count_url(base_url):
+    """spending_by_transaction_count endpoint next to a spending_by_transaction URL."""
+    return base_url.rstrip("/") + "_count/"
+
+
+def fetch_count(naics, action_window, client, base_url=BASE_URL, throttle=None):
+    payload = {"filters": build_payload(naics, 1, action_window=action_window)["filters"]}
+    data = fetch_with_retry(payload, client=client, url=count_url(base_url), throttle=throttle,
+                            labels={"naics": naics, "endpoint": "count"})
+    return sum(data.get("results", {}).values())
+
+
+# -----------------------------
+# Time-sliced windows
+# -----------------------------
+def plan_windows(start, end, count, max_records=MAX_WINDOW_RECORDS):
+    """
+    Split the action-date range [start, end] into windows that each hold at
+    most `max_records` transactions, by bisecting any window that is too big.
+    Empty windows are dropped. Returns (start, end) ISO date pairs in date order.
+    """
+    n = count((start.isoformat(), end.isoformat()))
+    if n == 0:
+        return []
+    if n <= max_records or start == end:
+        if n > max_records:
+            print(f"  {n} records on {start}, more than one window should hold")
+        return [(start.isoformat(), end.isoformat())]
+    mid = start + (end - start) // 2
+    return (plan_windows(start, mid, count, max_records)
+            + plan_windows(mid + timedelta(days=1), end, count, max_records))
+
+
+def action_range(naics, manifest, output_dir, incremental=False, as_of=None):
+    """
+    Action-date range to crawl for a NAICS code, and whether the result
+    should be merged into its existing partitions rather than replace them.
+
+    Ranges end at `as_of` (default today). In incremental mode a code with
+    data on disk only asks for actions from shortly before its high-water
+    mark.
+    """
+    today = as_of or date.today()
+    if incremental:
+        high_water = manifest.high_water(naics) or max_action_date(naics, output_dir)
+        if high_water and (output_dir / f"naics={naics}").exists():
+            start = date.fromisoformat(high_water) - timedelta(days=INCREMENTAL_OVERLAP_DAYS)
+            return start, today, True
+    return date.fromisoformat(ACTION_START_DATE), today, False
+
+
+# -----------------------------
+# Crawl progress
+# -----------------------------
+class WindowProgress:
+    """
+    Crawl state for one NAICS code and filter window.
+
+    Records before `committed` are on disk in the first `written` staged
+    part files. Pages that come back out of order wait in `pages` until the
+    gap before them fills, and full buffers wait in the normalize and write
+    stages' bounded queues, so memory holds at most a few row groups plus
+    the in-flight pages.
+    """
+
+    def __init__(self, naics, window, offset=0, parts=0, done=False):
+        self.naics = naics
+        self.window = window  # award start/end, then action start/end
+        self.action_window = window[2:]
+        self.next_offset = offset
+        self.taken = offset  # records moved out of `pages`
+        self.committed = offset
+        self.end_offset = offset if done else None  # first record not worth keeping, once known
+        self.failed_at = None  # lowest offset of a page that failed
+        self.records_end = None  # offset after the last record, once a short last page shows it
+        self.pages = {}  # offset -> results
+        self.buffer = []  # contiguous records not yet handed to the normalize stage
+        self.in_flight = 0
+        self.parts = parts  # parts handed to the normalize stage
+        self.written = parts  # parts on disk
+        self.writing = 0
+        self.write_failed = False  # parts after a failed one are not counted, even if they were written
+
+    @property
+    def finished(self):
+        """Every page has come back."""
+        return self.end_offset is not None and self.in_flight == 0
 
+    @property
+    def settled(self):
+        """Every page has come back and every record kept is on disk."""
+        return self.finished and not self.buffer and self.writing == 0
+
+    @property
+    def failed(self):
+        """
+        Records are missing: a part failed to write, or a page failed that
+        is not past the last record. Speculative pages beyond the end may
+        fail (the API rejects some of them) before the last page arrives.
+        """
+        if self.write_failed:
+            return True
+        return self.failed_at is not None and (self.records_end is None or self.failed_at < self.records_end)
+
+    def take_contiguous(self):
+        while self.taken in self.pages and (self.end_offset is None or self.taken < self.end_offset):
+            results = self.pages.pop(self.taken)
+            self.buffer.extend(results)
+            self.taken += len(results)
+
+
+class CodeCrawl:
+    """All windows of one NAICS code, in the order their records are merged."""
+
+    def __init__(self, naics, windows, merge=False):
+        self.naics = naics
+        self.windows = windows
+        self.merge = merge
+
+    @property
+    def finished(self):
+        return all(w.settled for w in self.windows)
+
+    @property
+    def failed(self):
+        return any(w.failed for w in self.windows)
+
+
+def record_page(progress, future, offset, limit, stats):
+    page = offset // limit + 1
+    label = f"NAICS {progress.naics} {progress.action_window[0]}..{progress.action_window[1]}"
+    try:
+        data = future.result()
+    except Exception as e:
+        print(f"Failed to fetch page {page} for {label}: {e}")
+        progress.failed_at = min(offset, progress.failed_at if progress.failed_at is not None else offset)
+        progress.end_offset = min(offset, progress.end_offset if progress.end_offset is not None else offset)
+        return
+
+    results = data.get("results", [])
+    stats.add_page(len(results), progress.naics)
+    if results:
+        progress.pages[offset] = results
+        print(f"  Page {page} (limit {limit}) fetched for {label}, {len(results)} records")
+    if not results or is_last_page(data, results, limit):
+        end = progress.records_end = offset + len(results)
+        progress.end_offset = min(end, progress.end_offset if progress.end_offset is not None else end)
+
+
+def flush(progress, manifest, output_dir, normalizer):
+    """
+    Hand the buffered records to the normalize stage as the window's next
+    part. Returns the part's Future and record count, or None if there was
+    nothing to write; the checkpoint moves on once the part is written.
+    """
+    if not progress.buffer:
+        checkpoint(progress, manifest)
+        return None
+    path = part_path(staging_dir(output_dir, progress.naics, progress.window), progress.parts)
+    future = normalizer.put((progress.naics, path, progress.buffer))
+    rows = len(progress.buffer)
+    progress.parts += 1
+    progress.writing += 1
+    progress.buffer = []
+    return future, rows
+
+
+def part_written(progress, future, rows, manifest):
+    progress.writing -= 1
+    try:
+        future.result()
+    except Exception as e:
+        print(f"Failed to write part {progress.written} for NAICS {progress.naics}: {e}")
+        progress.write_failed = True
+    if not progress.write_failed:
+        progress.written += 1
+        progress.committed += rows
+    checkpoint(progress, manifest)
+
+
+def checkpoint(progress, manifest):
+    # Exhausted: the last page has come back and every record up to it is on disk, though pages past it may not have
+    exhausted = progress.records_end is not None and progress.committed >= progress.records_end
+    manifest.update(progress.naics, progress.window, offset=progress.committed, parts=progress.written,
+                    done=progress.settled and not progress.failed, exhausted=exhausted)
+
+
+def finish(code, manifest, output_dir, metrics):
+    naics = code.naics
+    if code.failed:
+        committed = sum(w.committed for w in code.windows)
+        print(f"NAICS {naics} incomplete: {committed} records checkpointed, rerun to resume")
+        return
+    started = time.monotonic()
+    staged = [staging_dir(output_dir, naics, w.window) for w in code.windows]
+    if code.merge:
+        tables = list(iter_parts(staged))
+        rows = sum(t.num_rows for t in tables)
+        if rows:
+            delta = pa.concat_tables(tables)
+            key = DEDUPE_KEY if set(DEDUPE_KEY) <= set(delta.column_names) else ["Award ID", "Mod"]
+            added = merge_code(naics, delta, key, output_dir)
+            print(f"Merged {rows} records for NAICS {naics}, {added} new")
+        else:
+            print(f"No new records for NAICS {naics}")
+    else:
+        rows = write_code(naics, iter_parts(staged), output_dir)
+        if rows:
+            print(f"Saved {rows} records for NAICS {naics}")
+        else:
+            print(f"No records found for NAICS {naics}")
+    metrics.observe("finish_seconds", time.monotonic() - started, naics=naics, mode="merge" if code.merge else "write")
+    remove_parts(staged)
+    manifest.drop_code(naics)  # the next run plans it afresh, even while other codes are still failing
+    high_water = max_action_date(naics, output_dir)
+    if high_water:
+        manifest.set_high_water(naics, high_water)
+    if rows:
+        started = time.monotonic()
         try:
-            data = fetch_with_retry(payload)
+            awards.build(output_dir)  # only the files just written are rolled up again
         except Exception as e:
-            print(f"Failed to fetch page {page} for NAICS {naics}: {e}")
-            break
+            print(f"Failed to update the award table, it is rebuilt when next read: {e}")
+        metrics.observe("awards_seconds", time.monotonic() - started, naics=naics)
+
+
+# -----------------------------
+# Concurrent crawl
+# -----------------------------
+def crawl(naics_codes=DEFENSE_NAICS, concurrency=CONCURRENCY, pages_per_window=PAGES_PER_WINDOW,
+          rate=REQUESTS_PER_SECOND, base_url=BASE_URL, output_dir=OUTPUT_DIR, client=None,
+          restart=False, incremental=False, max_window_records=MAX_WINDOW_RECORDS, cache=None, as_of=None,
+          metrics=None):
+    """
+    Fetch several NAICS codes at once, each split into action-date windows
+    that are fetched in parallel.
 
-        results = data.get("results", [])
-        if not results:
-            break  # no more pages
-
-        all_records.extend(results)
-        print(f"  Page {page} fetched, {len(results)} records")
-        page += 1
-        time.sleep(0.3)  # polite pause
-
-    # Save results immediately
-    if all_records:
-        df = pd.DataFrame(all_records)
-        file_path = OUTPUT_DIR / f"naics_{naics}.parquet"
-        df.to_parquet(file_path, engine="pyarrow", index=False)
-        print(f"Saved {len(all_records)} records for NAICS {naics}")
+    Each code's action-date range is first bisected, using the count
+    endpoint, into windows of at most `max_window_records` transactions, so
+    page numbers never get deep and one slow window cannot stall the rest of
+    the code. At most `concurrency` requests are in flight overall and at
+    most `pages_per_window` for any one window; every request first takes a
+    token from a shared bucket refilled at `rate` requests/sec. Pages are
+    tracked by record offset so the client's adaptive page size can change
+    between requests.
+
+    Records are streamed to staged part files in offset order through a
+    pipeline (see pipeline.py): fetch workers decode pages, one normalize
+    thread flattens and types each full buffer, and one write thread writes
+    the parquet parts and then each finished code's partitions, all running
+    at once behind bounded queues. Progress is checkpointed in a manifest
+    next to the output as parts land on disk, so an interrupted or
+    failed crawl picks up where it stopped on the next run (unless `restart`
+    is set). A code's partitions in the dataset are only replaced, windows in
+    date order, once every page has been fetched, and its entries then
+    leave the manifest, so only codes that failed are resumed.
+
+    With `incremental` set, codes that already have data only fetch actions
+    since their `Action Date` high-water mark and merge them into the
+    fiscal-year partitions they fall in.
+
+    With a ResponseCache, requests it holds are served from disk without
+    waiting for a token. Replaying a recorded crawl needs the same `as_of`
+    date, since the windows (and so every query) depend on it; pages are
+    looked up by the records they cover, not by page size.
+    """
+    output_dir.mkdir(exist_ok=True)
+    manifest = CrawlManifest(output_dir)
+    if restart:
+        manifest.clear_windows()
+        shutil.rmtree(output_dir / STAGING_DIR, ignore_errors=True)
+    bucket = TokenBucket(rate, capacity=concurrency)
+    stats = CrawlStats(metrics)
+    client = client or FetchClient(base_url, pool_size=concurrency, cache=cache, metrics=stats.metrics)
+    if client.metrics is None:
+        client.metrics = stats.metrics
+
+    def count(naics, action_window):
+        return fetch_count(naics, action_window, client, base_url, throttle=bucket.acquire)
+
+    def plan_code(naics):
+        start, end, merge = action_range(naics, manifest, output_dir, incremental, as_of)
+        windows = plan_windows(start, end, lambda w: count(naics, w), max_window_records)
+        manifest.set_plan(naics, windows=windows, merge=merge, done=False)
+        return manifest.plan(naics)
+
+    def fetch_page(progress, offset, limit):
+        started = time.monotonic()
+        try:
+            return fetch_records(progress.naics, progress.action_window, offset, limit, client,
+                                 throttle=bucket.acquire, labels={"naics": progress.naics, "endpoint": "search"})
+        finally:
+            fetch_stage.record(busy=time.monotonic() - started)
+
+    def normalize_part(part):
+        naics, path, records = part
+        started = time.monotonic()
+        table = normalize(records)
+        stats.metrics.observe("normalize_seconds", time.monotonic() - started, naics=naics)
+        return lambda: write_part(naics, table, path)
+
+    def write_part(naics, table, path):
+        started = time.monotonic()
+        write_table(table, path)
+        stats.metrics.observe("write_seconds", time.monotonic() - started, naics=naics)
+
+    def start_code(naics, plan):
+        windows = []
+        for action_window in plan["windows"]:
+            window = (AWARD_START_DATE, AWARD_END_DATE, *action_window)
+            entry = manifest.get(naics, window)
+            offset, parts = entry.get("offset", 0), entry.get("parts", 0)
+            done = entry.get("done", False) or entry.get("exhausted", False)
+            if not done and offset % client.page_size.sizes[0] != 0:
+                print(f"NAICS {naics} {action_window[0]}..{action_window[1]}: checkpoint at {offset} records is "
+                      f"not on a page boundary, fetching the window again")
+                offset, parts = 0, 0
+            windows.append(WindowProgress(naics, window, offset, parts, done))
+            remove_parts_from(staging_dir(output_dir, naics, window), parts)
+        resumed = sum(w.committed for w in windows)
+        print(f"Fetching NAICS {naics} in {len(windows)} windows"
+              + (f", resuming at {resumed} records" if resumed else "") + "...")
+        return CodeCrawl(naics, windows, plan.get("merge", False))
+
+    pending = list(naics_codes)
+    active = {}  # naics -> CodeCrawl, oldest first
+    fetch_stage = pipeline.StageStats("fetch", concurrency)
+    writer = pipeline.Stage("write", lambda job: job())
+    normalizer = pipeline.Stage("normalize", normalize_part, downstream=writer)
+    stages = [fetch_stage, normalizer, writer]
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        futures = {}
+        fetching = 0  # futures that are page fetches or plans, as opposed to writes
+        while pending or active or futures:
+            # Fill free worker slots, oldest NAICS code and earliest window first
+            for code in active.values():
+                for progress in code.windows:
+                    while (progress.end_offset is None and progress.in_flight < pages_per_window
+                           and fetching < concurrency):
+                        offset = progress.next_offset
+                        limit = client.page_size.limit_for(offset)
+                        futures[pool.submit(fetch_page, progress, offset, limit)] = ("page", progress, offset, limit)
+                        progress.next_offset += limit
+                        progress.in_flight += 1
+                        fetching += 1
+
+            # Plan the next code while there are slots to spare
+            while pending and fetching < concurrency:
+                naics = pending.pop(0)
+                plan = manifest.plan(naics)
+                if plan and plan.get("done"):
+                    manifest.drop_code(naics)  # left behind by an older crawler; finished codes drop their plan
+                    plan = None
+                if plan:
+                    active[naics] = start_code(naics, plan)
+                else:
+                    print(f"Planning windows for NAICS {naics}...")
+                    futures[pool.submit(plan_code, naics)] = ("plan", naics)
+                    fetching += 1
+                    break
+
+            if futures:
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            else:
+                done = []
+            for future in done:
+                task = futures.pop(future)
+                if task[0] == "plan":
+                    fetching -= 1
+                    naics = task[1]
+                    try:
+                        active[naics] = start_code(naics, future.result())
+                    except Exception as e:
+                        print(f"Failed to plan windows for NAICS {naics}: {e}")
+                        stats.failed.append(naics)
+                    continue
+                if task[0] == "part":
+                    part_written(task[1], future, task[2], manifest)
+                    continue
+                if task[0] == "finish":
+                    code = task[1]
+                    try:
+                        future.result()
+                        written = not code.failed
+                    except Exception as e:
+                        print(f"Failed to write NAICS {code.naics}: {e}")
+                        written = False
+                    if not written:
+                        stats.failed.append(code.naics)
+                    continue
+
+                fetching -= 1
+                _, progress, offset, limit = task
+                progress.in_flight -= 1
+                if progress.end_offset is None or offset < progress.end_offset:
+                    record_page(progress, future, offset, limit, stats)
+                progress.take_contiguous()
+                if len(progress.buffer) >= ROW_GROUP_RECORDS or progress.finished:
+                    started = time.monotonic()
+                    part = flush(progress, manifest, output_dir, normalizer)
+                    fetch_stage.record(blocked=time.monotonic() - started, items=0)  # pages wait while normalize is full
+                    if part:
+                        futures[part[0]] = ("part", progress, part[1])
+
+            # Write out every code whose windows have all come back and are on disk
+            for naics in [n for n, c in active.items() if c.finished]:
+                code = active.pop(naics)
+                job = writer.put(lambda code=code: finish(code, manifest, output_dir, stats.metrics))
+                futures[job] = ("finish", code)
+
+    normalizer.close()
+    stats.stop()
+    stats.stages = {stage.name: stage.summary(stats.elapsed) for stage in stages}
+    for stage in stages:
+        stats.metrics.count("stage_busy_seconds", stage.busy, stage=stage.name)
+        stats.metrics.count("stage_blocked_seconds", stage.blocked, stage=stage.name)
+    stats.hosts = {name: {"concurrency_limit": host.limit, "throttled": host.throttled}
+                   for name, host in client.retry.hosts.items()}
+    if stats.failed:
+        print(f"Crawl incomplete, NAICS codes to resume: {', '.join(stats.failed)}")
     else:
-        print(f"No records found for NAICS {naics}")
+        manifest.clear_windows()
+        shutil.rmtree(output_dir / STAGING_DIR, ignore_errors=True)
+    print(f"Crawl finished: {stats.summary()}")
+    print(stats.table())
+    print(pipeline.table(stages, stats.elapsed))
+    if client.cache is not None:
+        print(f"Response cache: {client.cache.summary()}")
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fetch defense NAICS transactions from USAspending")
+    parser.add_argument("--naics", nargs="+", default=DEFENSE_NAICS, help="NAICS codes to fetch")
+    parser.add_argument("--concurrency", type=int, default=CONCURRENCY, help="max requests in flight")
+    parser.add_argument("--pages-per-window", type=int, default=PAGES_PER_WINDOW,
+                        help="max requests in flight for a single action-date window")
+    parser.add_argument("--max-window-records", type=int, default=MAX_WINDOW_RECORDS,
+                        help="split action-date windows holding more records than this")
+    parser.add_argument("--rate", type=float, default=REQUESTS_PER_SECOND, help="max requests per second")
+    parser.add_argument("--base-url", default=BASE_URL, help="spending_by_transaction endpoint")
+    parser.add_argument("--output-dir", type=Path, default=OUTPUT_DIR)
+    parser.add_argument("--restart", action="store_true",
+                        help="discard checkpointed progress from an interrupted crawl")
+    parser.add_argument("--incremental", action="store_true",
+                        help="only fetch actions newer than each code's stored high-water mark")
+    parser.add_argument("--cache", choices=MODES, default=DEFAULT_MODE,
+                        help="response cache mode: replay serves stale entries too, offline never touches the network")
+    parser.add_argument("--cache-dir", type=Path, default=CACHE_DIR)
+    parser.add_argument("--cache-ttl", type=float, default=DEFAULT_TTL, help="seconds a cached response stays fresh")
+    parser.add_argument("--as-of", type=date.fromisoformat,
+                        help="crawl as if today were this date (YYYY-MM-DD), to replay a cached crawl")
+    parser.add_argument("--report", type=Path, nargs="+", default=[],
+                        help="write the run report here: Prometheus text for *.prom, JSON otherwise")
+    args = parser.parse_args()
+
+    cache = None if args.cache == "off" else ResponseCache(args.cache_dir, args.cache, args.cache_ttl)
+    stats = crawl(args.naics, concurrency=args.concurrency, pages_per_window=args.pages_per_window,
+                  rate=args.rate, base_url=args.base_url, output_dir=args.output_dir,
+                  restart=args.restart, incremental=args.incremental,
+                  max_window_records=args.max_window_records, cache=cache, as_of=args.as_of)
+    for path in args.report:
+        stats.metrics.write(path, **stats.report())
+        print(f"Run report written to {path}")
+    if stats.failed:
+        sys.exit(1)
+    print("All NAICS codes processed!")
+
 
-print("All NAICS codes processed!")
\ No newline at end of file
+if __name__ == "__main__":
+    main()